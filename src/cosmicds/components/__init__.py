@@ -1,11 +1,34 @@
-from .scaffold_alert import ScaffoldAlert
-from .math_jax_support.math_jax_support import MathJaxSupport
-from .plotly_support.plotly_support import PlotlySupport
-from .viewer_layout import *
-from .debug_control import StateEditor
-from .layer_toggle import LayerToggle
-from .statistics_selector import StatisticsSelector
-from .percentage_selector import PercentageSelector
-from .refresh_button import RefreshButton
-from .info_dialog.info_dialog import InfoDialog
-from .google_analytics_support.google_analytics_support import GoogleAnalyticsSupport
+from importlib import import_module
+
+# The components are imported on first access (PEP 562), so that using one
+# of them does not import the dependencies of all the others (e.g. glue and
+# plotly for the viewer layout)
+_COMPONENTS = {
+    "ScaffoldAlert": ".scaffold_alert",
+    "MathJaxSupport": ".math_jax_support.math_jax_support",
+    "PlotlySupport": ".plotly_support.plotly_support",
+    "ToolBar": ".viewer_layout",
+    "ViewerLayout": ".viewer_layout",
+    "StateEditor": ".debug_control",
+    "RenderProfile": ".debug_control",
+    "LayerToggle": ".layer_toggle",
+    "StatisticsSelector": ".statistics_selector",
+    "PercentageSelector": ".percentage_selector",
+    "RefreshButton": ".refresh_button",
+    "InfoDialog": ".info_dialog.info_dialog",
+    "GoogleAnalyticsSupport": ".google_analytics_support.google_analytics_support",
+}
+
+__all__ = list(_COMPONENTS)
+
+
+def __getattr__(name):
+    if name not in _COMPONENTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(_COMPONENTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -6,6 +6,7 @@ import reacton.ipyvuetify as rv
 from cosmicds.remote import BaseAPI
 
 from .refresh_button import RefreshButton
+from ..profiling import profile_render, render_profiler
 from ..state import GLOBAL_STATE, BaseLocalState, BaseState
 
 from enum import Enum
@@ -78,12 +79,59 @@ def FieldList(component_state: Reactive[BS]):
 
 
 @solara.component
+def RenderProfile():
+    """
+    A table of the render statistics recorded in this session while in
+    debug mode: renders, cumulative and 95th percentile render times,
+    and the reactive variables that triggered the renders.
+    """
+    # The statistics are not reactive, so they are read on refresh
+    profiler = render_profiler()
+    _, set_refreshes = solara.use_state(0)
+
+    def refresh():
+        set_refreshes(lambda count: count + 1)
+
+    def reset():
+        profiler.reset()
+        refresh()
+
+    with solara.Card(title="Render Profile", style="max-width: 800px"):
+        with solara.Row():
+            solara.Button(children="Refresh", on_click=refresh)
+            solara.Button(children="Reset", on_click=reset)
+
+        profile = profiler.snapshot()
+        if not profiler.enabled:
+            solara.Markdown("Render profiling is on in debug mode only.")
+        elif not profile:
+            solara.Markdown("No renders recorded yet.")
+        else:
+            rows = [
+                "| Component | Renders | Total (ms) | p95 (ms) | Triggers |",
+                "|:--|--:|--:|--:|:--|",
+            ]
+            for name, stats in profile.items():
+                triggers = ", ".join(
+                    f"{trigger} ({count})"
+                    for trigger, count in stats["triggers"].items()
+                )
+                rows.append(
+                    f"| {name} | {stats['renders']} | {stats['total_ms']:.1f} "
+                    f"| {stats['p95_ms']:.1f} | {triggers} |"
+                )
+            solara.Markdown("\n".join(rows))
+
+
+@solara.component
+@profile_render
 def StateEditor(marker_cls: Type[Enum],
                 component_state: Reactive[BS],
                 local_state: Reactive[BLS],
                 api: BaseAPI,
                 show_all: bool = True):
     show_dialog, set_show_dialog = solara.use_state(False)
+    show_profile, set_show_profile = solara.use_state(False)
     with solara.Card(style="border-radius: 5px; border: 2px solid #EC407A; max-width: 400px"):
         if show_all:
             with solara.Row():
@@ -105,11 +153,21 @@ def StateEditor(marker_cls: Type[Enum],
                         children="Edit State",
                         on_click=lambda: set_show_dialog(not show_dialog)
                     )
+                with solara.Column():
+                    solara.Button(
+                        children="Render Profile",
+                        on_click=lambda: set_show_profile(not show_profile)
+                    )
             with solara.Column():
                 with rv.Dialog(v_model=show_dialog, on_v_model=set_show_dialog, max_width="500px"):
                     with solara.Card():
                         with solara.Column():
                             FieldList(component_state)      
+                with rv.Dialog(
+                    v_model=show_profile, on_v_model=set_show_profile, max_width="800px"
+                ):
+                    if show_profile:
+                        RenderProfile()
             
         if show_all:
             with solara.Row():
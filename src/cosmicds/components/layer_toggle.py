@@ -7,6 +7,8 @@ from traitlets import List, observe
 import solara
 import os
 
+from ..profiling import profile_render
+
 
 class _LayerToggle(VuetifyTemplate):
     # absolute path for __file__ /.. / .. / "vue_components" / "layer_toggle.vue"
@@ -119,5 +121,6 @@ class _LayerToggle(VuetifyTemplate):
 
 
 @solara.component
+@profile_render
 def LayerToggle(viewer, names=None, sort=None, ignore_conditions=None, *args, **kwargs):
     return _LayerToggle.element(viewer=viewer, names=names, sort=sort, ignore_conditions=ignore_conditions)
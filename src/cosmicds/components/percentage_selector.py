@@ -4,6 +4,7 @@ import reacton.ipyvuetify as rv
 
 from glue.core.subset import ElementSubsetState, SubsetState
 
+from ..profiling import profile_render
 from ..utils import percent_around_center_indices
 
 from glue.core import Data, Session
@@ -13,6 +14,7 @@ from typing import Callable, Iterable, List, Optional
 
 
 @solara.component
+@profile_render
 def PercentageSelector(viewers: List[Viewer],
                        glue_data: List[Data],
                        bins: None | List[None | Iterable[None | Number]]=None,
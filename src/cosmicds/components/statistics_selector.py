@@ -14,6 +14,7 @@ from plotly.graph_objects import Scatter
 from numbers import Number
 from typing import Callable, Iterable, List, Optional
 
+from ..profiling import profile_render
 from ..utils import line_mark, mode, CDS_IMAGE_BASE_URL
 
 image_location=f"{CDS_IMAGE_BASE_URL}"
@@ -44,6 +45,7 @@ def labeled_vertical_line(x: float, y_min: float, y_max: float, color: str, labe
 
 
 @solara.component
+@profile_render
 def StatisticsSelector(viewers: List[PlotlyBaseView],
                        glue_data: List[Data],
                        units: List[str],
@@ -0,0 +1,323 @@
+import asyncio
+import functools
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+from typing import Any, Callable, Hashable, Optional
+
+from solara.server import kernel_context
+
+from cosmicds.event_loop import get_event_loop
+from cosmicds.logger import setup_logger
+
+logger = setup_logger("DEBOUNCE")
+
+__all__ = ["Coalescer", "Debouncer", "coalesce", "debounce"]
+
+
+def _session_key() -> Optional[str]:
+    if kernel_context.has_current_context():
+        return kernel_context.get_current_context().id
+    return None
+
+
+class _Pending:
+    __slots__ = ("first", "deadline", "call", "trailing", "armed", "context", "future")
+
+    def __init__(self, first: float, context):
+        self.first = first
+        self.deadline = first
+        self.call: tuple = ()
+        self.trailing = False
+        self.armed = False
+        self.context = context
+        self.future: Optional[Future] = None
+
+
+class Debouncer:
+    """
+    Postpones calls to ``function`` until ``wait`` seconds have passed
+    without another call, separately for every instance (when used as a
+    method), solara session and optional ``key``, so that one student's
+    calls never cancel another's.
+
+    The timers live on the shared event loop (see `cosmicds.event_loop`)
+    rather than in a thread per call: a call only moves the deadline of
+    the pending one, which is checked when its timer fires. Postponed
+    calls run on the reused executor threads of that loop, within the
+    session they were made from. Pending calls only hold weak references
+    to their instance, and are dropped if it is collected before they are
+    made.
+
+    Parameters
+    ----------
+    function : callable
+        The function to debounce.
+    wait : float
+        The seconds without calls after which the last one is made.
+    leading : bool, optional
+        Whether to make the first call of a burst immediately, in the
+        calling thread.
+    trailing : bool, optional
+        Whether to make the last call of a burst once it is over. With
+        ``leading`` too, it is only made if there was more than one call.
+    max_wait : float, optional
+        The most seconds a call may be postponed, even while calls keep
+        coming.
+    key : callable, optional
+        Computes an additional key from the arguments of a call, e.g. the
+        ID of the measurement being edited, to debounce separately.
+    """
+
+    def __init__(
+        self,
+        function: Callable,
+        wait: float,
+        leading: bool = False,
+        trailing: bool = True,
+        max_wait: Optional[float] = None,
+        key: Optional[Callable[..., Hashable]] = None,
+    ):
+        if not (leading or trailing):
+            raise ValueError("A debouncer must call on the leading or trailing edge.")
+        self.function = function
+        self.wait = wait
+        self.leading = leading
+        self.trailing = trailing
+        self.max_wait = max_wait
+        self.key = key
+        self._lock = threading.Lock()
+        self._pending: dict[tuple, _Pending] = {}
+        # Keys for the instances with calls, which go when they do
+        self._instance_keys: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self._stats = {"calls": 0, "runs": 0}
+        functools.update_wrapper(self, function)
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        return functools.partial(self._bound_call, instance)
+
+    def __call__(self, *args, **kwargs) -> None:
+        self._call(None, *args, **kwargs)
+
+    def _bound_call(self, instance, *args, **kwargs) -> None:
+        self._call(instance, *args, **kwargs)
+
+    def _instance_key(self, instance) -> Hashable:
+        if instance is None:
+            return None
+        try:
+            return self._instance_keys.setdefault(instance, object())
+        except TypeError:
+            # Not hashable or weakly referenceable, so kept alive by its call
+            return id(instance)
+
+    @staticmethod
+    def _reference(instance) -> Optional[Callable[[], Any]]:
+        if instance is None:
+            return None
+        try:
+            return weakref.ref(instance)
+        except TypeError:
+            return lambda: instance
+
+    # Whether calls get a future for the result, see `Coalescer`
+    _returns_future = False
+
+    def _call(self, instance, *args, **kwargs) -> _Pending:
+        extra = self.key(*args, **kwargs) if self.key is not None else None
+        call = (self._reference(instance), args, kwargs)
+        now = time.monotonic()
+
+        with self._lock:
+            key = (self._instance_key(instance), _session_key(), extra)
+            self._stats["calls"] += 1
+            pending = self._pending.get(key)
+            if pending is None:
+                context = None
+                if kernel_context.has_current_context():
+                    context = kernel_context.get_current_context()
+                pending = self._pending[key] = _Pending(now, context)
+                if self._returns_future:
+                    pending.future = Future()
+                call_now = self.leading
+                pending.trailing = self.trailing and not call_now
+            else:
+                call_now = False
+                pending.trailing = self.trailing
+            pending.call = call
+            pending.deadline = now + self.wait
+            if self.max_wait is not None:
+                pending.deadline = min(pending.deadline, pending.first + self.max_wait)
+            arm = not pending.armed
+            pending.armed = True
+
+        if arm:
+            loop = get_event_loop()
+            loop.call_soon_threadsafe(self._arm, loop, key, pending)
+        if call_now:
+            self._run(call, pending.context)
+        return pending
+
+    def _arm(self, loop: asyncio.AbstractEventLoop, key: tuple, pending: _Pending):
+        delay = max(pending.deadline - time.monotonic(), 0)
+        loop.call_later(delay, self._fire, loop, key, pending)
+
+    def _fire(self, loop: asyncio.AbstractEventLoop, key: tuple, pending: _Pending):
+        with self._lock:
+            if pending.deadline > time.monotonic():
+                # Postponed by later calls since the timer was set
+                loop.call_later(
+                    pending.deadline - time.monotonic(), self._fire, loop, key, pending
+                )
+                return
+            if self._pending.get(key) is pending:
+                del self._pending[key]
+            if not pending.trailing:
+                return
+
+        context = pending.context
+        if context is not None and context.closed_event.is_set():
+            if pending.future is not None:
+                pending.future.cancel()
+            return
+        loop.run_in_executor(None, self._run, pending.call, context, pending.future)
+
+    def _run(self, call: tuple, context=None, future: Optional[Future] = None):
+        reference, args, kwargs = call
+        if reference is not None:
+            instance = reference()
+            if instance is None:
+                # Collected while the call was pending
+                if future is not None:
+                    future.cancel()
+                return
+            args = (instance, *args)
+        with self._lock:
+            self._stats["runs"] += 1
+        if future is not None and not future.set_running_or_notify_cancel():
+            return
+        try:
+            # The executor threads may have inherited another session
+            with context or kernel_context.without_context():
+                result = self.function(*args, **kwargs)
+        except Exception as e:
+            if future is None:
+                logger.exception("Debounced call to `%s` failed.", self.__qualname__)
+            else:
+                future.set_exception(e)
+        else:
+            if future is not None:
+                future.set_result(result)
+
+    @property
+    def pending(self) -> int:
+        """The number of calls waiting to be made."""
+        with self._lock:
+            return len(self._pending)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, pending=len(self._pending))
+
+
+class _BoundCoalescer:
+    def __init__(self, coalescer: "Coalescer", instance: Any):
+        self._coalescer = coalescer
+        self._instance = instance
+
+    def __call__(self, *args, **kwargs) -> Future:
+        return self._coalescer._future(self._instance, *args, **kwargs)
+
+    async def aio(self, *args, **kwargs) -> Any:
+        return await asyncio.wrap_future(self(*args, **kwargs))
+
+
+class Coalescer(Debouncer):
+    """
+    Coalesces the calls to ``function`` made within ``wait`` seconds of
+    each other (per instance, session and ``key``, like `Debouncer`) into
+    a single call, made with the arguments of the last one once the calls
+    stop. Every call returns a `concurrent.futures.Future`, the same for
+    all the calls coalesced, which gets the result (or exception) of that
+    call. No thread waits on it unless the caller does.
+
+    From asyncio code, ``await coalesced.aio(...)`` instead, on any event
+    loop.
+
+    Parameters
+    ----------
+    function : callable
+        The function to coalesce the calls of.
+    wait : float
+        The seconds without calls after which the call is made.
+    max_wait : float, optional
+        The most seconds a call may be postponed, even while calls keep
+        coming.
+    key : callable, optional
+        Computes an additional key from the arguments of a call, to
+        coalesce separately.
+    """
+
+    def __init__(
+        self,
+        function: Callable,
+        wait: float,
+        max_wait: Optional[float] = None,
+        key: Optional[Callable[..., Hashable]] = None,
+    ):
+        super().__init__(function, wait, max_wait=max_wait, key=key)
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        return _BoundCoalescer(self, instance)
+
+    def __call__(self, *args, **kwargs) -> Future:
+        return self._future(None, *args, **kwargs)
+
+    async def aio(self, *args, **kwargs) -> Any:
+        return await asyncio.wrap_future(self(*args, **kwargs))
+
+    _returns_future = True
+
+    def _future(self, instance, *args, **kwargs) -> Future:
+        return self._call(instance, *args, **kwargs).future
+
+
+def coalesce(
+    wait: float,
+    max_wait: Optional[float] = None,
+    key: Optional[Callable[..., Hashable]] = None,
+) -> Callable[[Callable], Coalescer]:
+    """
+    Decorator that coalesces the calls to a function made within ``wait``
+    seconds of each other into one, whose result every call gets through
+    a future (see `Coalescer`).
+    """
+
+    def decorator(function: Callable) -> Coalescer:
+        return Coalescer(function, wait, max_wait, key)
+
+    return decorator
+
+
+def debounce(
+    wait: float,
+    leading: bool = False,
+    trailing: bool = True,
+    max_wait: Optional[float] = None,
+    key: Optional[Callable[..., Hashable]] = None,
+) -> Callable[[Callable], Debouncer]:
+    """
+    Decorator that postpones calls to a function until ``wait`` seconds
+    have passed since it was last called, per instance and session (see
+    `Debouncer`).
+    """
+
+    def decorator(function: Callable) -> Debouncer:
+        return Debouncer(function, wait, leading, trailing, max_wait, key)
+
+    return decorator
@@ -0,0 +1,73 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Coroutine, Optional, TypeVar
+
+from cosmicds.logger import setup_logger
+
+logger = setup_logger("LOOP")
+
+T = TypeVar("T")
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_thread: Optional[threading.Thread] = None
+_lock = threading.Lock()
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Returns the asyncio event loop shared by the whole worker process,
+    starting it on a daemon thread the first time it is requested.
+
+    Anything that has to live on a single loop (e.g. the pooled ``httpx``
+    client used by `~cosmicds.remote.AsyncBaseAPI`) should be used from
+    this loop only.
+    """
+    global _loop, _thread
+
+    with _lock:
+        if _loop is None or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            _thread = threading.Thread(
+                target=_loop.run_forever, name="cosmicds-event-loop", daemon=True
+            )
+            _thread.start()
+            logger.info("Started shared event loop.")
+
+    return _loop
+
+
+def in_event_loop_thread() -> bool:
+    """Whether the caller is running on the shared event loop thread."""
+    return _thread is not None and threading.current_thread() is _thread
+
+
+def run_coroutine(coro: Coroutine[Any, Any, T]) -> "Future[T]":
+    """
+    Schedules ``coro`` on the shared event loop from any thread and returns
+    a `concurrent.futures.Future` for its result.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+
+
+def run_sync(coro: Coroutine[Any, Any, T], timeout: Optional[float] = None) -> T:
+    """
+    Runs ``coro`` on the shared event loop and blocks until it finishes.
+    Must not be called from the shared loop itself.
+    """
+    if in_event_loop_thread():
+        coro.close()
+        raise RuntimeError("Cannot block on the shared event loop from within it.")
+
+    return run_coroutine(coro).result(timeout)
+
+
+async def run_on_loop(coro: Coroutine[Any, Any, T]) -> T:
+    """
+    Awaits ``coro`` on the shared event loop, regardless of which event loop
+    the caller is running in (e.g. the per-thread loop of a solara task).
+    """
+    if in_event_loop_thread():
+        return await coro
+
+    return await asyncio.wrap_future(run_coroutine(coro))
@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import threading
+import time
+from typing import TYPE_CHECKING, Optional
+
+from cosmicds import configure_glue
+from cosmicds.logger import setup_logger
+
+# glue is imported when the first session uses it rather than on import
+if TYPE_CHECKING:
+    from glue_jupyter import JupyterApplication
+
+logger = setup_logger("GLUE_APP")
+
+# How long loading the glue plugins (a one-off per process) and building
+# the glue application of each session took
+GLUE_APP_STATS = {
+    "plugins_seconds": None,
+    "created": 0,
+    "build_seconds": 0.0,
+    "last_build_seconds": None,
+}
+
+_plugins_lock = threading.Lock()
+_plugins_loaded = False
+
+
+def load_glue_plugins() -> Optional[float]:
+    """
+    Loads the glue plugins, which register themselves globally and so are
+    only loaded once per process. Returns how long that took, or `None` if
+    they were already loaded.
+
+    The plugins must be loaded in the thread that uses them: importing glue
+    on a background thread would let the thread serving a page see its
+    modules (and those of e.g. pandas) half imported.
+    """
+    global _plugins_loaded
+
+    with _plugins_lock:
+        if _plugins_loaded:
+            return None
+        from glue.main import load_plugins
+
+        start = time.perf_counter()
+        configure_glue()
+        load_plugins()
+        _plugins_loaded = True
+        seconds = GLUE_APP_STATS["plugins_seconds"] = time.perf_counter() - start
+
+    logger.info("Loaded the glue plugins in %.2fs.", seconds)
+    return seconds
+
+
+def warm_up():
+    """
+    Does the one-off glue setup ahead of the first session. Meant to be
+    called by a story's app when the server starts, before it serves any
+    page, rather than on import.
+    """
+    load_glue_plugins()
+
+
+def create_glue_app() -> JupyterApplication:
+    """
+    Returns a new `JupyterApplication`, with its own glue session, for the
+    current kernel. Its widgets belong to that kernel, so an application is
+    never built ahead of time nor shared with another session.
+    """
+    load_glue_plugins()
+
+    from glue_jupyter import JupyterApplication
+
+    start = time.perf_counter()
+    app = JupyterApplication()
+    seconds = time.perf_counter() - start
+    with _plugins_lock:
+        GLUE_APP_STATS["created"] += 1
+        GLUE_APP_STATS["build_seconds"] += seconds
+        GLUE_APP_STATS["last_build_seconds"] = seconds
+    return app
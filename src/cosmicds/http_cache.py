@@ -0,0 +1,127 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from cosmicds.logger import setup_logger
+from cosmicds.metrics import template_path
+
+logger = setup_logger("HTTP_CACHE")
+
+# Number of URLs whose validators and bodies are kept
+VALIDATOR_CACHE_SIZE = int(os.getenv("CDS_API_VALIDATOR_CACHE_SIZE", 2048))
+
+
+def response_transport(response) -> str:
+    """
+    Returns the package a response comes from, e.g. ``requests`` or
+    ``httpx``, under which the caches keep it.
+    """
+    return type(response).__module__.partition(".")[0]
+
+
+class ValidatorCache:
+    """
+    A bounded, thread-safe HTTP validator cache for GET requests. The
+    ``ETag`` and ``Last-Modified`` validators of each response are stored
+    per URL along with the response, conditional requests are sent with
+    ``If-None-Match`` and ``If-Modified-Since``, and the stored response is
+    reused when the server answers ``304 Not Modified``.
+
+    Works with both `requests` and ``httpx`` responses, which are kept
+    apart (see `response_transport`) so that each client only reuses its own.
+
+    Parameters
+    ----------
+    size : int
+        The number of URLs to keep, least recently used first out.
+    """
+
+    def __init__(self, size: int = VALIDATOR_CACHE_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._stats = {}
+
+    def conditional_headers(
+        self, url: str, headers: Optional[dict] = None, transport: str = "requests"
+    ) -> dict:
+        """
+        Returns ``headers`` with the validators stored for ``url`` and the
+        given ``transport`` added, if any.
+        """
+        headers = dict(headers or {})
+        with self._lock:
+            entry = self._entries.get((transport, url))
+        if entry is not None:
+            etag, last_modified, _ = entry
+            if etag is not None:
+                headers.setdefault("If-None-Match", etag)
+            if last_modified is not None:
+                headers.setdefault("If-Modified-Since", last_modified)
+        return headers
+
+    def resolve(self, url: str, response):
+        """
+        Returns the stored response if ``response`` is a ``304 Not
+        Modified``, otherwise stores ``response`` if it has validators and
+        returns it.
+        """
+        path = template_path(url)
+        key = (response_transport(response), url)
+        with self._lock:
+            stats = self._stats.setdefault(
+                path, {"requests": 0, "hits": 0, "bytes_saved": 0}
+            )
+            stats["requests"] += 1
+
+            if response.status_code == 304:
+                entry = self._entries.get(key)
+                if entry is None:
+                    logger.warning("Got 304 for `%s` without a cached response.", url)
+                    return response
+                self._entries.move_to_end(key)
+                cached = entry[2]
+                stats["hits"] += 1
+                stats["bytes_saved"] += len(cached.content)
+                return cached
+
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+            if response.status_code == 200 and (etag or last_modified):
+                self._entries[key] = (etag, last_modified, response)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+            else:
+                self._entries.pop(key, None)
+
+        return response
+
+    def invalidate(self, url: Optional[str] = None):
+        with self._lock:
+            if url is None:
+                self._entries.clear()
+            else:
+                for key in [key for key in self._entries if key[1] == url]:
+                    del self._entries[key]
+
+    def stats(self) -> dict:
+        """
+        Returns the conditional requests, ``304`` hits and response bytes
+        saved per templated endpoint, with the totals under ``total``.
+        """
+        with self._lock:
+            stats = {path: dict(entry) for path, entry in self._stats.items()}
+            entries = len(self._entries)
+
+        total = {"requests": 0, "hits": 0, "bytes_saved": 0}
+        for entry in stats.values():
+            for key in total:
+                total[key] += entry[key]
+        total["entries"] = entries
+        stats["total"] = total
+        return stats
+
+
+API_VALIDATOR_CACHE = ValidatorCache()
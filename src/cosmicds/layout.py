@@ -1,6 +1,7 @@
 import datetime
 import os
-from typing import Optional
+import time
+from typing import Iterable, Optional
 from warnings import filterwarnings
 
 import solara
@@ -17,12 +18,19 @@ from cosmicds.components.login import Login
 from cosmicds.components.speech_settings import SpeechSettings
 from cosmicds.components.tooltip_menu import TooltipMenu
 from cosmicds.logger import setup_logger
+from cosmicds.profiling import profile_render, render_profiler
 from cosmicds.utils import get_session_id
 from .components.breakpoint_watcher.breakpoint_watcher import BreakpointWatcher
 from .components.location_helper.location_helper import LocationHelper
 from .components.theme_toggle import ThemeToggle
 from .remote import BASE_API
-from .state import GLOBAL_STATE, BaseLocalState
+from .state import (
+    GLOBAL_STATE,
+    LOGIN_STATUS,
+    BaseLocalState,
+    BaseState,
+    LoginStatus,
+)
 
 filterwarnings(action="ignore", category=UserWarning)
 
@@ -31,11 +39,59 @@ if "AWS_EBS_URL" in os.environ:
 
 logger = setup_logger("LAYOUT")
 
+DEMO_PICTURE = (
+    "https://s.gravatar.com/avatar/d49c4a758d6e45538cd0fb4cd09e91eb"
+    "?s=480&r=pg&d=https%3A%2F%2Fcdn.auth0.com%2Favatars%2Fco.png"
+)
+
+DEMO_TEACHER = {
+    "userinfo": {
+        "cds/name": "Demo Teacher",
+        "cds/email": "demo_teacher@some.email",
+        "cds/picture": DEMO_PICTURE,
+        "nickname": "cosmicds",
+        "name": "Demo Teacher",
+        "picture": DEMO_PICTURE,
+        "updated_at": "2025-02-06T17:47:34.507Z",
+        "email": "demo_teacher@some.email",
+        "email_verified": True,
+    }
+}
+
+DEMO_STUDENT = {
+    "userinfo": {
+        "cds/name": "Demo User",
+        "cds/email": "cosmicds@cfa.harvard.edu",
+        "cds/picture": DEMO_PICTURE,
+        "nickname": "cosmicds",
+        "name": "Demo User",
+        "picture": DEMO_PICTURE,
+        "updated_at": "2025-02-06T17:47:34.507Z",
+        "email": "cosmicds@cfa.harvard.edu",
+        "email_verified": True,
+    }
+}
+
 
 def BaseSetup(
     story_name: str = "",
     story_title: str = "Cosmic Data Story",
+    local_state: Optional[Reactive[BaseLocalState]] = None,
+    component_states: Iterable[Reactive[BaseState]] = (),
+    stage_ids: Iterable[str] = (),
 ):
+    """
+    Authenticates the user and loads their information. If ``local_state``
+    and ``component_states`` are given, the story state and the state of
+    every stage are loaded along with it, in a single concurrent bootstrap.
+    The states of any other ``stage_ids`` are then prefetched in the
+    background, so that navigating to those stages does not wait on the API.
+
+    The login runs once per session on a background task, as a state
+    machine (idle, loading, ready or error) exposed with the time spent in
+    each phase through `~cosmicds.state.LOGIN_STATUS`. A progress bar is
+    shown while it is loading.
+    """
     # Retrieve whether to force demo mode
     force_demo_ref = Ref(GLOBAL_STATE.fields.force_demo)
 
@@ -69,64 +125,127 @@ def BaseSetup(
 
     solara.use_memo(_load_from_cache, dependencies=[])
 
-    educator_mode = False
-    if bool(auth.user.value):
-        if BASE_API.is_educator:
-            educator_mode = True
+    def _flush_on_unload():
+        # Upload any queued state snapshots when the page goes away
+        return lambda: BASE_API.flush_states(wait=False)
+
+    solara.use_effect(_flush_on_unload, dependencies=[])
+
+    if force_demo_ref.value and not bool(auth.user.value):
+        logger.info("Loading app in demo mode.")
+        Ref(GLOBAL_STATE.fields.update_db).set(False)
+        auth.user.set(DEMO_STUDENT)
+        class_code.set("215")
+
+    authenticated = bool(auth.user.value)
+
+    def _set_phase(phase: Optional[str], started: float) -> float:
+        # Records the time spent in the current phase and moves on to the next
+        now = time.perf_counter()
+        status = LOGIN_STATUS.value
+        timings = dict(status.timings, **{status.phase: now - started})
+        LOGIN_STATUS.set(
+            status.model_copy(update={"phase": phase, "timings": timings})
+        )
+        return now
+
+    def _login():
+        # Runs on a background task, so that re-rendering never repeats the
+        # requests behind it
+        if not authenticated:
+            return
+
+        status = LOGIN_STATUS.value
+        if status.state in ("loading", "ready") and status.user == BASE_API.hashed_user:
+            return
+
+        logger.debug("User is authenticated.")
+        login_started = started = time.perf_counter()
+        LOGIN_STATUS.set(
+            LoginStatus(state="loading", phase="educator", user=BASE_API.hashed_user)
+        )
+
+        educator_mode = BASE_API.is_educator
+        if educator_mode:
             force_demo_ref.set(True)
             Ref(GLOBAL_STATE.fields.update_db).set(False)
             Ref(GLOBAL_STATE.fields.show_team_interface).set(True)
             Ref(GLOBAL_STATE.fields.educator).set(True)
 
-    if force_demo_ref.value:
-        logger.info("Loading app in demo mode.")
-        if educator_mode:
-            auth.user.set(
-                {
-                    "userinfo": {
-                        "cds/name": "Demo Teacher",
-                        "cds/email": "demo_teacher@some.email",
-                        "cds/picture": "https://s.gravatar.com/avatar/d49c4a758d6e45538cd0fb4cd09e91eb?s=480&r=pg&d=https%3A%2F%2Fcdn.auth0.com%2Favatars%2Fco.png",
-                        "nickname": "cosmicds",
-                        "name": "Demo Teacher",
-                        "picture": "https://s.gravatar.com/avatar/d49c4a758d6e45538cd0fb4cd09e91eb?s=480&r=pg&d=https%3A%2F%2Fcdn.auth0.com%2Favatars%2Fco.png",
-                        "updated_at": "2025-02-06T17:47:34.507Z",
-                        "email": "demo_teacher@some.email",
-                        "email_verified": True,
-                    }
-                }
+        code = class_code.value
+        if force_demo_ref.value:
+            logger.info("Loading app in demo mode.")
+            if educator_mode:
+                auth.user.set(DEMO_TEACHER)
+            else:
+                Ref(GLOBAL_STATE.fields.update_db).set(False)
+                auth.user.set(DEMO_STUDENT)
+            code = "215"
+
+        started = _set_phase("bootstrap", started)
+        loaded = BASE_API.bootstrap(
+            story_name, GLOBAL_STATE, local_state, component_states
+        )
+        if not loaded and bool(code):
+            started = _set_phase("create_user", started)
+            BASE_API.create_new_user(story_name, code, GLOBAL_STATE)
+            loaded = BASE_API.bootstrap(
+                story_name, GLOBAL_STATE, local_state, component_states
             )
-        else:
-            Ref(GLOBAL_STATE.fields.update_db).set(False)
 
-            auth.user.set(
-                {
-                    "userinfo": {
-                        "cds/name": "Demo User",
-                        "cds/email": "cosmicds@cfa.harvard.edu",
-                        "cds/picture": "https://s.gravatar.com/avatar/d49c4a758d6e45538cd0fb4cd09e91eb?s=480&r=pg&d=https%3A%2F%2Fcdn.auth0.com%2Favatars%2Fco.png",
-                        "nickname": "cosmicds",
-                        "name": "Demo User",
-                        "picture": "https://s.gravatar.com/avatar/d49c4a758d6e45538cd0fb4cd09e91eb?s=480&r=pg&d=https%3A%2F%2Fcdn.auth0.com%2Favatars%2Fco.png",
-                        "updated_at": "2025-02-06T17:47:34.507Z",
-                        "email": "cosmicds@cfa.harvard.edu",
-                        "email_verified": True,
+        if not loaded:
+            _set_phase(None, started)
+            LOGIN_STATUS.set(
+                LOGIN_STATUS.value.model_copy(
+                    update={
+                        "state": "error",
+                        "error": "User is authenticated, but does not exist.",
                     }
-                }
+                )
             )
-        class_code.set("215")
-
-    if bool(auth.user.value):
-        logger.debug("User is authenticated.")
-        if BASE_API.user_exists:
-            BASE_API.load_user_info(story_name, GLOBAL_STATE)
-        elif bool(class_code.value):
-            BASE_API.create_new_user(story_name, class_code.value, GLOBAL_STATE)
-        else:
             logger.error("User is authenticated, but does not exist.")
             router.push(auth.get_logout_url())
-    elif not bool(auth.user.value):
+            return
+
+        if local_state is not None and GLOBAL_STATE.value.update_db:
+            started = _set_phase("prefetch", started)
+            BASE_API.prefetch_stage_states(local_state.value.story_id, stage_ids)
+
+        _set_phase(None, started)
+        timings = dict(
+            LOGIN_STATUS.value.timings, total=time.perf_counter() - login_started
+        )
+        LOGIN_STATUS.set(
+            LoginStatus(state="ready", user=BASE_API.hashed_user, timings=timings)
+        )
+        logger.info(
+            "Logged in in %.2fs (%s).",
+            timings["total"],
+            ", ".join(f"{phase}: {t:.2f}s" for phase, t in timings.items()),
+        )
+
+        # Last, as it re-runs this task, which is then a no-op
+        class_code.set(code)
+
+    login = solara.lab.use_task(
+        _login, dependencies=[authenticated, class_code.value], raise_error=False
+    )
+
+    def _on_error():
+        if login.error:
+            LOGIN_STATUS.set(
+                LOGIN_STATUS.value.model_copy(
+                    update={"state": "error", "error": str(login.exception)}
+                )
+            )
+
+    solara.use_effect(_on_error, dependencies=[login.error])
+
+    if not authenticated:
         logger.debug("User has not authenticated.")
+        if LOGIN_STATUS.value.state != "idle":
+            LOGIN_STATUS.set(LoginStatus())
+        BASE_API.forget_user(GLOBAL_STATE)
         BASE_API.clear_user(GLOBAL_STATE)
         origin_split = settings.main.base_url.split("//")
         root_url = "//".join(
@@ -142,60 +261,71 @@ def BaseSetup(
             ]
         )
         LocationHelper(url=root_url)
+    elif LOGIN_STATUS.value.state == "loading":
+        solara.ProgressLinear(True)
+    elif LOGIN_STATUS.value.state == "error":
+        solara.Error(f"Failed to load your data: {LOGIN_STATUS.value.error}")
+
+
+@solara.component
+@profile_render
+def PointsChip(local_state: Optional[Reactive[BaseLocalState]] = None):
+    with rv.Chip(class_="ma-2 piggy-chip"):
+        if local_state is not None:
+            piggybank_total = Ref(local_state.fields.piggybank_total)
+            solara.Text(f"{piggybank_total.value} Points")
+
+        rv.Icon(
+            class_="ml-2",
+            children=["mdi-piggy-bank"],
+            color="var(--success-dark)",
+        )
 
 
-def BaseLayout(
-    local_state: Optional[Reactive[BaseLocalState]] = None,
-    children: list = [],
-    story_name: str = "",
-    story_title: str = "Cosmic Data Story",
-):
-    debug_menu = solara.use_reactive(False)
+@solara.component
+@profile_render
+def SpeechMenu():
     speech_menu = solara.use_reactive(False)
-    stu_info_panel = solara.use_reactive([0])
-
     speech = Ref(GLOBAL_STATE.fields.speech)
 
-    router = solara.use_router()
-    route_current, routes_current_level = solara.use_route(peek=True)
-    route_index = routes_current_level.index(route_current)
-    location = solara.use_context(solara.routing._location_context)
-
-    selected_link = solara.use_reactive(route_index)
-
-    # Set up a watcher for vue break_point events
-    break_point = solara.use_reactive("")
-    BreakpointWatcher(
-        event_set_breakpoint_info=lambda event: break_point.set(event["breakpoint"])
-    )
-
-    def _change_local_url():
-        if selected_link.value is None:
-            return
-
-        path = routes_current_level[selected_link.value].path
-
-        if path != "/":
-            router.push(f"{router.root_path}/{path}")
-        else:
-            location.pathname = settings.main.base_url
-
-    solara.use_memo(_change_local_url, dependencies=[selected_link.value])
-
-    @solara.lab.computed
-    def display_info():
-        info = (auth.user.value or {}).get("userinfo")
-
-        if info is not None and "cds/name" in info and "cds/email" in info:
-            return {**info, "id": GLOBAL_STATE.value.student.id}
+    with TooltipMenu(
+        v_model=speech_menu.value,
+        icon="mdi-tune-vertical",
+        tooltip="Speech Settings",
+        bottom=True,
+        offset_y=True,
+        close_on_content_click=False,
+    ):
+        initial_settings = speech.value.model_dump()
+
+        def update_speech_property(prop, value):
+            settings = speech.value.model_copy()
+            setattr(settings, prop, value)
+            speech.set(settings)
+
+        SpeechSettings(
+            initial_state=initial_settings,
+            event_autoread_changed=lambda read: update_speech_property(
+                "autoread", read
+            ),
+            event_pitch_changed=lambda pitch: update_speech_property(
+                "pitch", pitch
+            ),
+            event_rate_changed=lambda rate: update_speech_property("rate", rate),
+            event_voice_changed=lambda voice: update_speech_property(
+                "voice", voice
+            ),
+        )
 
-        return {
-            "cds/name": "Undefined",
-            "cds/email": "ERROR: No user",
-            "id": "",
-        }
 
-    drawer = solara.use_reactive(None)
+@solara.component
+@profile_render
+def AppBar(
+    drawer: Reactive[Optional[bool]],
+    local_state: Optional[Reactive[BaseLocalState]] = None,
+):
+    educator = Ref(GLOBAL_STATE.fields.educator)
+    force_demo = Ref(GLOBAL_STATE.fields.force_demo)
 
     with rv.AppBar(
         elevate_on_scroll=False,
@@ -223,14 +353,14 @@ def BaseLayout(
 
         rv.Html(tag="h2", children=["Hubble's Law"], class_="pl-5")
 
-        if GLOBAL_STATE.value.educator:
+        if educator.value:
             rv.Html(
                 tag="h3",
                 class_="ml-8 app-title",
                 children=["Educator Mode"],
                 style_="color: #8e8e8e; font-size: 1.5em; font-weight: bold;",
             )
-        if GLOBAL_STATE.value.force_demo:
+        if force_demo.value:
             rv.Html(
                 tag="h3",
                 class_="ml-8 app-title",
@@ -239,34 +369,7 @@ def BaseLayout(
             )
         rv.Spacer()
 
-        with TooltipMenu(
-            v_model=speech_menu.value,
-            icon="mdi-tune-vertical",
-            tooltip="Speech Settings",
-            bottom=True,
-            offset_y=True,
-            close_on_content_click=False,
-        ):
-            initial_settings = GLOBAL_STATE.value.speech.model_dump()
-
-            def update_speech_property(prop, value):
-                settings = speech.value.model_copy()
-                setattr(settings, prop, value)
-                speech.set(settings)
-
-            SpeechSettings(
-                initial_state=initial_settings,
-                event_autoread_changed=lambda read: update_speech_property(
-                    "autoread", read
-                ),
-                event_pitch_changed=lambda pitch: update_speech_property(
-                    "pitch", pitch
-                ),
-                event_rate_changed=lambda rate: update_speech_property("rate", rate),
-                event_voice_changed=lambda voice: update_speech_property(
-                    "voice", voice
-                ),
-            )
+        SpeechMenu()
 
         ThemeToggle(
             on_icon="mdi-brightness-4",  # dark mode icon
@@ -278,18 +381,101 @@ def BaseLayout(
 
         rv.Divider(vertical=True, class_="mx-2")
 
-        with rv.Chip(class_="ma-2 piggy-chip"):
+        PointsChip(local_state)
 
-            if local_state is not None:
-                # TODO: Check that this doesn't make solara render the whole
-                #  app. if it does, move the chip into its own component.
-                solara.Text(f"{local_state.value.piggybank_total} Points")
 
-            rv.Icon(
-                class_="ml-2",
-                children=["mdi-piggy-bank"],
-                color="var(--success-dark)",
-            )
+@solara.component
+@profile_render
+def StudentInfoPanel():
+    stu_info_panel = solara.use_reactive([0])
+    student_id = Ref(GLOBAL_STATE.fields.student.id)
+
+    with rv.ExpansionPanels(
+        v_model=stu_info_panel.value,
+        on_v_model=stu_info_panel.set,
+        flat=True,
+        tile=True,
+        style_="padding-right: 1px;",
+    ):
+        with rv.ExpansionPanel(class_="pa-0 ma-0"):
+            with rv.ExpansionPanelHeader(class_="mx-2 my-0"):
+                with rv.Row(class_="flex align-center"):
+                    rv.Icon(children="mdi-account", class_="mr-4")
+                    rv.Html(tag="h4", children=f"Student ID: {student_id.value}")
+
+            with rv.ExpansionPanelContent():
+                rv.TextField(
+                    value=f"{BASE_API.hashed_user}",
+                    label="Anonymized ID",
+                    readonly=True,
+                    outlined=True,
+                    dense=True,
+                    hide_details=True,
+                )
+                # rv.Divider(),
+                # rv.Btn(
+                #     href=auth.get_logout_url(), icon=False,
+                #     block=True, outlined=True,
+                #     class_="mt-2",
+                #     # children=[rv.Icon(children=["mdi-logout"])]
+                #     children=["Logout"],
+                # ),
+
+
+@solara.component
+@profile_render
+def RouteList(
+    routes: list,
+    selected_link: Reactive[Optional[int]],
+    local_state: Optional[Reactive[BaseLocalState]] = None,
+):
+    max_route_index = None
+    if local_state is not None:
+        max_route_index = Ref(local_state.fields.max_route_index).value
+
+    with rv.List(
+        nav=True,
+    ):
+        with rv.ListItemGroup(
+            v_model=selected_link.value,
+            on_v_model=selected_link.set,
+        ):
+            for i, route in enumerate(routes):
+                disabled = max_route_index is not None and i > max_route_index
+
+                with rv.ListItem(disabled=disabled, inactive=disabled):
+                    with rv.ListItemIcon(class_="mr-4"):
+                        rv.Icon(children=f"mdi-numeric-{i}-circle")
+
+                    with rv.ListItemContent(
+                        style_=(
+                            "white-space: normal; overflow: visible; "
+                            "text-overflow: clip;"
+                        ),
+                        class_="px-0 mx-0",
+                    ):
+                        rv.ListItemTitle(
+                            children=(
+                                f"{route.label}"
+                                if route.path != "/"
+                                else "Introduction"
+                            )
+                        )
+
+
+@solara.component
+@profile_render
+def NavigationDrawer(
+    drawer: Reactive[Optional[bool]],
+    routes: list,
+    selected_link: Reactive[Optional[int]],
+    local_state: Optional[Reactive[BaseLocalState]] = None,
+):
+    # Set up a watcher for vue break_point events
+    break_point = solara.use_reactive("")
+    BreakpointWatcher(
+        event_set_breakpoint_info=lambda event: break_point.set(event["breakpoint"])
+    )
 
     with rv.NavigationDrawer(
         v_model=drawer.value,
@@ -300,63 +486,10 @@ def BaseLayout(
             {
                 "name": "append",
                 "variable": "btm",
-                "children": [
-                    rv.ExpansionPanels(
-                        v_model=stu_info_panel.value,
-                        on_v_model=stu_info_panel.set,
-                        flat=True,
-                        tile=True,
-                        style_="padding-right: 1px;",
-                        children=[
-                            rv.ExpansionPanel(
-                                class_="pa-0 ma-0",
-                                children=[
-                                    rv.ExpansionPanelHeader(
-                                        class_="mx-2 my-0",
-                                        children=[
-                                            rv.Row(
-                                                class_="flex align-center",
-                                                children=[
-                                                    rv.Icon(
-                                                        children="mdi-account",
-                                                        class_="mr-4",
-                                                    ),
-                                                    rv.Html(
-                                                        tag="h4",
-                                                        children=f"Student ID: {GLOBAL_STATE.value.student.id}",
-                                                    ),
-                                                ],
-                                            )
-                                        ],
-                                    ),
-                                    rv.ExpansionPanelContent(
-                                        children=[
-                                            rv.TextField(
-                                                value=f"{BASE_API.hashed_user}",
-                                                label="Anonymized ID",
-                                                readonly=True,
-                                                outlined=True,
-                                                dense=True,
-                                                hide_details=True,
-                                            ),
-                                            # rv.Divider(),
-                                            # rv.Btn(
-                                            #     href=auth.get_logout_url(), icon=False,
-                                            #     block=True, outlined=True,
-                                            #     class_="mt-2",
-                                            #     # children=[rv.Icon(children=["mdi-logout"])]
-                                            #     children=["Logout"],
-                                            # ),
-                                        ]
-                                    ),
-                                ],
-                            )
-                        ],
-                    )
-                ],
+                "children": [StudentInfoPanel()],
             }
         ],
-    ) as navigation_drawer:
+    ):
         if break_point.value in ["xs", "sm", "md"]:
             with rv.Row(class_="flex justify-end pa-2 ml-0"):
                 solara.IconButton(
@@ -366,33 +499,12 @@ def BaseLayout(
                     x_small=True,
                 )
 
-        with rv.List(
-            nav=True,
-        ):
-            with rv.ListItemGroup(
-                v_model=selected_link.value,
-                on_v_model=selected_link.set,
-            ):
-                for i, route in enumerate(routes_current_level):
-                    disabled = False
-                    if local_state is not None:
-                        disabled = (
-                            local_state.value.max_route_index is not None
-                            and i > local_state.value.max_route_index
-                        )
+        RouteList(routes, selected_link, local_state)
 
-                    with rv.ListItem(disabled=disabled, inactive=disabled) as list_item:
-                        with rv.ListItemIcon(class_="mr-4"):
-                            rv.Icon(children=f"mdi-numeric-{i}-circle")
-
-                        with rv.ListItemContent(
-                            style_="white-space: normal; overflow: visible; text-overflow: clip;",
-                            class_="px-0 mx-0",
-                        ):
-                            rv.ListItemTitle(
-                                children=f"{route.label if route.path != '/' else 'Introduction'}"
-                            )
 
+@solara.component
+@profile_render
+def MainContent(children: list = []):
     with rv.Content(class_="solara-content-main", style_="height: 100%"):
         with rv.Container(
             # children=children,
@@ -404,6 +516,10 @@ def BaseLayout(
                 children=children, style_="height: 100%; width: 100%", fluid=False
             )
 
+
+@solara.component
+@profile_render
+def Footer():
     with rv.Footer(
         class_="text-center align-items",
         padless=True,
@@ -439,3 +555,53 @@ def BaseLayout(
                         """,
                             style="font-size: 12px; line-height: 12px",
                         )
+
+
+def BaseLayout(
+    local_state: Optional[Reactive[BaseLocalState]] = None,
+    children: list = [],
+    story_name: str = "",
+    story_title: str = "Cosmic Data Story",
+):
+    """
+    The app bar, navigation drawer, content and footer of a story.
+
+    Each part is its own component, subscribed only to the state fields it
+    shows, so that e.g. earning points only re-renders the points chip
+    rather than the whole layout.
+    """
+    router = solara.use_router()
+    route_current, routes_current_level = solara.use_route(peek=True)
+    route_index = routes_current_level.index(route_current)
+    location = solara.use_context(solara.routing._location_context)
+
+    selected_link = solara.use_reactive(route_index)
+
+    def _change_local_url():
+        if selected_link.value is None:
+            return
+
+        path = routes_current_level[selected_link.value].path
+
+        if path != "/":
+            router.push(f"{router.root_path}/{path}")
+        else:
+            location.pathname = settings.main.base_url
+
+    solara.use_memo(_change_local_url, dependencies=[selected_link.value])
+
+    drawer = solara.use_reactive(None)
+
+    debug_mode = local_state is not None and Ref(local_state.fields.debug_mode).value
+    profiler = render_profiler()
+
+    def _profile_renders():
+        if debug_mode:
+            return profiler.enable()
+
+    solara.use_effect(_profile_renders, dependencies=[debug_mode])
+
+    AppBar(drawer, local_state)
+    NavigationDrawer(drawer, routes_current_level, selected_link, local_state)
+    MainContent(children)
+    Footer()
@@ -0,0 +1,296 @@
+import threading
+from typing import Hashable, Iterable, Optional
+from weakref import WeakKeyDictionary, ref
+
+import numpy as np
+from numpy.typing import ArrayLike
+
+from cosmicds.logger import setup_logger
+
+logger = setup_logger("LINE_FIT")
+
+__all__ = ["LineFit", "LineFitEngine", "fit_line", "fit_lines"]
+
+
+class _Parameter:
+    """A fitted parameter, read through ``value`` as with astropy models."""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value: float):
+        self.value = value
+
+    def __float__(self):
+        return float(self.value)
+
+    def __repr__(self):
+        return f"Parameter(value={self.value})"
+
+
+class LineFit:
+    """
+    A least-squares line, which can be called on ``x`` values like the
+    astropy ``Linear1D`` models it replaces, and whose parameters are read
+    with ``fit.slope.value`` and ``fit.intercept.value``.
+    """
+
+    def __init__(self, slope: float, intercept: float = 0.0, count: int = 0):
+        self.slope = _Parameter(slope)
+        self.intercept = _Parameter(intercept)
+        self.count = count
+
+    def __call__(self, x: ArrayLike) -> np.ndarray:
+        return self.slope.value * np.asarray(x, dtype=float) + self.intercept.value
+
+    def __repr__(self):
+        return (
+            f"LineFit(slope={self.slope.value}, intercept={self.intercept.value}, "
+            f"count={self.count})"
+        )
+
+
+def _sums(
+    x: np.ndarray, y: np.ndarray, groups: Optional[np.ndarray] = None, size: int = 1
+) -> np.ndarray:
+    # The running sums n, Σx, Σy, Σx² and Σxy of every group, ignoring the
+    # non-finite points
+    x = np.asarray(x, dtype=float).ravel()
+    y = np.asarray(y, dtype=float).ravel()
+    finite = np.isfinite(x) & np.isfinite(y)
+    x, y = x[finite], y[finite]
+    if groups is None:
+        return np.array([[len(x), x.sum(), y.sum(), x @ x, x @ y]])
+    groups = np.asarray(groups).ravel()[finite]
+    return np.stack(
+        [
+            np.bincount(groups, minlength=size).astype(float),
+            np.bincount(groups, weights=x, minlength=size),
+            np.bincount(groups, weights=y, minlength=size),
+            np.bincount(groups, weights=x * x, minlength=size),
+            np.bincount(groups, weights=x * y, minlength=size),
+        ],
+        axis=1,
+    )
+
+
+def _solve(sums: np.ndarray, through_origin: bool) -> tuple[np.ndarray, np.ndarray]:
+    # Closed-form least squares from the sums of each row
+    n, sx, sy, sxx, sxy = sums.T
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if through_origin:
+            slope = np.where(sxx > 0, sxy / sxx, np.nan)
+            return slope, np.zeros_like(slope)
+        det = n * sxx - sx * sx
+        slope = np.where(det > 0, (n * sxy - sx * sy) / det, np.nan)
+        intercept = np.where(n > 0, (sy - slope * sx) / n, np.nan)
+    return slope, intercept
+
+
+def _fit(sums: np.ndarray, through_origin: bool) -> LineFit:
+    slope, intercept = _solve(sums[None, :], through_origin)
+    return LineFit(float(slope[0]), float(intercept[0]), int(sums[0]))
+
+
+def fit_lines(
+    x: ArrayLike,
+    y: ArrayLike,
+    groups: ArrayLike,
+    through_origin: bool = True,
+) -> dict[Hashable, LineFit]:
+    """
+    Fits a line to the points of every group at once, e.g. to the
+    measurements of each student or class, and returns the fits by group.
+    Non-finite points are ignored.
+
+    Parameters
+    ----------
+    x, y : array-like
+        The coordinates of the points.
+    groups : array-like
+        The group of each point.
+    through_origin : bool, optional
+        Whether to fit lines through the origin (``y = slope * x``, as for
+        the Hubble constant) rather than with a free intercept.
+    """
+    labels, indices = np.unique(np.asarray(groups).ravel(), return_inverse=True)
+    sums = _sums(x, y, indices, len(labels))
+    slopes, intercepts = _solve(sums, through_origin)
+    return {
+        label: LineFit(float(slope), float(intercept), int(count))
+        for label, slope, intercept, count in zip(
+            labels.tolist(), slopes, intercepts, sums[:, 0]
+        )
+    }
+
+
+def fit_line(x: ArrayLike, y: ArrayLike, through_origin: bool = True) -> LineFit:
+    """
+    Fits a line through the origin (or with a free intercept) to the
+    finite points given by ``x`` and ``y``.
+    """
+    return _fit(_sums(x, y)[0], through_origin)
+
+
+class _Entry:
+    __slots__ = ("sums", "length", "x", "y", "subset_state")
+
+    def __init__(self, sums, length, x, y, subset_state):
+        self.sums = sums
+        self.length = length
+        # The arrays (and subset state) the sums were computed from
+        self.x = ref(x)
+        self.y = ref(y)
+        self.subset_state = subset_state
+
+
+class LineFitEngine:
+    """
+    Fits lines to glue layers (datasets or subsets) from running sums, which
+    are kept until the layer changes, and extended with just the new rows
+    when rows are appended with `cosmicds.rows.append_rows`.
+
+    A layer is known to be unchanged while its ``x`` and ``y`` components
+    hold the same (read-only) arrays and, for a subset, the same subset
+    state. A subset state can also change in place, so the
+    `~glue.core.message.SubsetUpdateMessage` of subsets must be passed to
+    `subset_updated`. Pass the `~cosmicds.messages.RowsAppendedMessage` of
+    appended rows to `rows_appended` to update the sums rather than refit.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: "WeakKeyDictionary[object, dict]" = WeakKeyDictionary()
+        self._stats = {"fits": 0, "cached": 0, "incremental": 0}
+
+    @staticmethod
+    def _array(data, att) -> Optional[np.ndarray]:
+        # Derived and coordinate components are computed on access, and so
+        # cannot be told to be unchanged
+        array = getattr(data.get_component(att), "_data", None)
+        return array if isinstance(array, np.ndarray) else None
+
+    def _arrays(self, layer, x_att, y_att):
+        data = getattr(layer, "data", layer)
+        return (
+            data,
+            self._array(data, x_att),
+            self._array(data, y_att),
+            getattr(layer, "subset_state", None),
+        )
+
+    def _compute(self, layers, x_att, y_att) -> list[np.ndarray]:
+        # The sums of several layers, in a single vectorised pass
+        xs, ys, groups = [], [], []
+        for index, layer in enumerate(layers):
+            x = np.asarray(layer[x_att], dtype=float)
+            y = np.asarray(layer[y_att], dtype=float)
+            xs.append(x.ravel())
+            ys.append(y.ravel())
+            groups.append(np.full(x.size, index))
+        if not layers:
+            return []
+        sums = _sums(
+            np.concatenate(xs), np.concatenate(ys), np.concatenate(groups), len(layers)
+        )
+        return list(sums)
+
+    def _cached(self, layer, x_att, y_att) -> Optional[np.ndarray]:
+        entry = self._entries.get(layer, {}).get((x_att, y_att))
+        if entry is None:
+            return None
+        _, x, y, subset_state = self._arrays(layer, x_att, y_att)
+        if (
+            x is not None
+            and entry.x() is x
+            and entry.y() is y
+            and entry.subset_state is subset_state
+        ):
+            return entry.sums
+        return None
+
+    def fit_many(
+        self, layers: Iterable, x_att, y_att, through_origin: bool = True
+    ) -> list[Optional[LineFit]]:
+        """
+        Fits a line to each layer, computing the sums of all the layers not
+        cached in one pass. A layer without finite points gets `None`.
+        """
+        layers = list(layers)
+        with self._lock:
+            sums = [self._cached(layer, x_att, y_att) for layer in layers]
+        missing = [layer for layer, s in zip(layers, sums) if s is None]
+        computed = iter(self._compute(missing, x_att, y_att))
+
+        with self._lock:
+            fits = []
+            for index, layer in enumerate(layers):
+                if sums[index] is None:
+                    sums[index] = next(computed)
+                    data, x, y, subset_state = self._arrays(layer, x_att, y_att)
+                    if x is not None and y is not None:
+                        self._entries.setdefault(layer, {})[(x_att, y_att)] = _Entry(
+                            sums[index], data.shape[0], x, y, subset_state
+                        )
+                    self._stats["fits"] += 1
+                else:
+                    self._stats["cached"] += 1
+                n = sums[index][0]
+                fits.append(_fit(sums[index], through_origin) if n else None)
+        return fits
+
+    def fit(
+        self, layer, x_att, y_att, through_origin: bool = True
+    ) -> Optional[LineFit]:
+        """Fits a line to a layer, or returns `None` if it has no finite points."""
+        return self.fit_many([layer], x_att, y_att, through_origin)[0]
+
+    def rows_appended(self, message):
+        """
+        Adds the rows appended to a dataset to the sums of its layers (and
+        forgets the sums of layers whose rows were updated in place).
+        """
+        data = message.data
+        new_rows = message.new_rows
+        with self._lock:
+            layers = [data, *data.subsets]
+            for layer in layers:
+                entries = self._entries.get(layer)
+                if not entries:
+                    continue
+                for key, entry in list(entries.items()):
+                    x_att, y_att = key
+                    _, x, y, subset_state = self._arrays(layer, x_att, y_att)
+                    if (
+                        x is None
+                        or y is None
+                        or len(message.updated)
+                        or entry.length != message.start
+                        or entry.subset_state is not subset_state
+                    ):
+                        del entries[key]
+                        logger.debug("Refitting `%s` after rows changed.", layer.label)
+                        continue
+                    x_new, y_new = x[new_rows], y[new_rows]
+                    if subset_state is not None:
+                        mask = subset_state.to_mask(data, view=new_rows)
+                        x_new, y_new = x_new[mask], y_new[mask]
+                    entry.sums = entry.sums + _sums(x_new, y_new)[0]
+                    entry.length = data.shape[0]
+                    entry.x, entry.y = ref(x), ref(y)
+                    self._stats["incremental"] += 1
+
+    def subset_updated(self, message):
+        """
+        Forgets the sums of a subset whose subset state changed, possibly in
+        place (and so without a new state to tell it by).
+        """
+        if message.attribute != "style":
+            self.forget(message.subset)
+
+    def forget(self, layer):
+        with self._lock:
+            self._entries.pop(layer, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,309 @@
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Callable, Iterable, Optional
+
+import numpy as np
+from glue.core import Data, Subset
+from glue.core.application_base import Application
+from glue.core.component import Component
+from glue.core.hub import HubListener
+from glue.core.message import (
+    DataAddComponentMessage,
+    DataCollectionAddMessage,
+    DataCollectionDeleteMessage,
+    NumericalDataChangedMessage,
+)
+
+from cosmicds.logger import setup_logger
+from cosmicds.rows import release_row_buffers
+from cosmicds.shared_data import SHARED_DATASETS
+
+logger = setup_logger("MEMORY")
+
+# Bytes of glue data each session may keep in memory before the least
+# recently used datasets are spilled to disk; 0 disables the budget
+SESSION_MEMORY_BUDGET = int(
+    float(os.getenv("CDS_SESSION_MEMORY_BUDGET_MB", 256)) * 1024**2
+)
+
+# Where spilled datasets are written, in one directory per session
+SPILL_DIR = os.getenv(
+    "CDS_SPILL_DIR", os.path.join(tempfile.gettempdir(), "cosmicds-spill")
+)
+
+
+def _is_mapped(values: np.ndarray) -> bool:
+    while isinstance(values, np.ndarray):
+        if isinstance(values, np.memmap):
+            return True
+        values = values.base
+    return False
+
+
+class _Entry:
+    def __init__(self, data: Data):
+        self.data = data
+        self.nbytes = 0
+        self.evicted = False
+        # The spilled arrays, and their files, by component
+        self.spilled: dict[Component, tuple[np.memmap, str]] = {}
+
+
+class SessionMemoryBudget(HubListener):
+    """
+    Keeps the array bytes held by the datasets of one glue session under a
+    budget.
+
+    Datasets are ordered by last use, which is their addition, a change of
+    their values or an explicit `access`. (Subset changes are not counted,
+    as subset groups span every dataset of the session.)
+    When the budget is exceeded, the least recently used datasets that are
+    not displayed in a viewer are evicted: their numerical components are
+    written to ``.npy`` files and replaced by read-only memory maps of
+    those files, so their pages are only read back when the values are
+    accessed, and can be dropped by the OS again afterwards. Using an
+    evicted dataset counts as a reload and makes it count against the
+    budget again.
+
+    Only the numerical arrays held by the session are counted; categorical
+    components, arrays mapped from other files and shared datasets (see
+    `cosmicds.shared_data`) are left alone.
+
+    Parameters
+    ----------
+    app : `~glue.core.application_base.Application`
+        The application of the session, whose viewers are never evicted.
+    budget : int
+        The number of bytes to keep in memory; 0 disables evictions.
+    directory : str
+        The directory under which the spilled arrays are written.
+    displayed : callable, optional
+        Returns additional datasets to keep in memory, e.g. those shown by
+        viewers created outside of ``app``.
+    """
+
+    def __init__(
+        self,
+        app: Application,
+        budget: int = SESSION_MEMORY_BUDGET,
+        directory: str = SPILL_DIR,
+        displayed: Optional[Callable[[], Iterable[Data]]] = None,
+    ):
+        self.app = app
+        self.budget = budget
+        self.directory = directory
+        self._displayed = displayed
+        self._session_directory: Optional[str] = None
+        self._lock = threading.RLock()
+        self._entries: OrderedDict[int, _Entry] = OrderedDict()
+        self._files = 0
+        self._stats = {"evictions": 0, "reloads": 0, "bytes_spilled": 0}
+
+        data_collection = app.data_collection
+        for data in data_collection:
+            self._track(data)
+
+        hub = app.session.hub
+        hub.subscribe(
+            self,
+            DataCollectionAddMessage,
+            handler=lambda message: self._track(message.data),
+            filter=lambda message: message.sender is data_collection,
+        )
+        hub.subscribe(
+            self,
+            DataCollectionDeleteMessage,
+            handler=lambda message: self._forget(message.data),
+            filter=lambda message: message.sender is data_collection,
+        )
+        hub.subscribe(
+            self,
+            NumericalDataChangedMessage,
+            handler=lambda message: self._changed(message.data),
+        )
+        hub.subscribe(
+            self,
+            DataAddComponentMessage,
+            handler=lambda message: self._changed(message.data),
+        )
+
+    @staticmethod
+    def _arrays(entry: _Entry) -> Iterable[tuple[Component, np.ndarray]]:
+        """The numerical arrays of a dataset held by this session."""
+        data = entry.data
+        for cid in data.main_components:
+            component = data.get_component(cid)
+            values = getattr(component, "_data", None)
+            if (
+                type(component) is not Component
+                or not isinstance(values, np.ndarray)
+                or values.dtype.kind not in "biufc"
+            ):
+                continue
+            spilled = entry.spilled.get(component)
+            if spilled is not None and spilled[0] is values:
+                yield component, values
+            elif not _is_mapped(values) and not SHARED_DATASETS.is_shared(component):
+                yield component, values
+
+    def _measure(self, entry: _Entry) -> int:
+        return sum(values.nbytes for _, values in self._arrays(entry))
+
+    def _track(self, data: Data):
+        with self._lock:
+            entry = self._entries.get(id(data))
+            if entry is None:
+                entry = self._entries[id(data)] = _Entry(data)
+            entry.nbytes = self._measure(entry)
+            self._entries.move_to_end(id(data))
+        self.enforce()
+
+    def _forget(self, data: Data):
+        with self._lock:
+            entry = self._entries.pop(id(data), None)
+        if entry is not None:
+            self._remove_files(entry, entry.spilled)
+
+    def _changed(self, data: Data):
+        with self._lock:
+            entry = self._entries.get(id(data))
+            if entry is None:
+                return
+            # Values replaced since the eviction are back in memory
+            replaced = {
+                component: spilled
+                for component, spilled in entry.spilled.items()
+                if component._data is not spilled[0]
+            }
+            for component in replaced:
+                del entry.spilled[component]
+        self._remove_files(entry, replaced)
+        self.access(data)
+        self._track(data)
+
+    def access(self, data: Data):
+        """
+        Marks ``data`` as just used, reloading it if it was evicted. Call
+        this before using the values of a dataset outside of glue.
+        """
+        with self._lock:
+            entry = self._entries.get(id(data))
+            if entry is None:
+                return
+            self._entries.move_to_end(id(data))
+            if entry.evicted:
+                entry.evicted = False
+                self._stats["reloads"] += 1
+                logger.debug("Reloaded `%s`.", data.label)
+        self.enforce()
+
+    def displayed(self) -> set[int]:
+        """The IDs of the datasets shown by a viewer."""
+        datasets = []
+        for viewer in getattr(self.app, "viewers", ()):
+            for artist in getattr(viewer, "layers", ()):
+                layer = artist.layer
+                datasets.append(layer.data if isinstance(layer, Subset) else layer)
+        if self._displayed is not None:
+            datasets.extend(self._displayed())
+        return set(map(id, datasets))
+
+    @property
+    def resident_bytes(self) -> int:
+        with self._lock:
+            return sum(e.nbytes for e in self._entries.values() if not e.evicted)
+
+    def enforce(self):
+        """
+        Evicts the least recently used datasets that are not displayed
+        until the resident bytes are within the budget.
+        """
+        if self.budget <= 0:
+            return
+
+        with self._lock:
+            resident = self.resident_bytes
+            if resident <= self.budget:
+                return
+
+            displayed = self.displayed()
+            for key, entry in list(self._entries.items()):
+                if resident <= self.budget:
+                    break
+                if entry.evicted or entry.nbytes == 0 or key in displayed:
+                    continue
+                try:
+                    self._evict(entry)
+                except OSError:
+                    logger.exception("Failed to spill `%s` to disk.", entry.data.label)
+                    return
+                resident -= entry.nbytes
+
+    def _evict(self, entry: _Entry):
+        data = entry.data
+        directory = self._get_session_directory()
+        # The spare capacity for appended rows would keep the values alive
+        release_row_buffers(data)
+        for component, values in self._arrays(entry):
+            spilled = entry.spilled.get(component)
+            if spilled is not None and spilled[0] is values:
+                path = spilled[1]
+            else:
+                self._files += 1
+                path = os.path.join(directory, f"{self._files}.npy")
+                np.save(path, values)
+                self._stats["bytes_spilled"] += values.nbytes
+
+            # Mapping the file anew drops the pages read since the last
+            # eviction. Glue keeps component values read-only anyway.
+            mapped = np.load(path, mmap_mode="r")
+            component._data = mapped
+            entry.spilled[component] = (mapped, path)
+
+        entry.evicted = True
+        self._stats["evictions"] += 1
+        logger.debug("Evicted `%s` (%d bytes).", data.label, entry.nbytes)
+
+    def _get_session_directory(self) -> str:
+        if self._session_directory is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._session_directory = tempfile.mkdtemp(
+                prefix="session-", dir=self.directory
+            )
+        return self._session_directory
+
+    @staticmethod
+    def _remove_files(entry: _Entry, spilled: dict):
+        for _, path in spilled.values():
+            try:
+                os.remove(path)
+            except OSError:
+                # Still mapped on some platforms; removed with the directory
+                pass
+
+    def close(self):
+        """
+        Stops tracking the session and deletes its spilled files. Evicted
+        datasets still in use keep their mapped values.
+        """
+        self.app.session.hub.unsubscribe_all(self)
+        with self._lock:
+            self._entries.clear()
+            directory, self._session_directory = self._session_directory, None
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = list(self._entries.values())
+            return dict(
+                self._stats,
+                budget=self.budget,
+                datasets=len(entries),
+                evicted=sum(e.evicted for e in entries),
+                resident_bytes=sum(e.nbytes for e in entries if not e.evicted),
+                evicted_bytes=sum(e.nbytes for e in entries if e.evicted),
+            )
@@ -1,4 +1,5 @@
-from glue.core.message import Message
+import numpy as np
+from glue.core.message import Message, NumericalDataChangedMessage
 
 
 class WriteToDatabaseMessage(Message):
@@ -47,3 +48,36 @@ class NewViewerMessage(Message):
     @property
     def data(self):
         return self._data
+
+
+class RowsAppendedMessage(NumericalDataChangedMessage):
+    """
+    Sent when rows are appended to or updated in a dataset with
+    `cosmicds.rows.append_rows`. Consumers that only subscribe to
+    `~glue.core.message.NumericalDataChangedMessage` still see it as a full
+    change; others can update incrementally from the new rows
+    (``data[cid][message.new_rows]``) and the updated ones.
+    """
+
+    def __init__(self, sender, start, count, updated=None, *args, **kwargs):
+        super().__init__(sender, *args, **kwargs)
+
+        self._start = start
+        self._count = count
+        self._updated = updated if updated is not None else np.empty(0, dtype=int)
+
+    @property
+    def start(self):
+        return self._start
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def new_rows(self):
+        return slice(self._start, self._start + self._count)
+
+    @property
+    def updated(self):
+        return self._updated
@@ -0,0 +1,356 @@
+import json
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import urlsplit
+
+from requests import adapters
+
+from cosmicds.logger import setup_logger
+
+logger = setup_logger("METRICS")
+
+# Upper bounds (in seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Port on which to serve the metrics locally; not served if unset
+METRICS_PORT = os.getenv("CDS_METRICS_PORT")
+
+# Known CosmicDS API routes, so that requests are grouped by endpoint rather
+# than by student, story or stage
+ENDPOINT_TEMPLATES = [
+    (re.compile(pattern), template)
+    for pattern, template in (
+        (r"/student/[^/]+", "/student/{user}"),
+        (r"/educators/[^/]+", "/educators/{user}"),
+        (r"/students/create", "/students/create"),
+        (
+            r"/class-for-student-story/[^/]+/[^/]+",
+            "/class-for-student-story/{student}/{story}",
+        ),
+        (r"/classes/size/[^/]+", "/classes/size/{class}"),
+        (r"/story-state/[^/]+/[^/]+", "/story-state/{student}/{story}"),
+        (r"/stage-state/[^/]+/[^/]+/[^/]+", "/stage-state/{student}/{story}/{stage}"),
+    )
+]
+
+_ID_SEGMENT = re.compile(r"(?<=/)(\d+|[0-9a-f]{32,})(?=/|$)")
+
+
+def template_path(url: str) -> str:
+    """
+    Returns the templated path of a request URL, e.g.
+    ``/stage-state/{student}/{story}/{stage}``. Unknown routes have numeric
+    and hash-like segments replaced by ``{id}``.
+    """
+    path = urlsplit(url).path.rstrip("/") or "/"
+    for pattern, template in ENDPOINT_TEMPLATES:
+        if pattern.fullmatch(path):
+            return template
+    return _ID_SEGMENT.sub("{id}", path)
+
+
+class _Histogram:
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        Estimates a quantile as the upper bound of its bucket, or the
+        slowest request if it is beyond the last bucket.
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return self.max
+
+
+class _Observation:
+    """A request in flight, as returned by `EndpointMetrics.track`."""
+
+    def __init__(self, metrics: "EndpointMetrics", method: str, url: str):
+        self.metrics = metrics
+        self.method = method.upper()
+        self.path = template_path(url)
+        self.status = "error"
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def finish(self, status: int, bytes_in: int = 0, bytes_out: int = 0):
+        self.status = str(status)
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.metrics._started(self.method, self.path)
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics._finished(self, time.perf_counter() - self.start)
+        return False
+
+
+class EndpointMetrics:
+    """
+    Thread-safe per-endpoint request metrics: request counts by status, a
+    latency histogram, bytes received and sent, and the number of requests
+    in flight. Endpoints are keyed by method and templated path (see
+    `template_path`).
+
+    Requests are recorded with
+
+    .. code-block:: python
+
+        with API_METRICS.track("GET", url) as request:
+            response = ...
+            request.finish(response.status_code, bytes_in, bytes_out)
+
+    A request that raises before `finish` is called is counted with the
+    status ``error``.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self._in_flight = {}
+
+    def track(self, method: str, url: str) -> _Observation:
+        return _Observation(self, method, url)
+
+    def _started(self, method, path):
+        with self._lock:
+            key = (method, path)
+            self._in_flight[key] = self._in_flight.get(key, 0) + 1
+
+    def _finished(self, observation: _Observation, latency: float):
+        key = (observation.method, observation.path)
+        with self._lock:
+            self._in_flight[key] -= 1
+            endpoint = self._endpoints.get(key)
+            if endpoint is None:
+                endpoint = self._endpoints[key] = {
+                    "statuses": {},
+                    "latency": _Histogram(),
+                    "bytes_in": 0,
+                    "bytes_out": 0,
+                }
+            statuses = endpoint["statuses"]
+            statuses[observation.status] = statuses.get(observation.status, 0) + 1
+            endpoint["latency"].observe(latency)
+            endpoint["bytes_in"] += observation.bytes_in
+            endpoint["bytes_out"] += observation.bytes_out
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+            self._in_flight = {k: v for k, v in self._in_flight.items() if v}
+
+    def snapshot(self) -> dict:
+        """
+        Returns the metrics of every endpoint as a JSON-compatible dict
+        keyed by ``"<METHOD> <templated path>"``.
+        """
+        with self._lock:
+            keys = set(self._endpoints) | set(self._in_flight)
+            snapshot = {}
+            for method, path in sorted(keys):
+                endpoint = self._endpoints.get((method, path))
+                histogram = endpoint["latency"] if endpoint else _Histogram()
+                snapshot[f"{method} {path}"] = {
+                    "method": method,
+                    "path": path,
+                    "requests": histogram.count,
+                    "statuses": dict(endpoint["statuses"]) if endpoint else {},
+                    "in_flight": self._in_flight.get((method, path), 0),
+                    "bytes_in": endpoint["bytes_in"] if endpoint else 0,
+                    "bytes_out": endpoint["bytes_out"] if endpoint else 0,
+                    "latency": {
+                        "sum": histogram.sum,
+                        "mean": (
+                            histogram.sum / histogram.count if histogram.count else None
+                        ),
+                        "max": histogram.max,
+                        "p50": histogram.quantile(0.5),
+                        "p95": histogram.quantile(0.95),
+                        "p99": histogram.quantile(0.99),
+                        "buckets": dict(
+                            zip([*map(str, LATENCY_BUCKETS), "+Inf"], histogram.counts)
+                        ),
+                    },
+                }
+            return snapshot
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self) -> str:
+        """Returns the metrics in the Prometheus text exposition format."""
+        lines = [
+            "# HELP cosmicds_api_requests_total CosmicDS API requests by status.",
+            "# TYPE cosmicds_api_requests_total counter",
+        ]
+        snapshot = self.snapshot()
+
+        def labels(entry, **extra):
+            pairs = {"method": entry["method"], "path": entry["path"], **extra}
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs.items()) + "}"
+
+        for entry in snapshot.values():
+            for status, count in sorted(entry["statuses"].items()):
+                lines.append(
+                    f"cosmicds_api_requests_total{labels(entry, status=status)} {count}"
+                )
+
+        lines += [
+            "# HELP cosmicds_api_request_duration_seconds "
+            "CosmicDS API request latency.",
+            "# TYPE cosmicds_api_request_duration_seconds histogram",
+        ]
+        for entry in snapshot.values():
+            cumulative = 0
+            for bound, count in entry["latency"]["buckets"].items():
+                cumulative += count
+                lines.append(
+                    "cosmicds_api_request_duration_seconds_bucket"
+                    f"{labels(entry, le=bound)} {cumulative}"
+                )
+            lines.append(
+                f"cosmicds_api_request_duration_seconds_sum{labels(entry)} "
+                f"{entry['latency']['sum']}"
+            )
+            lines.append(
+                f"cosmicds_api_request_duration_seconds_count{labels(entry)} "
+                f"{entry['requests']}"
+            )
+
+        for name, key, kind, help in (
+            (
+                "cosmicds_api_received_bytes_total",
+                "bytes_in",
+                "counter",
+                "Response bytes.",
+            ),
+            ("cosmicds_api_sent_bytes_total", "bytes_out", "counter", "Request bytes."),
+            ("cosmicds_api_requests_in_flight", "in_flight", "gauge", "Open requests."),
+        ):
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+            lines.extend(
+                f"{name}{labels(entry)} {entry[key]}" for entry in snapshot.values()
+            )
+
+        return "\n".join(lines) + "\n"
+
+
+API_METRICS = EndpointMetrics()
+
+
+def _request_size(body) -> int:
+    if body is None:
+        return 0
+    if isinstance(body, str):
+        return len(body.encode())
+    try:
+        return len(body)
+    except TypeError:
+        # Streamed or generator bodies are not counted
+        return 0
+
+
+class MetricsAdapter(adapters.HTTPAdapter):
+    """
+    A `requests` transport adapter recording every request in
+    `API_METRICS`. Latency is measured until the response headers arrive;
+    the response size is taken from its ``Content-Length``.
+    """
+
+    def __init__(self, *args, metrics: Optional[EndpointMetrics] = None, **kwargs):
+        self.metrics = metrics if metrics is not None else API_METRICS
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, *args, **kwargs):
+        with self.metrics.track(request.method, request.url) as observation:
+            response = super().send(request, *args, **kwargs)
+            observation.finish(
+                response.status_code,
+                int(response.headers.get("Content-Length") or 0),
+                _request_size(request.body),
+            )
+        return response
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") == "/metrics":
+            body = API_METRICS.to_prometheus()
+            content_type = "text/plain; version=0.0.4"
+        elif self.path.rstrip("/") == "/metrics.json":
+            body, content_type = API_METRICS.to_json(), "application/json"
+        elif self.path.rstrip("/") == "/scheduler.json":
+            from cosmicds.scheduler import SCHEDULER
+
+            body, content_type = json.dumps(SCHEDULER.stats()), "application/json"
+        else:
+            self.send_error(404)
+            return
+
+        data = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+_server: Optional[ThreadingHTTPServer] = None
+
+
+def serve_metrics(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """
+    Serves `API_METRICS` on a background thread, in the Prometheus text
+    format at ``/metrics`` and as JSON at ``/metrics.json``, along with the
+    job lag of `cosmicds.scheduler.SCHEDULER` at ``/scheduler.json``. Only
+    one server is started per process.
+    """
+    global _server
+
+    if _server is None:
+        _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        _server.daemon_threads = True
+        threading.Thread(
+            target=_server.serve_forever, name="cosmicds-metrics", daemon=True
+        ).start()
+        logger.info("Serving API metrics on http://%s:%s/metrics", host, port)
+
+    return _server
+
+
+if METRICS_PORT:
+    try:
+        serve_metrics(int(METRICS_PORT))
+    except OSError as e:
+        # Another worker process on this host is already serving
+        logger.warning("Could not serve API metrics on port %s: %s", METRICS_PORT, e)
@@ -0,0 +1,201 @@
+import functools
+import threading
+import time
+from collections import Counter, deque
+from typing import Callable, TypeVar
+
+import solara
+from solara.server import kernel_context
+from solara.toestand import ReactiveField, thread_local
+from solara.util import equals_extra
+
+from cosmicds.logger import setup_logger
+
+logger = setup_logger("PROFILING")
+
+# Number of recent render times kept per component for the percentiles
+RENDER_SAMPLES = 1000
+
+# Attributed to renders that no reactive variable read by the component
+# triggered, e.g. its first render, new arguments or its own hooks
+OTHER_TRIGGER = "(mount, arguments or hooks)"
+
+F = TypeVar("F", bound=Callable)
+
+
+def reactive_label(reactive) -> str:
+    """
+    Returns a readable name for a reactive variable, e.g.
+    ``GlobalState.student.id`` for a `~solara.toestand.Ref` to a field.
+    """
+    if isinstance(reactive, ReactiveField):
+        return reactive_label(reactive._root) + str(reactive._field)
+    key = getattr(getattr(reactive, "_storage", reactive), "storage_key", None)
+    if key is None:
+        return type(reactive).__name__
+    _, name, index = key.split(":")
+    return name if index == "0" else f"{name}#{index}"
+
+
+class _ComponentStats:
+    __slots__ = ("renders", "total", "max", "samples", "triggers")
+
+    def __init__(self):
+        self.renders = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=RENDER_SAMPLES)
+        self.triggers = Counter()
+
+
+class RenderProfiler:
+    """
+    Thread-safe render statistics of the components decorated with
+    `profile_render`: render counts, cumulative, 95th percentile and
+    maximum render times, and the reactive variables that triggered the
+    renders.
+
+    A render is attributed to the reactive variables, among those the
+    component read during its previous render, whose values changed since.
+    Render times only count the body of the component, not its children,
+    which reacton renders separately.
+
+    Every session has its own profiler (see `render_profiler`), so that
+    debug mode in one session does not profile the renders of the others.
+    Nothing is recorded unless it is enabled, which `BaseLayout` does while
+    the story is in debug mode. Enabling is counted, so that the profiler
+    stays on while any layout of the session is in debug mode.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._enabled = 0
+        self._components: dict[str, _ComponentStats] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self._enabled > 0
+
+    def enable(self) -> Callable[[], None]:
+        """Turns profiling on, and returns a function turning it back off."""
+        with self._lock:
+            self._enabled += 1
+        logger.debug("Render profiling enabled.")
+        return self.disable
+
+    def disable(self):
+        with self._lock:
+            self._enabled = max(self._enabled - 1, 0)
+
+    def record(self, name: str, seconds: float, triggers: list[str]):
+        with self._lock:
+            stats = self._components.get(name)
+            if stats is None:
+                stats = self._components[name] = _ComponentStats()
+            stats.renders += 1
+            stats.total += seconds
+            stats.max = max(stats.max, seconds)
+            stats.samples.append(seconds)
+            stats.triggers.update(triggers or [OTHER_TRIGGER])
+
+    def reset(self):
+        with self._lock:
+            self._components.clear()
+
+    def snapshot(self) -> dict:
+        """
+        Returns the statistics of every profiled component, slowest first,
+        as a JSON-compatible dict keyed by component name. Times are in
+        milliseconds.
+        """
+        with self._lock:
+            snapshot = {}
+            for name, stats in self._components.items():
+                samples = sorted(stats.samples)
+                p95 = samples[min(int(0.95 * len(samples)), len(samples) - 1)]
+                snapshot[name] = {
+                    "renders": stats.renders,
+                    "total_ms": 1000 * stats.total,
+                    "mean_ms": 1000 * stats.total / stats.renders,
+                    "p95_ms": 1000 * p95,
+                    "max_ms": 1000 * stats.max,
+                    "triggers": dict(stats.triggers.most_common()),
+                }
+        return dict(
+            sorted(snapshot.items(), key=lambda item: -item[1]["total_ms"])
+        )
+
+
+# Used outside of a solara session, e.g. when rendering in tests
+_DEFAULT_PROFILER = RenderProfiler()
+_profilers: dict[str, RenderProfiler] = {}
+_profilers_lock = threading.Lock()
+
+
+def render_profiler() -> RenderProfiler:
+    """
+    Returns the `RenderProfiler` of the current solara session, which is
+    dropped when the session closes.
+    """
+    if not kernel_context.has_current_context():
+        return _DEFAULT_PROFILER
+    context = kernel_context.get_current_context()
+    with _profilers_lock:
+        profiler = _profilers.get(context.id)
+        if profiler is not None:
+            return profiler
+        profiler = _profilers[context.id] = RenderProfiler()
+
+    def _forget():
+        with _profilers_lock:
+            _profilers.pop(context.id, None)
+
+    context.on_close(_forget)
+    return profiler
+
+
+def _changed(reads: dict) -> list[str]:
+    triggers = []
+    for reactive, value in reads.items():
+        try:
+            current = reactive.peek()
+            if not equals_extra(current, value):
+                triggers.append(reactive_label(reactive))
+        except Exception:
+            # e.g. a field of a model that no longer has it
+            triggers.append(reactive_label(reactive))
+    return triggers
+
+
+def profile_render(f: F) -> F:
+    """
+    Records the renders of a component with the `render_profiler` of its
+    session. Apply it under ``@solara.component`` only, so that it runs in
+    the render of the component: it uses a hook, and attributes to the
+    component every reactive variable read while rendering it.
+    """
+    name = f.__name__
+
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        # Always used, so that the hooks do not change when profiling does
+        previous_reads = solara.use_ref({})
+        profiler = render_profiler()
+        if not profiler.enabled:
+            return f(*args, **kwargs)
+
+        triggers = _changed(previous_reads.current)
+        start = time.perf_counter()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            profiler.record(name, time.perf_counter() - start, triggers)
+            reads = {}
+            for reactive in thread_local.reactive_used or ():
+                try:
+                    reads[reactive] = reactive.peek()
+                except Exception:
+                    pass
+            previous_reads.current = reads
+
+    return wrapper
@@ -1,31 +1,640 @@
 from solara_enterprise import auth
+import asyncio
+import atexit
 import hashlib
+import httpx
+import json
 import os
-from requests import Session
-from functools import cached_property
+import threading
+import random
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from pydantic import BaseModel
+from functools import cached_property, lru_cache
+from typing import Any, Callable, Coroutine, Iterable, Optional
 
 from .state import GLOBAL_STATE, BaseLocalState, BaseState, GlobalState, Student
+import solara
 from solara import Reactive
-from solara.lab import Ref
+from solara.server import kernel_context
+from solara.lab import Ref, Task
+from cosmicds.event_loop import run_coroutine, run_on_loop, run_sync
+from cosmicds.http_cache import API_VALIDATOR_CACHE
 from cosmicds.logger import setup_logger
+from cosmicds.metrics import API_METRICS, MetricsAdapter
+from cosmicds.resilience import (
+    API_BREAKER,
+    CONNECT_TIMEOUT,
+    READ_TIMEOUT,
+    ResilientSession,
+    resilient_request,
+)
+from cosmicds.schema import load_state, stamp_schema
+from cosmicds.storage import PatchRejectedError, StorageBackend, create_backend
 
 logger = setup_logger("API")
 
+# Seconds for which identity lookups (student/educator records) are reused
+IDENTITY_CACHE_TTL = float(os.getenv("CDS_IDENTITY_CACHE_TTL", 300))
+
+# Seconds for which a user being unknown is remembered, kept short as the
+# student may be created meanwhile (e.g. through another worker)
+IDENTITY_CACHE_NEGATIVE_TTL = float(os.getenv("CDS_IDENTITY_CACHE_NEGATIVE_TTL", 10))
+
+# Number of users whose lookups are kept, least recently used first out
+IDENTITY_CACHE_SIZE = int(os.getenv("CDS_IDENTITY_CACHE_SIZE", 10000))
+
+_MISSING = object()
+
+
+@lru_cache(maxsize=1024)
+def _hash_user_ref(user_ref: str, secret: str) -> str:
+    return hashlib.sha1((user_ref + secret).encode()).hexdigest()
+
+
+class IdentityCache:
+    """
+    Per-user cache of identity lookups (e.g. the ``student`` and ``educator``
+    records) that expire after ``ttl`` seconds, or ``negative_ttl`` seconds
+    for lookups that found nothing. At most ``max_users`` users are kept,
+    evicting the least recently used. Hits and misses are counted so that
+    the effect of the cache can be inspected with `stats`.
+    """
+
+    def __init__(
+        self,
+        ttl: float = IDENTITY_CACHE_TTL,
+        negative_ttl: float = IDENTITY_CACHE_NEGATIVE_TTL,
+        max_users: int = IDENTITY_CACHE_SIZE,
+    ):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_users = max_users
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # The expiry time and value of each lookup, by user
+        self._entries: OrderedDict[str, dict[str, tuple[float, Any]]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user: str, key: str) -> Any:
+        """Returns the cached value, or ``_MISSING`` if absent or expired."""
+        with self._lock:
+            entries = self._entries.get(user)
+            expires, value = (entries or {}).get(key, (0, _MISSING))
+            if value is _MISSING or time.monotonic() > expires:
+                if value is not _MISSING:
+                    del entries[key]
+                    if not entries:
+                        del self._entries[user]
+                self.misses += 1
+                return _MISSING
+            self._entries.move_to_end(user)
+            self.hits += 1
+            return value
+
+    def set(self, user: str, key: str, value: Any):
+        ttl = self.ttl if value is not None else self.negative_ttl
+        with self._lock:
+            entries = self._entries.get(user)
+            if entries is None:
+                entries = self._entries[user] = {}
+            self._entries.move_to_end(user)
+            entries[key] = (time.monotonic() + ttl, value)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_fetch(self, user: str, key: str, fetch: Callable[[], Any]) -> Any:
+        value = self.get(user, key)
+        if value is _MISSING:
+            value = fetch()
+            self.set(user, key, value)
+        return value
+
+    def invalidate(self, user: Optional[str] = None):
+        """Drops the entries of ``user``, or of every user if not given."""
+        with self._lock:
+            if user is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user, None)
+
+    def invalidate_student(self, student_id: int):
+        """Drops the entries of whichever user owns the given student id."""
+        with self._lock:
+            for user, entries in list(self._entries.items()):
+                student = entries.get("student", (0, None))[1]
+                if student is not None and student.get("id") == student_id:
+                    del self._entries[user]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "users": len(self._entries),
+            }
+
+
+class BootstrapData(BaseModel):
+    """
+    Everything needed before the first paint of a story for a logged in
+    student, as gathered by `AsyncBaseAPI.fetch_bootstrap`.
+    """
+
+    student: dict | None = None
+    educator: bool = False
+    class_info: dict | None = None
+    class_size: int = 0
+    # Whether story and stage states were requested from the database
+    from_database: bool = False
+    story_state: dict | None = None
+    stage_states: dict[str, dict | None] = {}
+
+
+# Write-behind queue settings, see `StateWriteQueue`
+WRITE_QUEUE_INTERVAL = float(os.getenv("CDS_WRITE_QUEUE_INTERVAL", 5))
+WRITE_QUEUE_MAX_PENDING = int(os.getenv("CDS_WRITE_QUEUE_MAX_PENDING", 1000))
+WRITE_QUEUE_BATCH_SIZE = int(os.getenv("CDS_WRITE_QUEUE_BATCH_SIZE", 50))
+WRITE_QUEUE_RETRIES = int(os.getenv("CDS_WRITE_QUEUE_RETRIES", 3))
+# Seconds `StateWriteQueue.submit` waits for room before dropping a snapshot,
+# as it is called while rendering
+WRITE_QUEUE_SUBMIT_TIMEOUT = float(os.getenv("CDS_WRITE_QUEUE_SUBMIT_TIMEOUT", 1))
+
+# (student id, story id, stage id or `None` for the story state itself)
+StateKey = tuple[int, str, Optional[str]]
+
+# Number of story and stage states kept per process in each of
+# `BaseAPI.acknowledged_states` and `BaseAPI.stage_state_cache`, on top of
+# a student's states being dropped once none of their sessions is open
+STATE_CACHE_SIZE = int(os.getenv("CDS_STATE_CACHE_SIZE", 20000))
+
+
+class StateCache(OrderedDict):
+    """
+    A dict of states by `StateKey` keeping at most ``size`` of them, the
+    least recently stored going first.
+    """
+
+    def __init__(self, size: int = STATE_CACHE_SIZE):
+        super().__init__()
+        self.size = size
+        self._lock = threading.Lock()
+
+    def __setitem__(self, key: StateKey, value: Any):
+        with self._lock:
+            super().__setitem__(key, value)
+            self.move_to_end(key)
+            while len(self) > self.size:
+                self.popitem(last=False)
+
+    def forget_student(self, student_id: int):
+        """Drops the states of a student."""
+        with self._lock:
+            for key in [key for key in self if key[0] == student_id]:
+                self.pop(key, None)
+
+
+def make_json_patch(old: Any, new: Any, path: str = "") -> list[dict]:
+    """
+    Returns the JSON patch (RFC 6902) operations turning ``old`` into ``new``.
+    Objects and equally long arrays are diffed recursively, anything else
+    that changed is replaced as a whole.
+    """
+    if old == new:
+        return []
+
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = []
+        for key in old.keys() - new.keys():
+            ops.append({"op": "remove", "path": f"{path}/{_escape_pointer(key)}"})
+        for key, value in new.items():
+            key_path = f"{path}/{_escape_pointer(key)}"
+            if key not in old:
+                ops.append({"op": "add", "path": key_path, "value": value})
+            else:
+                ops.extend(make_json_patch(old[key], value, key_path))
+        return ops
+
+    if isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        ops = []
+        for index, (old_item, new_item) in enumerate(zip(old, new)):
+            ops.extend(make_json_patch(old_item, new_item, f"{path}/{index}"))
+        return ops
+
+    return [{"op": "replace", "path": path, "value": new}]
+
+
+def _escape_pointer(key: Any) -> str:
+    return str(key).replace("~", "~0").replace("/", "~1")
+
+
+class StateWriteQueue:
+    """
+    Write-behind queue for story and stage state snapshots.
+
+    Only the latest snapshot per key is kept, so any number of changes to
+    the same state between two flushes result in a single write. A single
+    background worker flushes the pending snapshots every ``interval``
+    seconds (or on demand through `flush`, and at interpreter shutdown), in
+    batches of up to ``batch_size``, retrying failed writes with jittered
+    exponential backoff. When ``max_pending`` keys are waiting (e.g. failed
+    writes being retried while the API is down), `submit` waits up to
+    ``submit_timeout`` seconds for the worker to make room, then drops the
+    snapshot.
+
+    Parameters
+    ----------
+    writer : callable
+        Receives a list of ``(key, snapshot)`` pairs and returns the set of
+        keys that were written successfully.
+    """
+
+    def __init__(
+        self,
+        writer: Callable[[list[tuple[StateKey, dict]]], set[StateKey]],
+        interval: float = WRITE_QUEUE_INTERVAL,
+        max_pending: int = WRITE_QUEUE_MAX_PENDING,
+        batch_size: int = WRITE_QUEUE_BATCH_SIZE,
+        max_retries: int = WRITE_QUEUE_RETRIES,
+        retry_backoff: float = 0.5,
+        submit_timeout: Optional[float] = WRITE_QUEUE_SUBMIT_TIMEOUT,
+    ):
+        self.writer = writer
+        self.interval = interval
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.submit_timeout = submit_timeout
+
+        self._pending: OrderedDict[StateKey, dict] = OrderedDict()
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self._atexit_registered = False
+        self._flush_requested = 0
+        self._flushes_done = 0
+
+        self.submitted = 0
+        self.coalesced = 0
+        self.written = 0
+        self.retried = 0
+        self.failed = 0
+        self.dropped = 0
+        self.flush_count = 0
+        self.last_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+        self.max_depth = 0
+
+    def submit(self, key: StateKey, snapshot: dict, timeout: Any = _MISSING) -> bool:
+        """
+        Queues ``snapshot`` as the latest state for ``key``. Returns `False`
+        if the queue stayed full for ``timeout`` seconds, which defaults to
+        ``submit_timeout`` (`None` waits for as long as it takes).
+        """
+        if timeout is _MISSING:
+            timeout = self.submit_timeout
+        with self._condition:
+            self._ensure_worker()
+            self.submitted += 1
+
+            if key in self._pending:
+                self._pending[key] = snapshot
+                self.coalesced += 1
+                return True
+
+            if len(self._pending) >= self.max_pending:
+                # Backpressure: wake up the worker and wait for room
+                self._flush_requested += 1
+                self._condition.notify_all()
+                if not self._condition.wait_for(
+                    lambda: len(self._pending) < self.max_pending, timeout
+                ):
+                    logger.error("State write queue is full, dropping `%s`.", key)
+                    self.dropped += 1
+                    return False
+
+            self._pending[key] = snapshot
+            self.max_depth = max(self.max_depth, len(self._pending))
+            return True
+
+    def flush(self, wait: bool = True, timeout: Optional[float] = None) -> bool:
+        """
+        Flushes every pending snapshot now, e.g. when the page is unloaded.
+        If ``wait``, blocks until done and returns whether nothing is left
+        pending.
+        """
+        with self._condition:
+            if not self._pending and not self._in_flight:
+                return True
+
+            self._ensure_worker()
+            self._flush_requested += 1
+            target = self._flush_requested
+            self._condition.notify_all()
+
+            if not wait:
+                return False
+
+            self._condition.wait_for(lambda: self._flushes_done >= target, timeout)
+            return not self._pending and not self._in_flight
+
+    def close(self, timeout: Optional[float] = None):
+        """Flushes the pending snapshots and stops the worker."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+            thread = self._thread
+
+        if thread is not None:
+            thread.join(timeout)
+
+    @property
+    def depth(self) -> int:
+        return len(self._pending)
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "depth": len(self._pending),
+                "max_depth": self.max_depth,
+                "in_flight": self._in_flight,
+                "submitted": self.submitted,
+                "coalesced": self.coalesced,
+                "written": self.written,
+                "retried": self.retried,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "flushes": self.flush_count,
+                "last_flush_latency": self.last_flush_latency,
+                "mean_flush_latency": (
+                    self.total_flush_latency / self.flush_count
+                    if self.flush_count
+                    else 0.0
+                ),
+            }
+
+    def _ensure_worker(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping = False
+            self._thread = threading.Thread(
+                target=self._run, name="cosmicds-state-writer", daemon=True
+            )
+            self._thread.start()
+
+            if not self._atexit_registered:
+                atexit.register(self.close, 10)
+                self._atexit_registered = True
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._stopping
+                    or self._flush_requested > self._flushes_done,
+                    self.interval,
+                )
+                stopping = self._stopping
+                target = self._flush_requested
+
+            self._flush_pending()
+
+            with self._condition:
+                self._flushes_done = max(self._flushes_done, target)
+                self._condition.notify_all()
+                if stopping:
+                    if self._pending:
+                        logger.error(
+                            "Dropping %d unwritten states on shutdown.",
+                            len(self._pending),
+                        )
+                        self._pending.clear()
+                    self._thread = None
+                    return
+
+    def _flush_pending(self):
+        start = time.perf_counter()
+        flushed = False
+        # Failed writes are requeued, so are left for the next flush
+        with self._condition:
+            remaining = len(self._pending)
+
+        while True:
+            with self._condition:
+                batch = [
+                    self._pending.popitem(last=False)
+                    for _ in range(min(self.batch_size, remaining, len(self._pending)))
+                ]
+                remaining -= len(batch)
+                self._in_flight = len(batch)
+                self._condition.notify_all()
+
+            if not batch:
+                break
+
+            flushed = True
+            self._write_batch(batch)
+
+            with self._condition:
+                self._in_flight = 0
+
+        if flushed:
+            latency = time.perf_counter() - start
+            with self._condition:
+                self.flush_count += 1
+                self.last_flush_latency = latency
+                self.total_flush_latency += latency
+
+    def _write_batch(self, batch: list[tuple[StateKey, dict]]):
+        for attempt in range(self.max_retries + 1):
+            try:
+                written = self.writer(batch)
+            except Exception:
+                logger.exception("Failed to write batch of %d states.", len(batch))
+                written = set()
+
+            with self._condition:
+                self.written += len(written)
+                # Drop anything that was written or superseded in the meantime
+                batch = [
+                    (key, snapshot)
+                    for key, snapshot in batch
+                    if key not in written and key not in self._pending
+                ]
+                if not batch or attempt == self.max_retries:
+                    break
+                self.retried += len(batch)
+                delay = self.retry_backoff * 2**attempt * random.uniform(0.5, 1.5)
+                self._condition.wait_for(lambda: self._stopping, delay)
+
+        if batch:
+            with self._condition:
+                logger.error("Failed to write %d states, requeueing.", len(batch))
+                self.failed += len(batch)
+                for key, snapshot in batch:
+                    self._pending.setdefault(key, snapshot)
+
+
+class _OverriddenPut:
+    """
+    A queued write of a `BaseAPI` subclass that overrides `put_story_state`
+    or `put_stage_state`, which is called with the states (as they are when
+    written) within the session that queued it.
+    """
+
+    __slots__ = ("put", "states", "context")
+
+    def __init__(self, put: Callable[..., Any], *states: Reactive):
+        self.put = put
+        self.states = states
+        self.context = (
+            kernel_context.get_current_context()
+            if kernel_context.has_current_context()
+            else None
+        )
+
+    def __call__(self) -> bool:
+        with self.context or kernel_context.without_context():
+            return self.put(*self.states) is not False
+
 
 class BaseAPI:
     API_URL = "https://api.cosmicds.cfa.harvard.edu"
 
+    @cached_property
+    def backend(self) -> StorageBackend:
+        """
+        Where users, classes and states are persisted. The CosmicDS API
+        server by default, see `cosmicds.storage.create_backend`.
+        """
+        return create_backend(self)
+
+    @cached_property
+    def identity_cache(self) -> IdentityCache:
+        """
+        Cache of the identity lookups behind `user_exists`, `is_educator` and
+        `load_user_info`, so that re-rendering components does not repeat
+        them. Invalidated by `create_new_user` and `forget_user`.
+        """
+        return IdentityCache()
+
+    @cached_property
+    def write_queue(self) -> StateWriteQueue:
+        """
+        Write-behind queue used by `queue_story_state` and
+        `queue_stage_state`, coalescing snapshots per student, story and stage.
+        """
+        return StateWriteQueue(self._write_state_snapshots)
+
+    @cached_property
+    def acknowledged_states(self) -> StateCache:
+        """
+        The last story and stage states the server is known to hold, per
+        (student, story, stage), against which uploads are diffed.
+        """
+        return StateCache()
+
+    @cached_property
+    def stage_state_cache(self) -> StateCache:
+        """
+        Stage states per (student, story, stage), as futures that may still
+        be loading (see `prefetch_stage_states`). Kept up to date with the
+        states loaded at login and queued for upload, so `get_stage_state`
+        can answer without a request.
+        """
+        return StateCache()
+
+    @cached_property
+    def _student_sessions(self) -> dict[int, set[str]]:
+        # The IDs of the open kernels of each student with cached states
+        return {}
+
+    @cached_property
+    def _sessions_lock(self) -> threading.Lock:
+        return threading.Lock()
+
+    def _forget_states_on_close(self, student_id: int):
+        """
+        Drops the cached states of a student once the last of their
+        sessions (if called from one) closes.
+        """
+        if not kernel_context.has_current_context():
+            return
+        context = kernel_context.get_current_context()
+        with self._sessions_lock:
+            sessions = self._student_sessions.setdefault(student_id, set())
+            if context.id in sessions:
+                return
+            sessions.add(context.id)
+
+        def _forget():
+            with self._sessions_lock:
+                sessions.discard(context.id)
+                if sessions:
+                    return
+                del self._student_sessions[student_id]
+            self.acknowledged_states.forget_student(student_id)
+            self.stage_state_cache.forget_student(student_id)
+            logger.debug("Dropped the cached states of student `%s`.", student_id)
+
+        context.on_close(_forget)
+
+    @cached_property
+    def delta_stats(self) -> dict[str, int]:
+        """Counters of how state uploads were sent, and their sizes."""
+        return {
+            "patches": 0,
+            "full": 0,
+            "fallbacks": 0,
+            "unchanged": 0,
+            "bytes_sent": 0,
+            "bytes_full": 0,
+        }
+
+    @cached_property
+    def async_api(self) -> "AsyncBaseAPI":
+        """The `AsyncBaseAPI` sharing this API's configuration and caches."""
+        return AsyncBaseAPI(self)
+
     @cached_property
     def request_session(self):
         """
         Returns a `requests.Session` object that has the relevant authorization
         parameters to interface with the CosmicDS API server (provided that
         environment variables are set correctly).
+
+        Requests time out, GETs are retried and hedged, and the shared
+        circuit breaker fails fast while the server is unhealthy (see
+        `cosmicds.resilience.ResilientSession`). GETs are conditional on the
+        validators of the previous response for the same URL.
         """
-        session = Session()
+        session = ResilientSession(validators=API_VALIDATOR_CACHE)
         session.headers.update({"Authorization": os.getenv("CDS_API_KEY")})
+        session.mount("http://", MetricsAdapter())
+        session.mount("https://", MetricsAdapter())
         return session
 
+    @property
+    def circuit_state(self) -> dict:
+        """
+        The state of the circuit breaker guarding the CosmicDS API (``closed``,
+        ``open`` or ``half_open``), with failure and fallback counts.
+        """
+        return API_BREAKER.stats()
+
+    @property
+    def http_cache_stats(self) -> dict:
+        """
+        Conditional GET requests, ``304 Not Modified`` hits and the response
+        bytes they saved, per endpoint.
+        """
+        return API_VALIDATOR_CACHE.stats()
+
     @property
     def hashed_user(self):
         if auth.user.value is None:
@@ -40,42 +649,41 @@ class BaseAPI:
 
         user_ref = userinfo.get("cds/email", userinfo["cds/name"])
 
-        hashed = hashlib.sha1(
-            (user_ref + os.environ["SOLARA_SESSION_SECRET_KEY"]).encode()
-        ).hexdigest()
+        return _hash_user_ref(user_ref, os.environ["SOLARA_SESSION_SECRET_KEY"])
 
-        return hashed
+    def _get_student_json(self) -> dict | None:
+        hashed_user = self.hashed_user
+        return self.identity_cache.get_or_fetch(
+            hashed_user, "student", lambda: self.backend.get_student(hashed_user)
+        )
 
     @property
     def user_exists(self):
-        r = self.request_session.get(f"{self.API_URL}/student/{self.hashed_user}")
-        return r.json()["student"] is not None
+        return self._get_student_json() is not None
 
     
     @property
     def is_educator(self):
-        r = self.request_session.get(
-            f"{self.API_URL}/educators/{self.hashed_user}"
+        hashed_user = self.hashed_user
+        educator = self.identity_cache.get_or_fetch(
+            hashed_user, "educator", lambda: self.backend.get_educator(hashed_user)
         )
-        return r.json()["educator"] is not None
+        return educator is not None
     
 
     def update_class_size(self, state: Reactive[GlobalState]):
-        class_id = state.value.classroom.class_info["id"]
-        size_json = self.request_session.get(
-            f"{self.API_URL}/classes/size/{class_id}"
-        ).json()
-        Ref(state.fields.classroom.size).set(size_json["size"])
+        class_info = state.value.classroom.class_info
+        if class_info is None:
+            logger.info("Student is in no class, so has no class size.")
+            return
+        size = self.backend.get_class_size(class_info["id"])
+        Ref(state.fields.classroom.size).set(size)
 
     def load_user_info(self, story_name: str, state: Reactive[GlobalState]):
-        student_json = self.request_session.get(
-            f"{self.API_URL}/student/{self.hashed_user}"
-        ).json()["student"]
+        student_json = self._get_student_json()
         sid = student_json["id"]
 
-        class_json = self.request_session.get(
-            f"{self.API_URL}/class-for-student-story/{sid}/{story_name}"
-        ).json()
+        class_json = self.backend.get_class_for_student_story(sid, story_name)
 
         Ref(state.fields.student.id).set(sid)
         Ref(state.fields.classroom.class_info).set(class_json["class"])
@@ -83,35 +691,127 @@ class BaseAPI:
 
         logger.info("Loaded user info for user `%s`.", state.value.student.id)
 
+    def bootstrap(
+        self,
+        story_name: str,
+        global_state: Reactive[GlobalState],
+        local_state: Optional[Reactive[BaseLocalState]] = None,
+        component_states: Iterable[Reactive[BaseState]] = (),
+    ) -> bool:
+        """
+        Loads the student, their class and class size and, if given, the
+        story state and the state of every stage in one step, and fills the
+        given states with the results. After the student record is known,
+        all remaining requests are issued concurrently, so a login costs
+        two round trips rather than one per endpoint and stage.
+
+        Returns `False` (leaving the states untouched) if the user does not
+        exist yet.
+        """
+        component_states = list(component_states)
+        data = run_sync(
+            self.async_api.fetch_bootstrap(
+                story_name,
+                story_id=(
+                    local_state.value.story_id if local_state is not None else None
+                ),
+                stage_ids=[state.value.stage_id for state in component_states],
+                update_db=global_state.value.update_db,
+                hashed_user=self.hashed_user,
+            )
+        )
+        return self._apply_bootstrap(data, global_state, local_state, component_states)
+
+    def _apply_bootstrap(
+        self,
+        data: BootstrapData,
+        global_state: Reactive[GlobalState],
+        local_state: Optional[Reactive[BaseLocalState]],
+        component_states: list[Reactive[BaseState]],
+    ) -> bool:
+        if data.student is None:
+            return False
+
+        self._forget_states_on_close(data.student["id"])
+        if local_state is not None:
+            story_json = (
+                data.story_state
+                if data.from_database
+                else self._default_story_json(local_state)
+            )
+
+            if story_json is None:
+                logger.error(
+                    "Failed to retrieve state for story `%s` for user `%s`.",
+                    local_state.value.story_id,
+                    data.student["id"],
+                )
+            else:
+                BaseAPI._update_state(global_state, story_json.get("app", {}))
+                BaseAPI._update_state(local_state, story_json.get("story", {}))
+
+                if data.from_database:
+                    self.acknowledged_states[
+                        (data.student["id"], local_state.value.story_id, None)
+                    ] = story_json
+
+        # Stage states are keyed by the story, so need the story's state
+        if data.from_database and local_state is not None:
+            for stage_id, stage_json in data.stage_states.items():
+                self._cache_stage_state(
+                    (data.student["id"], local_state.value.story_id, stage_id),
+                    stage_json,
+                )
+
+            for component_state in component_states:
+                stage_json = data.stage_states.get(component_state.value.stage_id)
+
+                if stage_json is None:
+                    logger.error(
+                        "Failed to retrieve stage state for stage `%s` for user `%s`.",
+                        component_state.value.stage_id,
+                        data.student["id"],
+                    )
+                    continue
+
+                component_state.set(
+                    load_state(component_state.value.__class__, stage_json)
+                )
+                self.acknowledged_states[
+                    (
+                        data.student["id"],
+                        local_state.value.story_id,
+                        component_state.value.stage_id,
+                    )
+                ] = stage_json
+
+        # Applied last, so that fresh user info wins over saved app state
+        Ref(global_state.fields.student.id).set(data.student["id"])
+        Ref(global_state.fields.classroom.class_info).set(data.class_info)
+        Ref(global_state.fields.classroom.size).set(data.class_size)
+
+        logger.info("Loaded user info for user `%s`.", global_state.value.student.id)
+
+        return True
+
     def create_new_user(
         self, story_name: str, class_code: str, state: Reactive[GlobalState]
     ):
-        r = self.request_session.get(f"{self.API_URL}/student/{self.hashed_user}")
-        student = r.json()["student"]
+        # Always check against the server before creating a record
+        self.identity_cache.invalidate(self.hashed_user)
 
-        if student is not None:
+        if self._get_student_json() is not None:
             logger.error(
                 "Failed to create user `%s`: user already exists.", self.hashed_user
             )
             return
 
-        r = self.request_session.post(
-            f"{self.API_URL}/students/create",
-            json={
-                "username": self.hashed_user,
-                "password": "",
-                "institution": "",
-                "email": f"{self.hashed_user}",
-                "age": 0,
-                "gender": "undefined",
-                "classroom_code": class_code,
-            },
-        )
-
-        if r.status_code != 201:
+        if not self.backend.create_student(self.hashed_user, class_code):
             logger.error("Failed to create new user.")
             return
 
+        self.identity_cache.invalidate(self.hashed_user)
+
         logger.info(
             "Created new user `%s` with class code '%s'.",
             self.hashed_user,
@@ -126,6 +826,10 @@ class BaseAPI:
         local_state: Reactive[BaseLocalState],
         component_state: Reactive[BaseState],
     ):
+        """
+        Saves a stage state. If a subclass implements it, it also writes the
+        stage states queued with `queue_stage_state`.
+        """
         raise NotImplementedError()
 
     def get_stage_state(
@@ -139,14 +843,11 @@ class BaseAPI:
             logger.info("Skipping retrieval of Component state.")
             return component_state.value
 
-        stage_json = (
-            self.request_session.get(
-                f"{self.API_URL}/stage-state/{global_state.value.student.id}/"
-                f"{local_state.value.story_id}/{component_state.value.stage_id}"
-            )
-            .json()
-            .get("state", None)
-        )
+        key = self._state_key(global_state, local_state, component_state)
+        stage_json = self._cached_stage_state(key)
+        if stage_json is _MISSING:
+            stage_json = self.backend.get_stage_state(*key)
+            self._cache_stage_state(key, stage_json)
 
         if stage_json is None:
             logger.error(
@@ -156,7 +857,8 @@ class BaseAPI:
             )
             return
 
-        component_state.set(component_state.value.__class__(**stage_json))
+        component_state.set(load_state(component_state.value.__class__, stage_json))
+        self.acknowledged_states[key] = stage_json
 
         logger.info("Updated component state from database.")
 
@@ -172,22 +874,15 @@ class BaseAPI:
             logger.info("Skipping deletion of stage state.")
             return
 
-        r = self.request_session.delete(
-            f"{self.API_URL}/stage-state/{global_state.value.student.id}/"
-            f"{local_state.value.story_id}/{component_state.value.stage_id}"
-        )
-
-        if r.status_code != 200:
-            logger.error(
-                "Stage state for stage `%s`, story `%s` user `%s` did not exist in database.",
-                component_state.value.stage_id,
-                local_state.value.story_id,
-                global_state.value.student.id,
-            )
-            return
+        key = self._state_key(global_state, local_state, component_state)
+        self.acknowledged_states.pop(key, None)
+        self.stage_state_cache.pop(key, None)
 
-        result = r.json()
-        if not result.get("success", False):
+        if not self.backend.delete_stage_state(
+            global_state.value.student.id,
+            local_state.value.story_id,
+            component_state.value.stage_id,
+        ):
             logger.error(
                 "Error deleting stage state for stage `%s`, story `%s` user `%s`.",
                 component_state.value.stage_id,
@@ -201,33 +896,21 @@ class BaseAPI:
     ) -> BaseLocalState | None:
         if global_state.value.update_db and not self.is_educator:
 
-            story_json = (
-                self.request_session.get(
-                    f"{self.API_URL}/story-state/{global_state.value.student.id}/"
-                    f"{local_state.value.story_id}"
-                )
-                .json()
-                .get("state", None)
+            story_json = self.backend.get_story_state(
+                global_state.value.student.id, local_state.value.story_id
             )
 
             if story_json is None:
                 logger.error(f"Failed to retrieve state for story {local_state.value.story_id} for user {global_state.value.student.id}.")
                 return
 
+            self.acknowledged_states[
+                self._state_key(global_state, local_state)
+            ] = story_json
+
         else:
             logger.info("Skipping retrieval of Global and Local states.")
-            story_json = {
-                "app": GlobalState(
-                    student=GLOBAL_STATE.value.student, 
-                    show_team_interface = GLOBAL_STATE.value.show_team_interface, 
-                    classroom = GLOBAL_STATE.value.classroom,
-                    educator = GLOBAL_STATE.value.educator,
-                    update_db = GLOBAL_STATE.value.update_db,
-                    ).model_dump(),
-                "story": type(local_state.value)(
-                    title=local_state.value.title, story_id=local_state.value.story_id
-                ).as_dict(), # type: ignore
-            }
+            story_json = self._default_story_json(local_state)
 
         global_state_json = story_json.get("app", {})
         BaseAPI._update_state(global_state, global_state_json)
@@ -244,8 +927,184 @@ class BaseAPI:
         global_state: Reactive[GlobalState],
         local_state: Reactive[BaseLocalState],
     ):
+        """
+        Saves the story state. If a subclass implements it, it also writes
+        the story states queued with `queue_story_state`.
+        """
         raise NotImplementedError()
 
+    @staticmethod
+    def _state_key(
+        global_state: Reactive[GlobalState],
+        local_state: Reactive[BaseLocalState],
+        component_state: Optional[Reactive[BaseState]] = None,
+    ) -> StateKey:
+        return (
+            global_state.value.student.id,
+            local_state.value.story_id,
+            component_state.value.stage_id if component_state is not None else None,
+        )
+
+    def queue_story_state(
+        self,
+        global_state: Reactive[GlobalState],
+        local_state: Reactive[BaseLocalState],
+    ) -> bool:
+        """
+        Queues a snapshot of the story state for a write-behind upload.
+        Cheap enough to call on every state change.
+        """
+        if not global_state.value.update_db or self.is_educator:
+            return False
+
+        key = self._state_key(global_state, local_state)
+        if self._overrides("put_story_state"):
+            return self.write_queue.submit(
+                key, _OverriddenPut(self.put_story_state, global_state, local_state)
+            )
+        return self.write_queue.submit(
+            key,
+            {
+                "app": stamp_schema(
+                    type(global_state.value), global_state.value.as_dict()
+                ),
+                "story": stamp_schema(
+                    type(local_state.value), local_state.value.as_dict()
+                ),
+            },
+        )
+
+    def queue_stage_state(
+        self,
+        global_state: Reactive[GlobalState],
+        local_state: Reactive[BaseLocalState],
+        component_state: Reactive[BaseState],
+    ) -> bool:
+        """
+        Queues a snapshot of a stage state for a write-behind upload.
+        Cheap enough to call on every state change.
+        """
+        if not global_state.value.update_db or self.is_educator:
+            return False
+
+        key = self._state_key(global_state, local_state, component_state)
+        snapshot = stamp_schema(
+            type(component_state.value), component_state.value.as_dict()
+        )
+        self._cache_stage_state(key, snapshot)
+        if self._overrides("put_stage_state"):
+            return self.write_queue.submit(
+                key,
+                _OverriddenPut(
+                    self.put_stage_state, global_state, local_state, component_state
+                ),
+            )
+        return self.write_queue.submit(key, snapshot)
+
+    def prefetch_stage_states(
+        self, story_id: str, stage_ids: Iterable[str]
+    ) -> dict[str, "Future[Optional[dict]]"]:
+        """
+        Starts loading the saved state of every given stage of a story for
+        the current user, concurrently and in the background, and returns
+        the futures for them by stage. Later `get_stage_state` calls are
+        answered from these instead of a request each. Stages already
+        cached are not loaded again.
+        """
+        student = self._get_student_json()
+        if student is None or self.is_educator:
+            return {}
+
+        self._forget_states_on_close(student["id"])
+        futures = {}
+        for stage_id in stage_ids:
+            key = (student["id"], story_id, stage_id)
+            future = self.stage_state_cache.get(key)
+            if future is None:
+                future = self.stage_state_cache[key] = run_coroutine(
+                    self.backend.aget_stage_state(*key)
+                )
+            futures[stage_id] = future
+
+        logger.info(
+            "Prefetching %d stage states of story `%s`.", len(futures), story_id
+        )
+        return futures
+
+    def _cache_stage_state(self, key: StateKey, stage_json: Optional[dict]):
+        future = Future()
+        future.set_result(stage_json)
+        self.stage_state_cache[key] = future
+
+    def _cached_stage_state(self, key: StateKey) -> Any:
+        future = self.stage_state_cache.get(key)
+        if future is None:
+            return _MISSING
+
+        try:
+            return future.result(READ_TIMEOUT)
+        except Exception as e:
+            logger.warning("Prefetching stage state `%s` failed: %s", key, e)
+            self.stage_state_cache.pop(key, None)
+            return _MISSING
+
+    def flush_states(self, wait: bool = True, timeout: Optional[float] = None) -> bool:
+        """
+        Uploads every queued state snapshot now. Hook this up to page unload
+        so nothing is lost when a student closes the tab.
+        """
+        return self.write_queue.flush(wait=wait, timeout=timeout)
+
+    def _overrides(self, method: str) -> bool:
+        return getattr(type(self), method) is not getattr(BaseAPI, method)
+
+    def _write_state_snapshots(
+        self, batch: list[tuple[StateKey, Any]]
+    ) -> set[StateKey]:
+        # States queued by a subclass overriding `put_story_state` or
+        # `put_stage_state` are written by its method
+        snapshots = [
+            (key, snapshot) for key, snapshot in batch if isinstance(snapshot, dict)
+        ]
+        written = set()
+        if snapshots:
+            written = run_sync(self.async_api.put_state_snapshots(snapshots))
+        for key, put in batch:
+            if not isinstance(put, _OverriddenPut):
+                continue
+            try:
+                if put():
+                    written.add(key)
+            except Exception as e:
+                logger.error("Failed to write state `%s`: %s", key, e)
+        return written
+
+    @staticmethod
+    def _default_story_json(local_state: Reactive[BaseLocalState]) -> dict:
+        return {
+            "app": GlobalState(
+                student=GLOBAL_STATE.value.student, 
+                show_team_interface = GLOBAL_STATE.value.show_team_interface, 
+                classroom = GLOBAL_STATE.value.classroom,
+                educator = GLOBAL_STATE.value.educator,
+                update_db = GLOBAL_STATE.value.update_db,
+                ).model_dump(),
+            "story": type(local_state.value)(
+                title=local_state.value.title, story_id=local_state.value.story_id
+            ).as_dict(), # type: ignore
+        }
+
+    def forget_user(self, state: Reactive[GlobalState]):
+        """
+        Drops the cached identity and states of the student in ``state``,
+        e.g. before clearing it with `clear_user` when they log out.
+        """
+        student_id = state.value.student.id
+        if student_id:
+            self.identity_cache.invalidate_student(student_id)
+            self.acknowledged_states.forget_student(student_id)
+            self.stage_state_cache.forget_student(student_id)
+
     @staticmethod
     def clear_user(state: Reactive[GlobalState]):
         Ref(state.fields.student.id).set(0)
@@ -254,8 +1113,451 @@ class BaseAPI:
 
     @staticmethod
     def _update_state(state: Reactive[BaseState], data: dict):
-        new_state = state.value.__class__(**data)
+        new_state = load_state(state.value.__class__, data)
         state.value.__dict__.update(new_state.__dict__)
 
 
 BASE_API = BaseAPI()
+
+
+# Upper bounds for the connection pool shared by all sessions in this worker
+ASYNC_MAX_CONNECTIONS = int(os.getenv("CDS_API_MAX_CONNECTIONS", 20))
+ASYNC_MAX_KEEPALIVE = int(os.getenv("CDS_API_MAX_KEEPALIVE", 10))
+
+_async_client: Optional[httpx.AsyncClient] = None
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """
+    Returns the pooled `httpx.AsyncClient` shared by every session in this
+    worker process. The client must only be used on the shared event loop
+    (see `cosmicds.event_loop`), which `AsyncBaseAPI` takes care of.
+    """
+    global _async_client
+
+    if _async_client is None or _async_client.is_closed:
+        _async_client = httpx.AsyncClient(
+            headers={"Authorization": os.getenv("CDS_API_KEY", "")},
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=ASYNC_MAX_CONNECTIONS,
+                max_keepalive_connections=ASYNC_MAX_KEEPALIVE,
+            ),
+        )
+
+    return _async_client
+
+
+class AsyncBaseAPI:
+    """
+    Asynchronous counterpart of `BaseAPI`. Each method mirrors the
+    synchronous one of the same name, but awaits the request on the shared
+    event loop instead of blocking the calling thread. Note that
+    ``user_exists`` and ``is_educator`` are coroutine methods here rather
+    than properties.
+
+    Parameters
+    ----------
+    api : `BaseAPI`, optional
+        The synchronous API whose configuration (API URL, user hashing) is
+        reused. Defaults to ``BASE_API``.
+    """
+
+    def __init__(self, api: Optional[BaseAPI] = None):
+        self.api = api if api is not None else BASE_API
+
+    @property
+    def API_URL(self):
+        return self.api.API_URL
+
+    @property
+    def hashed_user(self):
+        return self.api.hashed_user
+
+    @property
+    def identity_cache(self) -> IdentityCache:
+        return self.api.identity_cache
+
+    @property
+    def backend(self) -> StorageBackend:
+        return self.api.backend
+
+    async def _request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        async def _send(headers):
+            headers = {**headers, **kwargs.get("headers", {})}
+            with API_METRICS.track(method, url) as observation:
+                response = await get_async_client().request(
+                    method, url, **{**kwargs, "headers": headers}
+                )
+                observation.finish(
+                    response.status_code,
+                    len(response.content),
+                    len(response.request.content),
+                )
+            return response
+
+        return await run_on_loop(
+            resilient_request(
+                _send,
+                method,
+                url,
+                errors=(httpx.HTTPError,),
+                validators=API_VALIDATOR_CACHE,
+            )
+        )
+
+    async def _get_student_json(self) -> dict | None:
+        hashed_user = self.hashed_user
+        student = self.identity_cache.get(hashed_user, "student")
+        if student is _MISSING:
+            student = await self.backend.aget_student(hashed_user)
+            self.identity_cache.set(hashed_user, "student", student)
+        return student
+
+    async def user_exists(self):
+        return await self._get_student_json() is not None
+
+    async def is_educator(self):
+        hashed_user = self.hashed_user
+        educator = self.identity_cache.get(hashed_user, "educator")
+        if educator is _MISSING:
+            educator = await self.backend.aget_educator(hashed_user)
+            self.identity_cache.set(hashed_user, "educator", educator)
+        return educator is not None
+
+    async def update_class_size(self, state: Reactive[GlobalState]):
+        class_info = state.value.classroom.class_info
+        if class_info is None:
+            logger.info("Student is in no class, so has no class size.")
+            return
+        size = await self.backend.aget_class_size(class_info["id"])
+        Ref(state.fields.classroom.size).set(size)
+
+    async def load_user_info(self, story_name: str, state: Reactive[GlobalState]):
+        sid = (await self._get_student_json())["id"]
+
+        class_json = await self.backend.aget_class_for_student_story(sid, story_name)
+
+        Ref(state.fields.student.id).set(sid)
+        Ref(state.fields.classroom.class_info).set(class_json["class"])
+        Ref(state.fields.classroom.size).set(class_json["size"])
+
+        logger.info("Loaded user info for user `%s`.", state.value.student.id)
+
+    async def fetch_bootstrap(
+        self,
+        story_name: str,
+        story_id: Optional[str] = None,
+        stage_ids: Iterable[str] = (),
+        update_db: bool = True,
+        hashed_user: Optional[str] = None,
+    ) -> BootstrapData:
+        """
+        Gathers the data applied by `bootstrap`. Only the network requests
+        are made here, so this may run on any event loop; pass
+        ``hashed_user`` explicitly when not running in a session context.
+        """
+        hashed_user = hashed_user if hashed_user is not None else self.hashed_user
+
+        async def _identity(key, fetch):
+            value = self.identity_cache.get(hashed_user, key)
+            if value is _MISSING:
+                value = await fetch(hashed_user)
+                self.identity_cache.set(hashed_user, key, value)
+            return value
+
+        student, educator = await asyncio.gather(
+            _identity("student", self.backend.aget_student),
+            _identity("educator", self.backend.aget_educator),
+        )
+        if student is None:
+            return BootstrapData()
+
+        sid = student["id"]
+        stage_ids = list(stage_ids)
+        from_database = update_db and educator is None and story_id is not None
+
+        requests = [self.backend.aget_class_for_student_story(sid, story_name)]
+        if from_database:
+            requests.append(self.backend.aget_story_state(sid, story_id))
+            requests.extend(
+                self.backend.aget_stage_state(sid, story_id, stage_id)
+                for stage_id in stage_ids
+            )
+
+        class_json, *states = await asyncio.gather(*requests)
+
+        data = BootstrapData(
+            student=student,
+            educator=educator is not None,
+            class_info=class_json["class"],
+            class_size=class_json["size"],
+            from_database=from_database,
+        )
+
+        if from_database:
+            data.story_state, *stage_states = states
+            data.stage_states = dict(zip(stage_ids, stage_states))
+
+        return data
+
+    async def bootstrap(
+        self,
+        story_name: str,
+        global_state: Reactive[GlobalState],
+        local_state: Optional[Reactive[BaseLocalState]] = None,
+        component_states: Iterable[Reactive[BaseState]] = (),
+    ) -> bool:
+        component_states = list(component_states)
+        data = await self.fetch_bootstrap(
+            story_name,
+            story_id=local_state.value.story_id if local_state is not None else None,
+            stage_ids=[state.value.stage_id for state in component_states],
+            update_db=global_state.value.update_db,
+        )
+        return self.api._apply_bootstrap(
+            data, global_state, local_state, component_states
+        )
+
+    async def create_new_user(
+        self, story_name: str, class_code: str, state: Reactive[GlobalState]
+    ):
+        # Always check against the server before creating a record
+        self.identity_cache.invalidate(self.hashed_user)
+
+        if await self._get_student_json() is not None:
+            logger.error(
+                "Failed to create user `%s`: user already exists.", self.hashed_user
+            )
+            return
+
+        if not await self.backend.acreate_student(self.hashed_user, class_code):
+            logger.error("Failed to create new user.")
+            return
+
+        self.identity_cache.invalidate(self.hashed_user)
+
+        logger.info(
+            "Created new user `%s` with class code '%s'.",
+            self.hashed_user,
+            class_code,
+        )
+
+        await self.load_user_info(story_name, state)
+
+    async def put_stage_state(
+        self,
+        global_state: Reactive[GlobalState],
+        local_state: Reactive[BaseLocalState],
+        component_state: Reactive[BaseState],
+    ):
+        raise NotImplementedError()
+
+    async def get_stage_state(
+        self,
+        global_state: Reactive[GlobalState],
+        local_state: Reactive[BaseLocalState],
+        component_state: Reactive[BaseState],
+    ) -> BaseState | None:
+
+        if not global_state.value.update_db or await self.is_educator():
+            logger.info("Skipping retrieval of Component state.")
+            return component_state.value
+
+        key = BaseAPI._state_key(global_state, local_state, component_state)
+        future = self.api.stage_state_cache.get(key)
+        stage_json = _MISSING
+        if future is not None:
+            try:
+                stage_json = await asyncio.wrap_future(future)
+            except Exception as e:
+                logger.warning("Prefetching stage state `%s` failed: %s", key, e)
+                self.api.stage_state_cache.pop(key, None)
+
+        if stage_json is _MISSING:
+            stage_json = await self.backend.aget_stage_state(*key)
+            self.api._cache_stage_state(key, stage_json)
+
+        if stage_json is None:
+            logger.error(
+                "Failed to retrieve stage state for story `%s` for user `%s`.",
+                local_state.value.story_id,
+                global_state.value.student.id,
+            )
+            return
+
+        component_state.set(load_state(component_state.value.__class__, stage_json))
+        self.api.acknowledged_states[key] = stage_json
+
+        logger.info("Updated component state from database.")
+
+        return component_state.value
+
+    async def delete_stage_state(
+        self,
+        global_state: Reactive[GlobalState],
+        local_state: Reactive[BaseLocalState],
+        component_state: Reactive[BaseState],
+    ):
+        if not global_state.value.update_db or await self.is_educator():
+            logger.info("Skipping deletion of stage state.")
+            return
+
+        key = BaseAPI._state_key(global_state, local_state, component_state)
+        self.api.acknowledged_states.pop(key, None)
+        self.api.stage_state_cache.pop(key, None)
+
+        if not await self.backend.adelete_stage_state(
+            global_state.value.student.id,
+            local_state.value.story_id,
+            component_state.value.stage_id,
+        ):
+            logger.error(
+                "Error deleting stage state for stage `%s`, story `%s` user `%s`.",
+                component_state.value.stage_id,
+                local_state.value.story_id,
+                global_state.value.student.id,
+            )
+            return
+
+    async def get_app_story_states(
+        self, global_state: Reactive[GlobalState], local_state: Reactive[BaseLocalState]
+    ) -> BaseLocalState | None:
+        if global_state.value.update_db and not await self.is_educator():
+            story_json = await self.backend.aget_story_state(
+                global_state.value.student.id, local_state.value.story_id
+            )
+
+            if story_json is None:
+                logger.error(
+                    f"Failed to retrieve state for story {local_state.value.story_id} "
+                    f"for user {global_state.value.student.id}."
+                )
+                return
+
+            self.api.acknowledged_states[
+                BaseAPI._state_key(global_state, local_state)
+            ] = story_json
+
+        else:
+            logger.info("Skipping retrieval of Global and Local states.")
+            story_json = BaseAPI._default_story_json(local_state)
+
+        BaseAPI._update_state(global_state, story_json.get("app", {}))
+        BaseAPI._update_state(local_state, story_json.get("story", {}))
+
+        logger.info("Updated local state from database.")
+
+        return local_state.value
+
+    async def put_story_state(
+        self,
+        global_state: Reactive[GlobalState],
+        local_state: Reactive[BaseLocalState],
+    ):
+        raise NotImplementedError()
+
+    async def put_state_snapshots(
+        self, batch: list[tuple[StateKey, dict]]
+    ) -> set[StateKey]:
+        """
+        Uploads a batch of story and stage state snapshots concurrently and
+        returns the keys that were written successfully.
+
+        If the server is known to hold an earlier version of a state, only
+        a JSON patch against it is sent, falling back to the full state if
+        the server rejects the patch.
+        """
+        acknowledged = self.api.acknowledged_states
+        stats = self.api.delta_stats
+
+        async def _put(key, snapshot):
+            student_id, story_id, stage_id = key
+            location = (student_id, story_id) if stage_id is None else key
+            if stage_id is None:
+                put = self.backend.aput_story_state
+                patch = self.backend.apatch_story_state
+            else:
+                put = self.backend.aput_stage_state
+                patch = self.backend.apatch_stage_state
+
+            full = len(json.dumps(snapshot).encode())
+            stats["bytes_full"] += full
+
+            try:
+                if key in acknowledged:
+                    operations = make_json_patch(acknowledged[key], snapshot)
+                    if not operations:
+                        stats["unchanged"] += 1
+                        return True
+
+                    if self.backend.supports_patch:
+                        patch_size = len(json.dumps(operations).encode())
+                        # Sent whether or not the server applies it
+                        stats["bytes_sent"] += patch_size
+                        try:
+                            ok = await patch(*location, operations)
+                        except PatchRejectedError:
+                            logger.info(
+                                "Patch for state `%s` rejected, sending it whole.", key
+                            )
+                            stats["fallbacks"] += 1
+                        else:
+                            if ok:
+                                stats["patches"] += 1
+                                acknowledged[key] = snapshot
+                            return ok
+
+                ok = await put(*location, snapshot)
+            except Exception as e:
+                logger.error("Failed to write state `%s`: %s", key, e)
+                return False
+
+            stats["full"] += 1
+            stats["bytes_sent"] += full
+            if ok:
+                acknowledged[key] = snapshot
+            return ok
+
+        results = await asyncio.gather(
+            *(_put(key, snapshot) for key, snapshot in batch)
+        )
+        return {key for (key, _), ok in zip(batch, results) if ok}
+
+    def clear_user(self, state: Reactive[GlobalState]):
+        self.api.forget_user(state)
+        BaseAPI.clear_user(state)
+
+
+ASYNC_BASE_API = BASE_API.async_api
+
+
+def use_api_task(
+    method: Callable[..., Coroutine[Any, Any, Any]],
+    *args,
+    dependencies: Optional[list] = None,
+    lazy: bool = False,
+    **kwargs,
+) -> Task:
+    """
+    Runs a coroutine method of `AsyncBaseAPI` as a solara task, so that the
+    calling component renders immediately and re-renders when the result is
+    available, e.g.
+
+        educator = use_api_task(ASYNC_BASE_API.is_educator)
+        if educator.finished and educator.value:
+            ...
+
+    The task runs when the component is first rendered, and again whenever
+    ``dependencies`` change; pass ``lazy=True`` to only run it when called
+    explicitly.
+    """
+
+    async def _run():
+        return await method(*args, **kwargs)
+
+    if lazy:
+        dependencies = None
+    elif dependencies is None:
+        dependencies = []
+    return solara.lab.use_task(_run, dependencies=dependencies, raise_error=False)
@@ -0,0 +1,481 @@
+import asyncio
+import copy
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Awaitable, Callable, Optional
+
+from requests import Session
+from requests.exceptions import ConnectionError, RequestException
+
+from cosmicds.http_cache import ValidatorCache, response_transport
+from cosmicds.logger import setup_logger
+
+logger = setup_logger("RESILIENCE")
+
+# Timeouts (in seconds) for connecting to and reading from the CosmicDS API
+CONNECT_TIMEOUT = float(os.getenv("CDS_API_CONNECT_TIMEOUT", 3.05))
+READ_TIMEOUT = float(os.getenv("CDS_API_READ_TIMEOUT", 10))
+
+# Extra attempts for GET requests that fail or time out, with jittered
+# exponential backoff starting at `RETRY_BACKOFF` seconds
+MAX_RETRIES = int(os.getenv("CDS_API_RETRIES", 2))
+RETRY_BACKOFF = float(os.getenv("CDS_API_RETRY_BACKOFF", 0.2))
+
+# Seconds after which a slow GET is raced by a second, identical request;
+# 0 disables hedging
+HEDGE_AFTER = float(os.getenv("CDS_API_HEDGE_AFTER", 1.0))
+
+# Threads sending synchronous GETs and their hedges, so that the caller can
+# return the first answer while the other attempt is still being read
+HEDGE_WORKERS = int(os.getenv("CDS_API_HEDGE_WORKERS", 64))
+
+# Consecutive failures after which the circuit opens, and how long it stays
+# open before a probe request is let through
+BREAKER_THRESHOLD = int(os.getenv("CDS_API_BREAKER_THRESHOLD", 5))
+BREAKER_COOLDOWN = float(os.getenv("CDS_API_BREAKER_COOLDOWN", 30))
+
+# Number of successful GET responses kept to serve while the API is down
+STALE_CACHE_SIZE = int(os.getenv("CDS_API_STALE_CACHE_SIZE", 2048))
+
+# Responses with these statuses mean the API is unhealthy, and GETs are retried
+RETRY_STATUSES = (502, 503, 504)
+
+
+class CircuitOpenError(ConnectionError):
+    """Raised instead of sending a request while the circuit is open."""
+
+
+class CircuitBreaker:
+    """
+    A thread-safe circuit breaker for the CosmicDS API.
+
+    The circuit is ``closed`` while requests succeed. After ``threshold``
+    consecutive failures (connection errors, timeouts or server errors) it
+    opens, and requests fail fast for ``cooldown`` seconds. It is then
+    ``half_open``: a single probe request is let through, which closes the
+    circuit if it succeeds and opens it again otherwise.
+
+    Parameters
+    ----------
+    threshold : int
+        The number of consecutive failures that opens the circuit.
+    cooldown : float
+        Seconds the circuit stays open before a probe is let through.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self, threshold: int = BREAKER_THRESHOLD, cooldown: float = BREAKER_COOLDOWN
+    ):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self._counts = {"opened": 0, "rejected": 0, "served_stale": 0}
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self) -> str:
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self._opened_at < self.cooldown:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow(self) -> bool:
+        """Whether a request may be sent now."""
+        return self.acquire() is not None
+
+    def acquire(self) -> Optional[str]:
+        """
+        Lets a request through if possible, returning the state it was let
+        through in (`None` if it was not). A request let through while
+        ``half_open`` is the probe, and no other is let through until its
+        outcome is recorded, or the probe released with `release_probe`.
+        """
+        with self._lock:
+            state = self._state()
+            if state == self.CLOSED:
+                return state
+            if state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return state
+            self._counts["rejected"] += 1
+            return None
+
+    def release_probe(self):
+        """
+        Lets another probe through, when the probe request ended without an
+        outcome (e.g. it was cancelled).
+        """
+        with self._lock:
+            self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("CosmicDS API recovered, closing circuit.")
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or (
+                self._opened_at is None and self._failures >= self.threshold
+            ):
+                logger.warning(
+                    "CosmicDS API failing (%d consecutive failures), opening circuit.",
+                    self._failures,
+                )
+                self._opened_at = time.monotonic()
+                self._counts["opened"] += 1
+            self._probing = False
+
+    def record_stale(self):
+        with self._lock:
+            self._counts["served_stale"] += 1
+
+    def reset(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def stats(self) -> dict:
+        with self._lock:
+            state = self._state()
+            return {
+                "state": state,
+                "consecutive_failures": self._failures,
+                "retry_in": (
+                    max(0.0, self.cooldown - (time.monotonic() - self._opened_at))
+                    if state == self.OPEN
+                    else 0.0
+                ),
+                **self._counts,
+            }
+
+
+class StaleCache:
+    """
+    A bounded, thread-safe LRU map from URL to the last successful GET
+    response, which is served while the API cannot be reached. Responses
+    are kept per transport (see `cosmicds.http_cache.response_transport`),
+    so that e.g. a `requests` caller is never served an ``httpx`` one.
+    """
+
+    def __init__(self, size: int = STALE_CACHE_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._responses = OrderedDict()
+
+    def get(self, url: str, transport: str = "requests"):
+        key = (transport, url)
+        with self._lock:
+            response = self._responses.get(key)
+            if response is not None:
+                self._responses.move_to_end(key)
+            return response
+
+    def set(self, url: str, response):
+        key = (response_transport(response), url)
+        with self._lock:
+            self._responses[key] = response
+            self._responses.move_to_end(key)
+            while len(self._responses) > self.size:
+                self._responses.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._responses.clear()
+
+
+# Shared by the sync and async clients, since they talk to the same server
+# (the cached responses are kept per transport)
+API_BREAKER = CircuitBreaker()
+API_STALE_CACHE = StaleCache()
+
+
+def backoff_delay(attempt: int, base: float = RETRY_BACKOFF) -> float:
+    """Exponential backoff with full jitter for the given retry attempt."""
+    return random.uniform(0, base * 2**attempt)
+
+
+_hedge_pool: Optional[ThreadPoolExecutor] = None
+_hedge_pool_lock = threading.Lock()
+
+
+def _get_hedge_pool() -> ThreadPoolExecutor:
+    global _hedge_pool
+
+    with _hedge_pool_lock:
+        if _hedge_pool is None:
+            _hedge_pool = ThreadPoolExecutor(
+                max_workers=HEDGE_WORKERS, thread_name_prefix="cosmicds-hedge"
+            )
+    return _hedge_pool
+
+
+def _discard(attempt: Future):
+    # Closes the response of an attempt that lost the race
+    if not attempt.cancelled() and attempt.exception() is None:
+        attempt.result().close()
+
+
+class ResilientSession(Session):
+    """
+    A `requests.Session` for the CosmicDS API with default connect and read
+    timeouts, a shared `CircuitBreaker`, and, for GET requests, bounded
+    retries with jittered backoff, hedging, and the last good response
+    served while the circuit is open or the API cannot be reached.
+
+    Responses served from the stale cache have ``from_stale_cache`` set.
+    If a `~cosmicds.http_cache.ValidatorCache` is given, GETs are sent as
+    conditional requests and unchanged responses are reused.
+    """
+
+    def __init__(
+        self,
+        breaker: Optional[CircuitBreaker] = None,
+        stale_cache: Optional[StaleCache] = None,
+        timeout: tuple[float, float] = (CONNECT_TIMEOUT, READ_TIMEOUT),
+        max_retries: int = MAX_RETRIES,
+        hedge_after: float = HEDGE_AFTER,
+        validators: Optional[ValidatorCache] = None,
+    ):
+        super().__init__()
+        self.breaker = breaker if breaker is not None else API_BREAKER
+        self.stale_cache = stale_cache if stale_cache is not None else API_STALE_CACHE
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.hedge_after = hedge_after
+        self.validators = validators
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        idempotent = method.upper() == "GET"
+        if idempotent and self.validators is not None:
+            kwargs["headers"] = self.validators.conditional_headers(
+                url, kwargs.get("headers"), transport="requests"
+            )
+
+        granted = self.breaker.acquire()
+        if granted is None:
+            return self._stale_or_raise(
+                url, idempotent, CircuitOpenError("CosmicDS API circuit is open.")
+            )
+
+        # Whether this request holds the probe of a half-open circuit, which
+        # must be released however the request ends
+        probing = granted == CircuitBreaker.HALF_OPEN
+        try:
+            attempts = self.max_retries + 1 if idempotent else 1
+            for attempt in range(attempts):
+                try:
+                    if idempotent and self.hedge_after > 0:
+                        response = self._hedged(method, url, *args, **kwargs)
+                    else:
+                        response = super().request(method, url, *args, **kwargs)
+                except RequestException as e:
+                    error, response = e, None
+                else:
+                    error = None
+
+                failed = error is not None or response.status_code >= 500
+                if not failed:
+                    self.breaker.record_success()
+                    probing = False
+                    if idempotent and self.validators is not None:
+                        response = self.validators.resolve(url, response)
+                    if idempotent and 200 <= response.status_code < 300:
+                        self.stale_cache.set(url, response)
+                    return response
+
+                self.breaker.record_failure()
+                probing = False
+                retryable = error is not None or response.status_code in RETRY_STATUSES
+                if attempt + 1 < attempts and retryable:
+                    granted = self.breaker.acquire()
+                    if granted is not None:
+                        probing = granted == CircuitBreaker.HALF_OPEN
+                        logger.info(
+                            "Retrying %s %s after failure: %s",
+                            method,
+                            url,
+                            error or response.status_code,
+                        )
+                        time.sleep(backoff_delay(attempt))
+                        continue
+
+                if error is not None or retryable:
+                    return self._stale_or_raise(url, idempotent, error, response)
+                return response
+        finally:
+            if probing:
+                self.breaker.release_probe()
+
+    def _hedged(self, method, url, *args, **kwargs):
+        """
+        Sends a GET from a hedge thread, and the same request again if it
+        has not been answered within ``hedge_after`` seconds. The first
+        answer is returned. The other attempt is not interrupted, but ends
+        by its own timeout at the latest, and its response is discarded.
+        """
+        send = super().request
+        pool = _get_hedge_pool()
+        attempts = [pool.submit(send, method, url, *args, **kwargs)]
+        if not wait(attempts, timeout=self.hedge_after).done:
+            logger.debug("Hedging slow request %s %s", method, url)
+            attempts.append(pool.submit(send, method, url, *args, **kwargs))
+
+        winner = None
+        try:
+            while winner is None:
+                answered = [a for a in attempts if a.done() and not a.exception()]
+                running = [a for a in attempts if not a.done()]
+                if answered:
+                    winner = answered[0]
+                elif not running:
+                    # Every attempt failed, raising the error of the first one
+                    winner = attempts[0]
+                else:
+                    wait(running, return_when=FIRST_COMPLETED)
+            return winner.result()
+        finally:
+            for attempt in attempts:
+                if attempt is not winner and not attempt.cancel():
+                    attempt.add_done_callback(_discard)
+
+    def _stale_or_raise(self, url, idempotent, error=None, response=None):
+        stale = self.stale_cache.get(url, "requests") if idempotent else None
+        if stale is not None:
+            self.breaker.record_stale()
+            # The cached response itself is served again later, unmarked
+            stale = copy.copy(stale)
+            stale.from_stale_cache = True
+            return stale
+        if response is not None:
+            return response
+        raise error
+
+
+async def resilient_request(
+    send: Callable[[], Awaitable[Any]],
+    method: str,
+    url: str,
+    breaker: Optional[CircuitBreaker] = None,
+    stale_cache: Optional[StaleCache] = None,
+    max_retries: int = MAX_RETRIES,
+    hedge_after: float = HEDGE_AFTER,
+    errors: tuple[type[BaseException], ...] = (Exception,),
+    validators: Optional[ValidatorCache] = None,
+    transport: str = "httpx",
+):
+    """
+    The asynchronous counterpart of `ResilientSession.request`. ``send``
+    creates the coroutine sending the request with ``transport`` (the
+    package of its responses, ``httpx`` by default) given extra request
+    headers, and ``errors`` are the exceptions it raises when the API
+    cannot be reached.
+    """
+    breaker = breaker if breaker is not None else API_BREAKER
+    stale_cache = stale_cache if stale_cache is not None else API_STALE_CACHE
+    idempotent = method.upper() == "GET"
+    headers = {}
+    if idempotent and validators is not None:
+        headers = validators.conditional_headers(url, transport=transport)
+
+    def _stale_or_raise(error=None, response=None):
+        stale = stale_cache.get(url, transport) if idempotent else None
+        if stale is not None:
+            breaker.record_stale()
+            return stale
+        if response is not None:
+            return response
+        raise error
+
+    async def _hedged():
+        tasks = [asyncio.ensure_future(send(headers))]
+        done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+        if not done:
+            logger.debug("Hedging slow request %s %s", method, url)
+            tasks.append(asyncio.ensure_future(send(headers)))
+
+        pending = set(tasks)
+        try:
+            while True:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None or not pending:
+                        return task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    granted = breaker.acquire()
+    if granted is None:
+        return _stale_or_raise(CircuitOpenError("CosmicDS API circuit is open."))
+
+    # Released however the request ends, e.g. when its task is cancelled
+    probing = granted == CircuitBreaker.HALF_OPEN
+    try:
+        attempts = max_retries + 1 if idempotent else 1
+        for attempt in range(attempts):
+            try:
+                if idempotent and hedge_after > 0:
+                    response = await _hedged()
+                else:
+                    response = await send(headers)
+            except errors as e:
+                error, response = e, None
+            else:
+                error = None
+
+            failed = error is not None or response.status_code >= 500
+            if not failed:
+                breaker.record_success()
+                probing = False
+                if idempotent and validators is not None:
+                    response = validators.resolve(url, response)
+                if idempotent and 200 <= response.status_code < 300:
+                    stale_cache.set(url, response)
+                return response
+
+            breaker.record_failure()
+            probing = False
+            retryable = error is not None or response.status_code in RETRY_STATUSES
+            if attempt + 1 < attempts and retryable:
+                granted = breaker.acquire()
+                if granted is not None:
+                    probing = granted == CircuitBreaker.HALF_OPEN
+                    logger.info(
+                        "Retrying %s %s after failure: %s",
+                        method,
+                        url,
+                        error or response.status_code,
+                    )
+                    await asyncio.sleep(backoff_delay(attempt))
+                    continue
+
+            if error is not None or retryable:
+                return _stale_or_raise(error, response)
+            return response
+    finally:
+        if probing:
+            breaker.release_probe()
@@ -0,0 +1,205 @@
+import threading
+from contextlib import nullcontext
+from typing import Any, Mapping, Optional, Union
+from weakref import WeakKeyDictionary
+
+import numpy as np
+from glue.core import ComponentID, Data
+from glue.core.component import CategoricalComponent, Component
+from glue.core.message import NumericalDataChangedMessage
+from numpy.typing import ArrayLike
+
+from cosmicds.messages import RowsAppendedMessage
+
+__all__ = ["append_rows", "release_row_buffers"]
+
+
+class _RowBuffers:
+    """
+    Over-allocated column buffers backing the components of a dataset, so
+    rows can be appended in amortised constant time. The components hold
+    views of the first ``length`` rows, which are never written to again:
+    updated rows are written to a copy of the buffer.
+    """
+
+    def __init__(self, data: Data, key: Optional[ComponentID]):
+        self.length = data.shape[0]
+        self.capacity = self.length
+        self.buffers = {
+            cid: np.array(self._values(data, cid)) for cid in data.main_components
+        }
+        self.key = key
+        self.index = None
+        if key is not None:
+            self.index = {
+                value: row for row, value in enumerate(self.buffers[key].tolist())
+            }
+
+    @staticmethod
+    def _values(data: Data, cid: ComponentID) -> np.ndarray:
+        component = data.get_component(cid)
+        if isinstance(component, CategoricalComponent):
+            return component.labels
+        return component.data
+
+    def in_sync(self, data: Data, key: Optional[ComponentID]) -> bool:
+        # The components may have been replaced since, e.g. by
+        # `update_values_from_data`
+        return (
+            key == self.key
+            and data.ndim == 1
+            and data.shape[0] == self.length
+            and set(self.buffers) == set(data.main_components)
+            and all(
+                np.shares_memory(self._values(data, cid), buffer)
+                for cid, buffer in self.buffers.items()
+                if self.length > 0
+            )
+        )
+
+    def reserve(
+        self, length: int, dtypes: dict[ComponentID, np.dtype], copy: bool = False
+    ):
+        """
+        Makes room for ``length`` rows of the given types, in new buffers if
+        needed or if ``copy`` is true.
+        """
+        if length > self.capacity:
+            self.capacity = max(length, 2 * self.capacity, 8)
+        for cid, buffer in self.buffers.items():
+            dtype = np.result_type(buffer.dtype, dtypes[cid])
+            if len(buffer) < self.capacity or dtype != buffer.dtype or copy:
+                grown = np.empty(self.capacity, dtype=dtype)
+                grown[: self.length] = buffer[: self.length]
+                self.buffers[cid] = grown
+
+
+_buffers: "WeakKeyDictionary[Data, _RowBuffers]" = WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def append_rows(
+    data: Data,
+    rows: Mapping[Union[str, ComponentID], ArrayLike],
+    key: Optional[Union[str, ComponentID]] = None,
+) -> Optional[RowsAppendedMessage]:
+    """
+    Appends rows to a one-dimensional dataset, or updates them if ``key``
+    is given and a row with the same key value already exists.
+
+    The component arrays are grown with capacity doubling, so appending is
+    amortised constant time per row rather than a copy of the whole
+    dataset. Updating rows copies the arrays, so that the values previously
+    read from the dataset never change. The new arrays are set with
+    `~glue.core.Data.update_values_from_data`, but a
+    `~cosmicds.messages.RowsAppendedMessage` describing only the new and
+    updated rows is broadcast (and returned) instead of the full refresh it
+    would send.
+
+    Parameters
+    ----------
+    data : `~glue.core.Data`
+        The dataset to add to.
+    rows : dict
+        The new values by component label or ID, one array per main
+        component of ``data``, all of the same length.
+    key : str or `~glue.core.ComponentID`, optional
+        The component identifying a row, e.g. the student ID of a
+        measurement. Rows whose key already exists are updated.
+    """
+    if data.ndim != 1:
+        raise ValueError("Rows can only be appended to one-dimensional data.")
+
+    columns = {data.id[cid] if isinstance(cid, str) else cid: cid for cid in rows}
+    values = {cid: np.asarray(rows[label]) for cid, label in columns.items()}
+    if set(values) != set(data.main_components):
+        raise ValueError(
+            "Rows must have a value for each of the components "
+            f"{[cid.label for cid in data.main_components]}."
+        )
+    lengths = {len(column) for column in values.values()}
+    if len(lengths) != 1:
+        raise ValueError("All columns of the new rows must have the same length.")
+    count = lengths.pop()
+    if count == 0:
+        return None
+
+    key = data.id[key] if isinstance(key, str) else key
+
+    with _lock:
+        buffers = _buffers.get(data)
+        if buffers is None or not buffers.in_sync(data, key):
+            buffers = _buffers[data] = _RowBuffers(data, key)
+
+        start = buffers.length
+        if key is None:
+            appended = np.arange(count)
+            updated_rows, updated_from = [], []
+        else:
+            appended_rows: dict[Any, int] = {}
+            updated: dict[int, int] = {}
+            for row, value in enumerate(values[key].tolist()):
+                existing = buffers.index.get(value)
+                if existing is not None:
+                    updated[existing] = row
+                else:
+                    # A repeated new key updates the row appended for it
+                    appended_rows[value] = row
+            appended = np.fromiter(appended_rows.values(), dtype=int)
+            updated_rows = np.fromiter(updated.keys(), dtype=int)
+            updated_from = np.fromiter(updated.values(), dtype=int)
+
+        length = start + len(appended)
+        buffers.reserve(
+            length,
+            {cid: column.dtype for cid, column in values.items()},
+            copy=len(updated_rows) > 0,
+        )
+
+        updated_data = Data(label=data.label, coords=data.coords)
+        for cid, column in values.items():
+            buffer = buffers.buffers[cid]
+            buffer[start:length] = column[appended]
+            if len(updated_rows):
+                buffer[updated_rows] = column[updated_from]
+
+            if isinstance(data.get_component(cid), CategoricalComponent):
+                component = CategoricalComponent(buffer[:length])
+            else:
+                component = Component(buffer[:length])
+            updated_data.add_component(component, cid.label)
+
+        if key is not None:
+            for offset, value in enumerate(values[key][appended].tolist()):
+                buffers.index[value] = start + offset
+        buffers.length = length
+
+        # Keeps the component IDs, and so the subsets, links and viewers
+        ignored = (
+            nullcontext()
+            if data.hub is None
+            else data.hub.ignore_callbacks(NumericalDataChangedMessage)
+        )
+        with ignored:
+            data.update_values_from_data(updated_data)
+
+    message = RowsAppendedMessage(
+        data,
+        start=start,
+        count=len(appended),
+        updated=np.asarray(updated_rows, dtype=int),
+        components_changed=list(values),
+    )
+    if data.hub is not None:
+        data.hub.broadcast(message)
+    return message
+
+
+def release_row_buffers(data: Data):
+    """
+    Forgets the spare capacity kept for appending rows to ``data``, e.g.
+    once its values have been moved out of memory. It is rebuilt by the
+    next `append_rows`.
+    """
+    with _lock:
+        _buffers.pop(data, None)
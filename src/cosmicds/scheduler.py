@@ -0,0 +1,328 @@
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Any, Callable, Optional
+
+from solara.server import kernel_context
+
+from cosmicds.logger import setup_logger
+
+logger = setup_logger("SCHEDULER")
+
+# Threads running the jobs; a job that is still running when it is due
+# again skips that run rather than running concurrently with itself
+SCHEDULER_WORKERS = int(os.getenv("CDS_SCHEDULER_WORKERS", 4))
+
+# Number of recent start delays kept for the lag percentiles
+LAG_SAMPLES = 1000
+
+# Owner of the jobs scheduled outside of a solara kernel
+NO_OWNER = None
+
+_CURRENT = object()
+
+
+def _init_worker():
+    # Timers used to give their function a fresh zmq IOLoop on each run
+    # (see `RepeatedTimer`); instead, each worker thread gets an event
+    # loop for good, which tornado's `IOLoop.current` wraps
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+
+class Job:
+    """
+    A function run periodically by a `Scheduler`, as returned by
+    `Scheduler.schedule`.
+    """
+
+    def __init__(
+        self,
+        scheduler: "Scheduler",
+        function: Callable,
+        args: tuple,
+        kwargs: dict,
+        interval: float,
+        jitter: float,
+        owner: Optional[str],
+        context: Optional["kernel_context.VirtualKernelContext"],
+        name: str,
+    ):
+        self.scheduler = scheduler
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.interval = interval
+        self.jitter = jitter
+        self.owner = owner
+        self.context = context
+        self.name = name
+        self.due = 0.0
+        self.cancelled = False
+        self.running = False
+        self.runs = 0
+        self.skipped = 0
+        self.errors = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def cancel(self):
+        """Stops running the job. A run in progress is not interrupted."""
+        self.scheduler.cancel(self)
+
+    def _next_due(self, after: float) -> float:
+        return after + self.interval + random.uniform(0, self.jitter)
+
+    def _run(self, due: float):
+        lag = time.monotonic() - due
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self.scheduler._record_lag(lag)
+        try:
+            with self.context or nullcontext():
+                self.function(*self.args, **self.kwargs)
+        except Exception:
+            self.errors += 1
+            logger.exception("Scheduled job `%s` failed.", self.name)
+        finally:
+            self.runs += 1
+            self.running = False
+
+    def __repr__(self):
+        return (
+            f"<Job {self.name!r} every {self.interval}s, owner={self.owner!r}"
+            f"{', cancelled' if self.cancelled else ''}>"
+        )
+
+
+class Scheduler:
+    """
+    Runs periodic jobs for the whole worker process: the jobs are kept in a
+    heap ordered by when they are next due, which a single thread waits on,
+    and are run by a small pool of reused threads. This replaces a thread
+    (and an event loop) per run of each timer of each session.
+
+    Jobs run at a fixed rate, each run being due one interval (plus a
+    random jitter, which spreads the jobs of sessions started together)
+    after the previous one was due, rather than after it finished. A job
+    that is still running when it is due again skips that run, and a job
+    that fell more than an interval behind is rescheduled from now.
+
+    Jobs scheduled from a solara kernel are owned by it: they run within
+    its context and are cancelled when it closes.
+
+    Parameters
+    ----------
+    workers : int
+        The number of threads running the jobs.
+    """
+
+    def __init__(self, workers: int = SCHEDULER_WORKERS):
+        self.workers = workers
+        self._condition = threading.Condition()
+        self._heap: list[tuple[float, int, Job]] = []
+        self._counter = itertools.count()
+        self._jobs_by_owner: dict[Optional[str], set[Job]] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._closed = False
+        self._lags = deque(maxlen=LAG_SAMPLES)
+        self._stats = {"runs": 0, "skipped": 0, "cancelled": 0}
+
+    def schedule(
+        self,
+        interval: float,
+        function: Callable,
+        *args: Any,
+        jitter: float = 0.0,
+        delay: Optional[float] = None,
+        owner: Any = _CURRENT,
+        name: Optional[str] = None,
+        **kwargs: Any,
+    ) -> Job:
+        """
+        Runs ``function(*args, **kwargs)`` every ``interval`` seconds.
+
+        Parameters
+        ----------
+        interval : float
+            The seconds between runs.
+        function : callable
+            The function to run.
+        jitter : float, optional
+            Up to how many seconds to randomly add to each interval.
+        delay : float, optional
+            The seconds before the first run, which defaults to
+            ``interval`` (plus jitter).
+        owner : str, optional
+            The ID of the kernel owning the job, whose closing cancels it.
+            Defaults to the current kernel, if any.
+        name : str, optional
+            A name for the job in the logs and statistics.
+        """
+        if interval <= 0:
+            raise ValueError("The interval of a job must be positive.")
+
+        context = None
+        if owner is _CURRENT:
+            owner = NO_OWNER
+            if kernel_context.has_current_context():
+                context = kernel_context.get_current_context()
+                owner = context.id
+
+        job = Job(
+            self,
+            function,
+            args,
+            kwargs,
+            interval,
+            jitter,
+            owner,
+            context,
+            name or getattr(function, "__qualname__", repr(function)),
+        )
+        now = time.monotonic()
+        job.due = job._next_due(now) if delay is None else now + delay
+
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The scheduler is closed.")
+            jobs = self._jobs_by_owner.get(owner)
+            if jobs is None:
+                jobs = self._jobs_by_owner[owner] = set()
+                if context is not None:
+                    context.on_close(lambda: self.cancel_owner(owner))
+            jobs.add(job)
+            self._push(job)
+            self._start()
+        return job
+
+    def _push(self, job: Job):
+        heapq.heappush(self._heap, (job.due, next(self._counter), job))
+        if self._heap[0][2] is job:
+            self._condition.notify()
+
+    def _start(self):
+        if self._thread is None:
+            self._executor = ThreadPoolExecutor(
+                self.workers,
+                thread_name_prefix="cosmicds-job",
+                initializer=_init_worker,
+            )
+            # Otherwise solara would run the scheduler, and the workers it
+            # starts, in the kernel that scheduled the first job
+            with kernel_context.without_context():
+                self._thread = threading.Thread(
+                    target=self._loop, name="cosmicds-scheduler", daemon=True
+                )
+                self._thread.start()
+            logger.info("Started the job scheduler.")
+
+    def _loop(self):
+        with self._condition:
+            while not self._closed:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+
+                due, _, job = self._heap[0]
+                now = time.monotonic()
+                if due > now:
+                    self._condition.wait(due - now)
+                    continue
+
+                heapq.heappop(self._heap)
+                if job.cancelled:
+                    continue
+
+                if job.running:
+                    job.skipped += 1
+                    self._stats["skipped"] += 1
+                else:
+                    job.running = True
+                    self._stats["runs"] += 1
+                    self._executor.submit(job._run, due)
+
+                job.due = job._next_due(due)
+                if job.due < now:
+                    job.due = job._next_due(now)
+                self._push(job)
+
+    def _record_lag(self, lag: float):
+        with self._condition:
+            self._lags.append(lag)
+
+    def cancel(self, job: Job):
+        with self._condition:
+            if job.cancelled:
+                return
+            job.cancelled = True
+            self._stats["cancelled"] += 1
+            jobs = self._jobs_by_owner.get(job.owner)
+            if jobs is not None:
+                jobs.discard(job)
+                if not jobs:
+                    del self._jobs_by_owner[job.owner]
+            # Dropped from the heap lazily, unless it is the next one due
+            self._condition.notify()
+
+    def cancel_owner(self, owner: Optional[str]) -> int:
+        """Cancels the jobs of a kernel, and returns how many there were."""
+        with self._condition:
+            jobs = list(self._jobs_by_owner.get(owner, ()))
+        for job in jobs:
+            self.cancel(job)
+        if jobs:
+            logger.debug("Cancelled %d jobs of `%s`.", len(jobs), owner)
+        return len(jobs)
+
+    def jobs(self, owner: Any = _CURRENT) -> list[Job]:
+        """The scheduled jobs of a kernel, by default the current one."""
+        if owner is _CURRENT:
+            owner = NO_OWNER
+            if kernel_context.has_current_context():
+                owner = kernel_context.get_current_context().id
+        with self._condition:
+            return list(self._jobs_by_owner.get(owner, ()))
+
+    def stats(self) -> dict:
+        """
+        Returns the numbers of scheduled jobs and of runs, skipped runs and
+        cancellations, and how late the recent runs started, in seconds.
+        """
+        with self._condition:
+            lags = sorted(self._lags)
+            jobs = [job for jobs in self._jobs_by_owner.values() for job in jobs]
+
+        def quantile(q):
+            return lags[min(int(q * len(lags)), len(lags) - 1)] if lags else None
+
+        return dict(
+            self._stats,
+            jobs=len(jobs),
+            owners=len({job.owner for job in jobs}),
+            lag_p50=quantile(0.5),
+            lag_p95=quantile(0.95),
+            lag_max=lags[-1] if lags else None,
+        )
+
+    def close(self, wait: bool = True):
+        """Cancels every job and stops the scheduler thread."""
+        with self._condition:
+            self._closed = True
+            jobs = [job for jobs in self._jobs_by_owner.values() for job in jobs]
+            self._condition.notify()
+        for job in jobs:
+            self.cancel(job)
+        if self._thread is not None:
+            self._thread.join()
+            self._executor.shutdown(wait=wait)
+
+
+SCHEDULER = Scheduler()
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import types
+import typing
+from functools import lru_cache
+from typing import Any, Optional, TypeVar, Union
+
+from pydantic import BaseModel, TypeAdapter, ValidationError
+
+from cosmicds.logger import setup_logger
+
+logger = setup_logger("SCHEMA")
+
+# Key under which state snapshots record the schema they were dumped with
+SCHEMA_KEY = "__schema__"
+
+# Types that come back from a JSON round trip exactly as they were dumped
+_JSON_TYPES = (str, int, float, bool, type(None), Any)
+
+Model = TypeVar("Model", bound=BaseModel)
+
+STATE_LOAD_STATS = {"trusted": 0, "validated": 0}
+
+
+@lru_cache(maxsize=None)
+def schema_hash(cls: type[BaseModel]) -> Optional[str]:
+    """
+    Returns a short hash of the JSON schema of a model, which changes
+    whenever one of its fields (or those of its nested models) does, or
+    `None` if the model has no fast path (see `load_state`).
+    """
+    if _field_plan(cls) is None:
+        return None
+    try:
+        schema = cls.model_json_schema()
+    except Exception as e:
+        logger.debug("No schema hash for `%s`: %s", cls.__name__, e)
+        return None
+    encoded = json.dumps([cls.__qualname__, schema], sort_keys=True).encode()
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+def _is_json_native(annotation: Any) -> bool:
+    if annotation in _JSON_TYPES or annotation in (list, dict):
+        return True
+
+    origin = typing.get_origin(annotation)
+    args = typing.get_args(annotation)
+    if origin is typing.Literal:
+        return all(isinstance(arg, _JSON_TYPES[:-1]) for arg in args)
+    if origin in (Union, types.UnionType):
+        return all(_is_json_native(arg) for arg in args)
+    if origin is list:
+        return all(_is_json_native(arg) for arg in args)
+    if origin is dict:
+        return args[0] is str and _is_json_native(args[1])
+    return False
+
+
+@lru_cache(maxsize=None)
+def _field_plan(cls: type[BaseModel]) -> Optional[dict[str, Optional[TypeAdapter]]]:
+    # For each field, `None` if its dumped value can be used as is, or an
+    # adapter validating just that field (nested models, tuples, dates...)
+    plan = {}
+    for name, field in cls.model_fields.items():
+        if field.alias is not None and field.alias != name:
+            return None
+        if _is_json_native(field.annotation):
+            plan[name] = None
+        else:
+            plan[name] = TypeAdapter(field.annotation)
+    return plan
+
+
+def stamp_schema(cls: type[BaseModel], data: dict) -> dict:
+    """
+    Records the schema of ``cls`` in a state dumped from it, so that it can
+    be loaded back without re-validation by `load_state`.
+    """
+    stamp = schema_hash(cls)
+    if stamp is None:
+        return data
+    return {**data, SCHEMA_KEY: stamp}
+
+
+def load_state(cls: type[Model], data: dict) -> Model:
+    """
+    Builds a state model from its JSON.
+
+    States stamped by `stamp_schema` with the current schema of ``cls``
+    were dumped from the same model, so they are trusted: the fields that
+    only hold JSON types (which are most of the payload, e.g. lists of
+    measurements) are used as they are, and only those holding nested
+    models or other types are validated. Anything else, including states
+    saved before a change to the model, is fully validated.
+    """
+    stamp = data.get(SCHEMA_KEY)
+    if stamp is not None and stamp == schema_hash(cls):
+        plan = _field_plan(cls)
+        try:
+            values = {
+                name: value if plan[name] is None else plan[name].validate_python(value)
+                for name, value in data.items()
+                if name in plan
+            }
+        except ValidationError as e:
+            logger.warning(
+                "Stamped `%s` state failed validation, validating it whole: %s",
+                cls.__name__,
+                e,
+            )
+        else:
+            STATE_LOAD_STATS["trusted"] += 1
+            return cls.model_construct(**values)
+
+    STATE_LOAD_STATS["validated"] += 1
+    return cls(**{name: value for name, value in data.items() if name != SCHEMA_KEY})
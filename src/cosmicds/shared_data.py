@@ -0,0 +1,189 @@
+import os
+import re
+import tempfile
+import threading
+from copy import copy
+from pathlib import Path
+from typing import Mapping, Union
+
+import numpy as np
+from glue.core import Component, Data
+from numpy.typing import ArrayLike
+
+from cosmicds.logger import setup_logger
+
+logger = setup_logger("SHARED_DATA")
+
+# Where memory-mapped shared datasets are written
+SHARED_DATA_DIR = os.getenv(
+    "CDS_SHARED_DATA_DIR", os.path.join(tempfile.gettempdir(), "cosmicds-shared-data")
+)
+
+
+class SharedDataset:
+    """
+    An immutable dataset shared by every session in the process. Its glue
+    components are built once, over read-only (and optionally
+    memory-mapped) arrays, and every `view` gets its own copies of them
+    around the same arrays, so the values are never copied per session.
+
+    Parameters
+    ----------
+    label : str
+        The label of the dataset, and of its views.
+    components : dict of str to `~glue.core.Component`
+        The components, by label.
+    memmapped : bool
+        Whether the numerical components are memory-mapped from disk.
+    """
+
+    def __init__(self, label: str, components: dict[str, Component], memmapped=False):
+        self.label = label
+        self.components = components
+        self.memmapped = memmapped
+
+    @property
+    def nbytes(self) -> int:
+        return sum(
+            component.data.nbytes
+            for component in self.components.values()
+            if isinstance(component.data, np.ndarray)
+        )
+
+    def view(self) -> Data:
+        """
+        Returns a new `~glue.core.Data` over the shared arrays. Subsets,
+        links, added components and updated values belong to the view only.
+        """
+        data = Data(label=self.label)
+        for name, component in self.components.items():
+            # glue updates a component by swapping its array, which must not
+            # reach the views of other sessions
+            data.add_component(copy(component), name)
+        return data
+
+    def shares(self, values: np.ndarray) -> bool:
+        """Whether ``values`` is (a view of) one of the shared arrays."""
+        arrays = [component.data for component in self.components.values()]
+        while isinstance(values, np.ndarray):
+            if any(values is array for array in arrays):
+                return True
+            values = values.base
+        return False
+
+
+class SharedDataRegistry:
+    """
+    A thread-safe, process-wide registry of `SharedDataset`, for reference
+    data that every student loads (galaxy lists, spectra tables, class-wide
+    measurement snapshots).
+    """
+
+    def __init__(self, directory: str = SHARED_DATA_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._datasets: dict[str, SharedDataset] = {}
+        self._views = 0
+
+    def register(
+        self,
+        label: str,
+        data: Union[Data, Mapping[str, ArrayLike]],
+        memmap: bool = False,
+        replace: bool = False,
+    ) -> SharedDataset:
+        """
+        Registers a dataset under ``label`` and returns it. If one is already
+        registered under that label it is returned instead, unless
+        ``replace`` is set.
+
+        Parameters
+        ----------
+        data : `~glue.core.Data` or dict of str to array-like
+            The values, as a glue dataset (whose main components are used)
+            or as arrays by component label.
+        memmap : bool
+            Whether to write the numerical components to ``.npy`` files and
+            memory-map them back, so that their pages are shared by the OS
+            (also between worker processes) and can be paged out.
+        """
+        with self._lock:
+            if label in self._datasets and not replace:
+                return self._datasets[label]
+
+            if isinstance(data, Data):
+                arrays = {cid.label: data[cid] for cid in data.main_components}
+            else:
+                arrays = dict(data)
+
+            components = {}
+            for name, values in arrays.items():
+                values = np.asarray(values)
+                if memmap and values.dtype.kind in "biufc":
+                    values = self._memmap(label, name, values)
+                else:
+                    values = np.array(values, copy=True)
+                values.setflags(write=False)
+                components[name] = Component.autotyped(values)
+
+            dataset = SharedDataset(label, components, memmapped=memmap)
+            self._datasets[label] = dataset
+
+        logger.info(
+            "Registered shared dataset `%s` (%d bytes).", label, dataset.nbytes
+        )
+        return dataset
+
+    def _memmap(self, label: str, name: str, values: np.ndarray) -> np.memmap:
+        directory = Path(self.directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / (re.sub(r"[^\w.-]", "_", f"{label}-{name}") + ".npy")
+        np.save(path, values)
+        return np.load(path, mmap_mode="r")
+
+    def get(self, label: str) -> SharedDataset:
+        with self._lock:
+            return self._datasets[label]
+
+    def view(self, label: str) -> Data:
+        """Returns a new view over the dataset registered under ``label``."""
+        dataset = self.get(label)
+        with self._lock:
+            self._views += 1
+        return dataset.view()
+
+    def remove(self, label: str):
+        """
+        Unregisters a dataset. Existing views keep their values.
+        """
+        with self._lock:
+            self._datasets.pop(label, None)
+
+    def is_shared(self, component: Component) -> bool:
+        """Whether ``component`` holds the values of a registered dataset."""
+        values = getattr(component, "_data", None)
+        with self._lock:
+            return any(
+                dataset.shares(values) for dataset in self._datasets.values()
+            )
+
+    def __contains__(self, label: str) -> bool:
+        with self._lock:
+            return label in self._datasets
+
+    @property
+    def labels(self) -> list[str]:
+        with self._lock:
+            return list(self._datasets)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "datasets": len(self._datasets),
+                "nbytes": sum(d.nbytes for d in self._datasets.values()),
+                "memmapped": sum(d.memmapped for d in self._datasets.values()),
+                "views": self._views,
+            }
+
+
+SHARED_DATASETS = SharedDataRegistry()
@@ -1,10 +1,18 @@
 import os
 from pydantic import BaseModel, Field
 from functools import cached_property
-from glue_jupyter import JupyterApplication
-from glue.core import DataCollection, Session
+from typing import TYPE_CHECKING, Literal
 import solara
-from glue.core import Data, DataCollection
+from solara.server import kernel_context
+
+from cosmicds.glue_app import create_glue_app
+
+# glue is only imported once a session first uses it
+if TYPE_CHECKING:
+    from glue.core import Data, DataCollection, Session
+    from glue_jupyter import JupyterApplication
+
+    from cosmicds.memory import SessionMemoryBudget
 
 
 update_db_init = True
@@ -89,18 +97,30 @@ class GlobalState(BaseState):
     educator: bool = False
 
     @cached_property
-    def _glue_app(self) -> JupyterApplication:
-        return JupyterApplication()
+    def _glue_app(self) -> "JupyterApplication":
+        return create_glue_app()
+
+    @cached_property
+    def memory_budget(self) -> "SessionMemoryBudget":
+        from cosmicds.memory import SessionMemoryBudget
+
+        budget = SessionMemoryBudget(self._glue_app)
+        if kernel_context.has_current_context():
+            kernel_context.get_current_context().on_close(budget.close)
+        return budget
 
     @cached_property
-    def glue_data_collection(self) -> DataCollection:
+    def glue_data_collection(self) -> "DataCollection":
+        # Datasets are added through the data collection, so start keeping
+        # them within the session's memory budget
+        self.memory_budget
         return self._glue_app.data_collection
 
     @cached_property
-    def glue_session(self) -> Session:
+    def glue_session(self) -> "Session":
         return self._glue_app.session
     
-    def add_or_update_data(self, data: Data):
+    def add_or_update_data(self, data: "Data"):
         if data.label in self.glue_data_collection:
             existing = self.glue_data_collection[data.label]
             existing.update_values_from_data(data)
@@ -109,5 +129,68 @@ class GlobalState(BaseState):
             self.glue_data_collection.append(data)
             return data
 
+    def append_rows(
+        self, label: str, rows: dict, key: str | None = None
+    ) -> "Data":
+        """
+        Appends rows to the dataset ``label``, creating it if needed, or
+        updates the rows whose ``key`` component matches, including among
+        the rows creating it. Unlike `add_or_update_data`, only the new rows
+        are sent to viewers and tools (see `cosmicds.rows.append_rows`).
+        """
+        import numpy as np
+        from glue.core import Data
+
+        from cosmicds.rows import append_rows
+
+        if label in self.glue_data_collection:
+            data = self.glue_data_collection[label]
+            append_rows(data, rows, key=key)
+        elif key is None:
+            data = Data(label=label, **rows)
+            self.glue_data_collection.append(data)
+        else:
+            # Starts empty, so that the rows of the first batch with the
+            # same key are merged as in the later ones
+            data = Data(
+                label=label,
+                **{name: np.asarray(values)[:0] for name, values in rows.items()},
+            )
+            append_rows(data, rows, key=key)
+            self.glue_data_collection.append(data)
+        return data
+
+    def add_shared_data(self, label: str) -> "Data":
+        """
+        Adds a view of the shared dataset registered under ``label`` (see
+        `cosmicds.shared_data.SHARED_DATASETS`) to this session's data
+        collection, unless it is already there, and returns it. The view
+        does not copy the values; its subsets and links are this session's
+        own.
+        """
+        from cosmicds.shared_data import SHARED_DATASETS
+
+        if label in self.glue_data_collection:
+            return self.glue_data_collection[label]
+
+        data = SHARED_DATASETS.view(label)
+        self.glue_data_collection.append(data)
+        return data
+
+
+class LoginStatus(BaseModel):
+    """
+    The progress of the login of a session, see `cosmicds.layout.BaseSetup`.
+    ``timings`` holds the seconds spent in each phase (``educator``,
+    ``bootstrap``, ``create_user``, ``prefetch``) and in ``total``.
+    """
+
+    state: Literal["idle", "loading", "ready", "error"] = "idle"
+    phase: str | None = None
+    user: str | None = None
+    error: str | None = None
+    timings: dict[str, float] = {}
+
 
 GLOBAL_STATE = solara.reactive(GlobalState())
+LOGIN_STATUS = solara.reactive(LoginStatus())
@@ -0,0 +1,590 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, Any, Callable, Optional
+
+from cosmicds.logger import setup_logger
+
+if TYPE_CHECKING:
+    from cosmicds.remote import BaseAPI
+
+logger = setup_logger("STORAGE")
+
+# Which backend `BaseAPI` persists to: "http" (the CosmicDS API) or "sqlite"
+STORAGE_BACKEND = os.getenv("CDS_STORAGE_BACKEND", "http").strip().lower()
+SQLITE_PATH = os.getenv("CDS_SQLITE_PATH", "cosmicds.sqlite3")
+
+# Whether the CosmicDS API server applies JSON patches to states, so that
+# only the changes to a state are sent
+API_SUPPORTS_PATCH = (
+    os.getenv("CDS_API_SUPPORTS_PATCH", "false").strip().lower() == "true"
+)
+
+
+class PatchRejectedError(Exception):
+    """Raised when a backend refuses to apply a state patch."""
+
+
+class StorageBackend(ABC):
+    """
+    The persistence operations behind `~cosmicds.remote.BaseAPI`: student
+    and educator lookup, class information, and getting, putting and
+    deleting story and stage states. States are plain JSON-compatible dicts.
+
+    Every operation has a coroutine counterpart prefixed with ``a``, used by
+    `~cosmicds.remote.AsyncBaseAPI`. By default these run the synchronous
+    operation in a thread; backends with a native asynchronous client
+    should override them.
+    """
+
+    #: Whether `patch_story_state` and `patch_stage_state` are supported
+    supports_patch = False
+
+    @abstractmethod
+    def get_student(self, hashed_user: str) -> Optional[dict]:
+        """Returns the student record of the given user, if any."""
+
+    @abstractmethod
+    def get_educator(self, hashed_user: str) -> Optional[dict]:
+        """Returns the educator record of the given user, if any."""
+
+    @abstractmethod
+    def create_student(self, hashed_user: str, class_code: str) -> bool:
+        """Creates a student in the class with the given code."""
+
+    @abstractmethod
+    def get_class_for_student_story(self, student_id: int, story_name: str) -> dict:
+        """
+        Returns the class of a student for a story, as a dict with the class
+        information under ``class`` and the class size under ``size``.
+        """
+
+    @abstractmethod
+    def get_class_size(self, class_id: int) -> int:
+        """Returns the number of students in a class."""
+
+    @abstractmethod
+    def get_story_state(self, student_id: int, story_id: str) -> Optional[dict]:
+        """Returns the saved story state, with ``app`` and ``story`` entries."""
+
+    @abstractmethod
+    def put_story_state(self, student_id: int, story_id: str, state: dict) -> bool:
+        """Saves a story state, returning whether this succeeded."""
+
+    @abstractmethod
+    def get_stage_state(
+        self, student_id: int, story_id: str, stage_id: str
+    ) -> Optional[dict]:
+        """Returns the saved state of a stage."""
+
+    @abstractmethod
+    def put_stage_state(
+        self, student_id: int, story_id: str, stage_id: str, state: dict
+    ) -> bool:
+        """Saves a stage state, returning whether this succeeded."""
+
+    @abstractmethod
+    def delete_stage_state(self, student_id: int, story_id: str, stage_id: str) -> bool:
+        """Deletes a stage state, returning whether it existed and was deleted."""
+
+    def patch_story_state(self, student_id: int, story_id: str, patch: list) -> bool:
+        """
+        Applies a JSON patch to the saved story state. Raises
+        `PatchRejectedError` if the patch cannot be applied.
+        """
+        raise PatchRejectedError("Patches are not supported by this backend.")
+
+    def patch_stage_state(
+        self, student_id: int, story_id: str, stage_id: str, patch: list
+    ) -> bool:
+        """
+        Applies a JSON patch to the saved stage state. Raises
+        `PatchRejectedError` if the patch cannot be applied.
+        """
+        raise PatchRejectedError("Patches are not supported by this backend.")
+
+    async def aget_student(self, hashed_user: str) -> Optional[dict]:
+        return await asyncio.to_thread(self.get_student, hashed_user)
+
+    async def aget_educator(self, hashed_user: str) -> Optional[dict]:
+        return await asyncio.to_thread(self.get_educator, hashed_user)
+
+    async def acreate_student(self, hashed_user: str, class_code: str) -> bool:
+        return await asyncio.to_thread(self.create_student, hashed_user, class_code)
+
+    async def aget_class_for_student_story(
+        self, student_id: int, story_name: str
+    ) -> dict:
+        return await asyncio.to_thread(
+            self.get_class_for_student_story, student_id, story_name
+        )
+
+    async def aget_class_size(self, class_id: int) -> int:
+        return await asyncio.to_thread(self.get_class_size, class_id)
+
+    async def aget_story_state(self, student_id: int, story_id: str) -> Optional[dict]:
+        return await asyncio.to_thread(self.get_story_state, student_id, story_id)
+
+    async def aput_story_state(
+        self, student_id: int, story_id: str, state: dict
+    ) -> bool:
+        return await asyncio.to_thread(
+            self.put_story_state, student_id, story_id, state
+        )
+
+    async def apatch_story_state(
+        self, student_id: int, story_id: str, patch: list
+    ) -> bool:
+        return await asyncio.to_thread(
+            self.patch_story_state, student_id, story_id, patch
+        )
+
+    async def aget_stage_state(
+        self, student_id: int, story_id: str, stage_id: str
+    ) -> Optional[dict]:
+        return await asyncio.to_thread(
+            self.get_stage_state, student_id, story_id, stage_id
+        )
+
+    async def aput_stage_state(
+        self, student_id: int, story_id: str, stage_id: str, state: dict
+    ) -> bool:
+        return await asyncio.to_thread(
+            self.put_stage_state, student_id, story_id, stage_id, state
+        )
+
+    async def apatch_stage_state(
+        self, student_id: int, story_id: str, stage_id: str, patch: list
+    ) -> bool:
+        return await asyncio.to_thread(
+            self.patch_stage_state, student_id, story_id, stage_id, patch
+        )
+
+    async def adelete_stage_state(
+        self, student_id: int, story_id: str, stage_id: str
+    ) -> bool:
+        return await asyncio.to_thread(
+            self.delete_stage_state, student_id, story_id, stage_id
+        )
+
+
+# Statuses with which the server rejects a patch, so the full state is sent
+PATCH_REJECTED_STATUSES = (400, 404, 405, 409, 412, 415, 422, 501)
+
+# Statuses with which the server rejects patches altogether, after which
+# only full states are sent
+PATCH_UNSUPPORTED_STATUSES = (405, 415, 501)
+
+_SUCCESS_STATUSES = (200, 201, 204)
+
+
+class HTTPStorageBackend(StorageBackend):
+    """
+    Persists to the CosmicDS API server, using the ``request_session`` of
+    the given API for synchronous calls and its `AsyncBaseAPI` (and pooled
+    ``httpx`` client) for asynchronous ones.
+
+    States are only patched if ``supports_patch`` (by default, the
+    ``CDS_API_SUPPORTS_PATCH`` environment variable) is true, and no longer
+    once the server answers that it does not support patches.
+    """
+
+    def __init__(self, api: "BaseAPI", supports_patch: Optional[bool] = None):
+        self.api = api
+        self.supports_patch = (
+            API_SUPPORTS_PATCH if supports_patch is None else supports_patch
+        )
+
+    def _url(self, path: str) -> str:
+        return f"{self.api.API_URL}/{path}"
+
+    def _call(self, method: str, path: str, parse: Callable[[Any], Any], **kwargs):
+        response = self.api.request_session.request(method, self._url(path), **kwargs)
+        return parse(response)
+
+    async def _acall(
+        self, method: str, path: str, parse: Callable[[Any], Any], **kwargs
+    ):
+        return parse(
+            await self.api.async_api._request(method, self._url(path), **kwargs)
+        )
+
+    @staticmethod
+    def _succeeded(r) -> bool:
+        return r.status_code in _SUCCESS_STATUSES
+
+    def _patched(self, r) -> bool:
+        if r.status_code in PATCH_UNSUPPORTED_STATUSES and self.supports_patch:
+            logger.warning(
+                "Server does not support patches (status %d), sending full states.",
+                r.status_code,
+            )
+            self.supports_patch = False
+        if r.status_code in PATCH_REJECTED_STATUSES:
+            raise PatchRejectedError(
+                f"Server rejected patch with status {r.status_code}."
+            )
+        return r.status_code in _SUCCESS_STATUSES
+
+    @staticmethod
+    def _deleted(r) -> bool:
+        return r.status_code == 200 and r.json().get("success", False)
+
+    @staticmethod
+    def _student_payload(hashed_user: str, class_code: str) -> dict:
+        return {
+            "username": hashed_user,
+            "password": "",
+            "institution": "",
+            "email": f"{hashed_user}",
+            "age": 0,
+            "gender": "undefined",
+            "classroom_code": class_code,
+        }
+
+    @staticmethod
+    def _patch_kwargs(patch: list) -> dict:
+        return {
+            "content": json.dumps(patch).encode(),
+            "headers": {"Content-Type": "application/json-patch+json"},
+        }
+
+    def get_student(self, hashed_user):
+        return self._call(
+            "GET", f"student/{hashed_user}", lambda r: r.json()["student"]
+        )
+
+    def get_educator(self, hashed_user):
+        return self._call(
+            "GET", f"educators/{hashed_user}", lambda r: r.json()["educator"]
+        )
+
+    def create_student(self, hashed_user, class_code):
+        return self._call(
+            "POST",
+            "students/create",
+            lambda r: r.status_code == 201,
+            json=self._student_payload(hashed_user, class_code),
+        )
+
+    def get_class_for_student_story(self, student_id, story_name):
+        return self._call(
+            "GET",
+            f"class-for-student-story/{student_id}/{story_name}",
+            lambda r: r.json(),
+        )
+
+    def get_class_size(self, class_id):
+        return self._call("GET", f"classes/size/{class_id}", lambda r: r.json()["size"])
+
+    def get_story_state(self, student_id, story_id):
+        return self._call(
+            "GET",
+            f"story-state/{student_id}/{story_id}",
+            lambda r: r.json().get("state", None),
+        )
+
+    def put_story_state(self, student_id, story_id, state):
+        return self._call(
+            "PUT", f"story-state/{student_id}/{story_id}", self._succeeded, json=state
+        )
+
+    def patch_story_state(self, student_id, story_id, patch):
+        return self._call(
+            "PATCH",
+            f"story-state/{student_id}/{story_id}",
+            self._patched,
+            **self._patch_kwargs(patch),
+        )
+
+    def get_stage_state(self, student_id, story_id, stage_id):
+        return self._call(
+            "GET",
+            f"stage-state/{student_id}/{story_id}/{stage_id}",
+            lambda r: r.json().get("state", None),
+        )
+
+    def put_stage_state(self, student_id, story_id, stage_id, state):
+        return self._call(
+            "PUT",
+            f"stage-state/{student_id}/{story_id}/{stage_id}",
+            self._succeeded,
+            json=state,
+        )
+
+    def patch_stage_state(self, student_id, story_id, stage_id, patch):
+        return self._call(
+            "PATCH",
+            f"stage-state/{student_id}/{story_id}/{stage_id}",
+            self._patched,
+            **self._patch_kwargs(patch),
+        )
+
+    def delete_stage_state(self, student_id, story_id, stage_id):
+        return self._call(
+            "DELETE", f"stage-state/{student_id}/{story_id}/{stage_id}", self._deleted
+        )
+
+    async def aget_student(self, hashed_user):
+        return await self._acall(
+            "GET", f"student/{hashed_user}", lambda r: r.json()["student"]
+        )
+
+    async def aget_educator(self, hashed_user):
+        return await self._acall(
+            "GET", f"educators/{hashed_user}", lambda r: r.json()["educator"]
+        )
+
+    async def acreate_student(self, hashed_user, class_code):
+        return await self._acall(
+            "POST",
+            "students/create",
+            lambda r: r.status_code == 201,
+            json=self._student_payload(hashed_user, class_code),
+        )
+
+    async def aget_class_for_student_story(self, student_id, story_name):
+        return await self._acall(
+            "GET",
+            f"class-for-student-story/{student_id}/{story_name}",
+            lambda r: r.json(),
+        )
+
+    async def aget_class_size(self, class_id):
+        return await self._acall(
+            "GET", f"classes/size/{class_id}", lambda r: r.json()["size"]
+        )
+
+    async def aget_story_state(self, student_id, story_id):
+        return await self._acall(
+            "GET",
+            f"story-state/{student_id}/{story_id}",
+            lambda r: r.json().get("state", None),
+        )
+
+    async def aput_story_state(self, student_id, story_id, state):
+        return await self._acall(
+            "PUT", f"story-state/{student_id}/{story_id}", self._succeeded, json=state
+        )
+
+    async def apatch_story_state(self, student_id, story_id, patch):
+        return await self._acall(
+            "PATCH",
+            f"story-state/{student_id}/{story_id}",
+            self._patched,
+            **self._patch_kwargs(patch),
+        )
+
+    async def aget_stage_state(self, student_id, story_id, stage_id):
+        return await self._acall(
+            "GET",
+            f"stage-state/{student_id}/{story_id}/{stage_id}",
+            lambda r: r.json().get("state", None),
+        )
+
+    async def aput_stage_state(self, student_id, story_id, stage_id, state):
+        return await self._acall(
+            "PUT",
+            f"stage-state/{student_id}/{story_id}/{stage_id}",
+            self._succeeded,
+            json=state,
+        )
+
+    async def apatch_stage_state(self, student_id, story_id, stage_id, patch):
+        return await self._acall(
+            "PATCH",
+            f"stage-state/{student_id}/{story_id}/{stage_id}",
+            self._patched,
+            **self._patch_kwargs(patch),
+        )
+
+    async def adelete_stage_state(self, student_id, story_id, stage_id):
+        return await self._acall(
+            "DELETE", f"stage-state/{student_id}/{story_id}/{stage_id}", self._deleted
+        )
+
+
+class SQLiteStorageBackend(StorageBackend):
+    """
+    Persists to a local SQLite database in WAL mode, for offline lab
+    deployments and classroom-sized load tests without the CosmicDS API.
+    Classes are created on the fly from the class codes students sign up
+    with. Educators are the users added with `create_educator`.
+
+    Parameters
+    ----------
+    path : str
+        The database file; created if it does not exist.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS classes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            code TEXT UNIQUE NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS students (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            class_id INTEGER REFERENCES classes (id)
+        );
+        CREATE INDEX IF NOT EXISTS students_class ON students (class_id);
+        CREATE TABLE IF NOT EXISTS educators (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS story_states (
+            student_id INTEGER NOT NULL,
+            story_id TEXT NOT NULL,
+            state TEXT NOT NULL,
+            PRIMARY KEY (student_id, story_id)
+        );
+        CREATE TABLE IF NOT EXISTS stage_states (
+            student_id INTEGER NOT NULL,
+            story_id TEXT NOT NULL,
+            stage_id TEXT NOT NULL,
+            state TEXT NOT NULL,
+            PRIMARY KEY (student_id, story_id, stage_id)
+        );
+    """
+
+    def __init__(self, path: str = SQLITE_PATH):
+        self.path = path
+        self._local = threading.local()
+
+        with self._connection() as connection:
+            connection.executescript(self.SCHEMA)
+
+        logger.info("Using SQLite storage at `%s`.", path)
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections cannot be shared between threads, so keep one per thread
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _query_one(self, query: str, *args) -> Optional[tuple]:
+        return self._connection().execute(query, args).fetchone()
+
+    def _student_class(self, student_id: int) -> Optional[int]:
+        row = self._query_one("SELECT class_id FROM students WHERE id = ?", student_id)
+        return row[0] if row is not None else None
+
+    def get_student(self, hashed_user):
+        row = self._query_one(
+            "SELECT id, username, class_id FROM students WHERE username = ?",
+            hashed_user,
+        )
+        if row is None:
+            return None
+        return {"id": row[0], "username": row[1], "class_id": row[2]}
+
+    def get_educator(self, hashed_user):
+        row = self._query_one(
+            "SELECT id, username FROM educators WHERE username = ?", hashed_user
+        )
+        if row is None:
+            return None
+        return {"id": row[0], "username": row[1]}
+
+    def create_educator(self, hashed_user: str) -> bool:
+        """
+        Makes the given user an educator, returning whether they were not
+        one already.
+        """
+        with self._connection() as connection:
+            cursor = connection.execute(
+                "INSERT OR IGNORE INTO educators (username) VALUES (?)",
+                (hashed_user,),
+            )
+            return cursor.rowcount == 1
+
+    def create_student(self, hashed_user, class_code):
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR IGNORE INTO classes (code) VALUES (?)", (class_code,)
+            )
+            cursor = connection.execute(
+                "INSERT OR IGNORE INTO students (username, class_id) "
+                "SELECT ?, id FROM classes WHERE code = ?",
+                (hashed_user, class_code),
+            )
+            return cursor.rowcount == 1
+
+    def get_class_for_student_story(self, student_id, story_name):
+        class_id = self._student_class(student_id)
+        if class_id is None:
+            return {"class": None, "size": 0}
+
+        row = self._query_one("SELECT id, code FROM classes WHERE id = ?", class_id)
+        return {
+            "class": {"id": row[0], "code": row[1]},
+            "size": self.get_class_size(class_id),
+        }
+
+    def get_class_size(self, class_id):
+        return self._query_one(
+            "SELECT COUNT(*) FROM students WHERE class_id = ?", class_id
+        )[0]
+
+    def get_story_state(self, student_id, story_id):
+        row = self._query_one(
+            "SELECT state FROM story_states WHERE student_id = ? AND story_id = ?",
+            student_id,
+            story_id,
+        )
+        return json.loads(row[0]) if row is not None else None
+
+    def put_story_state(self, student_id, story_id, state):
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO story_states VALUES (?, ?, ?)",
+                (student_id, story_id, json.dumps(state)),
+            )
+        return True
+
+    def get_stage_state(self, student_id, story_id, stage_id):
+        row = self._query_one(
+            "SELECT state FROM stage_states "
+            "WHERE student_id = ? AND story_id = ? AND stage_id = ?",
+            student_id,
+            story_id,
+            stage_id,
+        )
+        return json.loads(row[0]) if row is not None else None
+
+    def put_stage_state(self, student_id, story_id, stage_id, state):
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO stage_states VALUES (?, ?, ?, ?)",
+                (student_id, story_id, stage_id, json.dumps(state)),
+            )
+        return True
+
+    def delete_stage_state(self, student_id, story_id, stage_id):
+        with self._connection() as connection:
+            cursor = connection.execute(
+                "DELETE FROM stage_states "
+                "WHERE student_id = ? AND story_id = ? AND stage_id = ?",
+                (student_id, story_id, stage_id),
+            )
+            return cursor.rowcount > 0
+
+
+def create_backend(api: "BaseAPI", name: str = STORAGE_BACKEND) -> StorageBackend:
+    """
+    Creates the storage backend named by ``name`` (by default, the
+    ``CDS_STORAGE_BACKEND`` environment variable) for the given API.
+    """
+    if name == "http":
+        return HTTPStorageBackend(api)
+    if name == "sqlite":
+        return SQLiteStorageBackend(SQLITE_PATH)
+
+    raise ValueError(f"Unknown storage backend `{name}`.")
@@ -7,12 +7,14 @@ from glue.core.message import (DataCollectionDeleteMessage, DataUpdateMessage,
                                SubsetMessage, SubsetUpdateMessage)
 from glue.core.exceptions import IncompatibleAttribute
 from glue_jupyter.bqplot.common.tools import Tool
-from numpy import isfinite, isnan
+from numpy import isnan
 from numpy.linalg import LinAlgError
 from traitlets import Unicode, HasTraits
 
 from cosmicds.config import register_tool
-from cosmicds.utils import fit_line, line_mark
+from cosmicds.line_fit import LineFitEngine
+from cosmicds.messages import RowsAppendedMessage
+from cosmicds.utils import line_mark
 
 
 
@@ -35,18 +37,22 @@ class LineFitTool(Tool, HubListener, HasTraits):
         self.active = False
         self._show_labels = kwargs.get("show_labels", True)
         self._ignore_conditions = []
+        self._fits = LineFitEngine()
         self.hub.subscribe(self, DataCollectionDeleteMessage,
                            handler=self._on_data_collection_deleted, filter=self._data_collection_filter)
         self.hub.subscribe(self, DataUpdateMessage,
                            handler=self._on_data_updated, filter=self._data_update_filter)
         self.hub.subscribe(self, SubsetUpdateMessage,
-                           handler=self._on_data_updated, filter=self._data_update_filter)
+                           handler=self._on_subset_updated)
         self.hub.subscribe(self, LayerArtistVisibilityMessage,
                            handler=self._on_layer_visibility_updated, filter=self._layer_filter)
         self.hub.subscribe(self, LayerArtistUpdatedMessage, filter=self._layer_filter,
                            handler=self._on_layer_artist_updated)
         self.hub.subscribe(self, NumericalDataChangedMessage, filter=self._data_collection_filter,
                            handler=self._on_data_updated)
+        self.hub.subscribe(self, RowsAppendedMessage,
+                           handler=self._on_rows_appended,
+                           filter=self._data_collection_filter)
 
         add_callback(self.viewer.state, 'layers', self._on_layers_updated)
 
@@ -111,6 +117,20 @@ class LineFitTool(Tool, HubListener, HasTraits):
         data = msg.subset if isinstance(msg, SubsetMessage) else msg.data
         self._update_fit_line_for_data(data)
 
+    def _on_subset_updated(self, msg):
+        # A subset state changed in place is still the same state, so the
+        # cached sums of its fits must be dropped whether or not it is shown
+        self._fits.subset_updated(msg)
+        refit = self.active and msg.attribute == "subset_state" \
+            and msg.subset in self.lines.keys()
+        if refit or self._data_update_filter(msg):
+            self._on_data_updated(msg)
+
+    def _on_rows_appended(self, msg):
+        # Only the new rows are added to the running sums of the fits
+        self._fits.rows_appended(msg)
+        self._on_data_updated(msg)
+
     def _on_layers_updated(self, layers):
         self._refresh_if_active()
 
@@ -204,11 +224,8 @@ class LineFitTool(Tool, HubListener, HasTraits):
     # Methods for fitting lines
 
     def _fit_line(self, state):
-        data = state.layer
-        mask = isfinite(data[self.viewer.state.x_att]) & isfinite(data[self.viewer.state.y_att])
-        x = data[self.viewer.state.x_att][mask]
-        y = data[self.viewer.state.y_att][mask]
-        return fit_line(x, y)
+        x_att, y_att = self.viewer.state.x_att, self.viewer.state.y_att
+        return self._fits.fit(state.layer, x_att, y_att)
 
     def _create_fit_line(self, state):
 
@@ -234,6 +251,7 @@ class LineFitTool(Tool, HubListener, HasTraits):
         if data in self.lines.keys():
             fit = self._fit_line(state)
             if fit is None:
+                self._remove_line(state)
                 return
             mark = self.lines[data]
             mark.x = self.x_range
@@ -266,9 +284,16 @@ class LineFitTool(Tool, HubListener, HasTraits):
 
     def _fit_to_layers(self):
         self._clear_lines()
-        for state in self.visible_layers:
-            if not any(condition(state) for condition in self._ignore_conditions):
-                self._fit_to_layer(state, add_marks=True)
+        states = [state for state in self.visible_layers
+                  if not any(condition(state) for condition in self._ignore_conditions)]
+        # Fit all the layers in one pass, so that each one below is cached
+        try:
+            self._fits.fit_many([state.layer for state in states],
+                                self.viewer.state.x_att, self.viewer.state.y_att)
+        except IncompatibleAttribute:
+            pass
+        for state in states:
+            self._fit_to_layer(state, add_marks=True)
 
     def _update_fit_line_for_data(self, data):
         for state in self.visible_layers:
@@ -1,31 +1,31 @@
-from collections import Counter
+from __future__ import annotations
+
+from collections import Counter, OrderedDict
 from datetime import datetime
 import json
 from numbers import Number
 import os
 from math import log10
 from types import UnionType
-from glue.core import Component, ComponentID, Data, DataCollection
-from glue.core.roi import CategoricalComponent
-from glue_plotly.viewers import PlotlyBaseView
 from pydantic import BaseModel
 from pydantic.fields import FieldInfo
-from requests import adapters
 import random
 from types import NoneType
-from typing import Dict, Type, Union, get_args, get_origin
+from typing import TYPE_CHECKING, Dict, Type, Union, get_args, get_origin
 
-from IPython.display import Javascript, display
+import numpy as np
+from functools import partial, wraps
+from threading import Lock
+from weakref import WeakKeyDictionary, WeakSet, ref
 
-from astropy.modeling import models, fitting
-from plotly.graph_objects import Scatter
+from cosmicds.debounce import coalesce, debounce
+from cosmicds.metrics import MetricsAdapter
 
-from glue.core.state_objects import State
-import numpy as np
-from threading import Timer, Event
-from functools import wraps
-from traitlets import Unicode
-from zmq.eventloop.ioloop import IOLoop
+# glue, plotly, astropy, IPython and zmq take seconds to import, so they are
+# only imported by the functions using them
+if TYPE_CHECKING:
+    from glue.core import Component, ComponentID, Data, DataCollection
+    from glue_plotly.viewers import PlotlyBaseView
 
 __all__ = [
     "load_template",
@@ -39,6 +39,7 @@ __all__ = [
     "CDSJSONEncoder",
     "RepeatedTimer",
     "debounce",
+    "coalesce",
 ]
 
 # The URL for the CosmicDS API
@@ -59,6 +60,8 @@ def get_session_id() -> str:
 # JC: I got parts of this from https://stackoverflow.com/a/57915246
 class CDSJSONEncoder(json.JSONEncoder):
     def default(self, obj):
+        from glue.core.state_objects import State
+
         if isinstance(obj, np.integer):
             return int(obj)
         if isinstance(obj, np.floating):
@@ -72,34 +75,39 @@ class CDSJSONEncoder(json.JSONEncoder):
         return super(CDSJSONEncoder, self).default(obj)
 
 
-# JC: I got this from https://stackoverflow.com/a/13151299
 class RepeatedTimer(object):
+    """
+    Calls ``function(*args, **kwargs)`` every ``interval`` seconds, from
+    the process-wide `~cosmicds.scheduler.SCHEDULER` rather than a thread
+    per call. Started on creation, it runs until stopped, or until the
+    kernel that started it closes.
+    """
+
     def __init__(self, interval, function, *args, **kwargs):
-        self._timer = None
+        self._job = None
         self.interval = interval
         self.function = function
         self.args = args
         self.kwargs = kwargs
-        self.is_running = False
         self.start()
 
-    def _run(self):
-        self.is_running = False
-        loop = IOLoop()
-        loop.make_current()
-        self.start()
-        self.function(*self.args, **self.kwargs)
-        loop.close()
+    @property
+    def is_running(self):
+        return self._job is not None and not self._job.cancelled
 
     def start(self):
+        from cosmicds.scheduler import SCHEDULER
+
         if not self.is_running:
-            self._timer = Timer(self.interval, self._run)
-            self._timer.start()
-            self.is_running = True
+            self._job = SCHEDULER.schedule(
+                self.interval,
+                partial(self.function, *self.args, **self.kwargs),
+                name=getattr(self.function, "__qualname__", None),
+            )
 
     def stop(self):
-        self._timer.cancel()
-        self.is_running = False
+        if self._job is not None:
+            self._job.cancel()
 
 
 def load_template(file_name, path=None, traitlet=False):
@@ -120,12 +128,15 @@ def load_template(file_name, path=None, traitlet=False):
     `Unicode`
         The traitlet object used to hold the vue code.
     """
+    from cosmicds.vue_templates import VUE_TEMPLATES
+
     path = os.path.dirname(path)
 
-    with open(os.path.join(path, file_name)) as f:
-        TEMPLATE = f.read()
+    TEMPLATE = VUE_TEMPLATES.read(os.path.join(path, file_name))
 
     if traitlet:
+        from traitlets import Unicode
+
         return Unicode(TEMPLATE)
 
     return TEMPLATE
@@ -256,10 +267,14 @@ def convert_material_color(color_string):
 
 
 def fit_line(x, y):
-    fit = fitting.LinearLSQFitter()
-    line_init = models.Linear1D(intercept=0, fixed={"intercept": True})
-    fitted_line = fit(line_init, x, y)
-    return fitted_line
+    """
+    Fits a line through the origin to the points given by ``x`` and ``y``,
+    in closed form (see `cosmicds.line_fit`). The result is called on ``x``
+    values and has ``slope.value``, like an astropy ``Linear1D`` model.
+    """
+    from cosmicds.line_fit import fit_line
+
+    return fit_line(x, y)
 
 
 def line_mark(start_x, start_y, end_x, end_y, color, label=None):
@@ -280,6 +295,8 @@ def line_mark(start_x, start_y, end_x, end_y, color, label=None):
     label : str, optional
         The label for the line. If provided, the line will be added to the legend.
     """
+    from plotly.graph_objects import Scatter
+
     line = Scatter(
         x=[start_x, end_x],
         y=[start_y, end_y],
@@ -315,51 +332,21 @@ def vertical_line_mark(layer, x, color, label=None):
     )
 
 
-def debounce(wait):
-    """
-    Decorator that will postpone a function's execution until after `wait` seconds have elapsed
-    since the last time it was invoked.
-    """
-
-    def decorator(fn):
-        def debounced(*args, **kwargs):
-            def call_it():
-                return fn(*args, **kwargs)
-
-            if hasattr(debounced, "_timer"):
-                debounced._timer.cancel()
-
-            debounced._timer = Timer(wait, call_it)
-            debounced._timer.start()
-
-        return debounced
-
-    return decorator
-
-
 def _debounce(wait):
     """
     Decorator that will postpone a function's execution until after `wait` seconds have elapsed
     since the last time it was invoked, and return the result of the function.
+
+    This blocks the calling thread until then; use `cosmicds.debounce.coalesce`
+    to get a future for the result instead.
     """
 
     def decorator(fn):
+        coalesced = coalesce(wait)(fn)
+
         @wraps(fn)
         def debounced(*args, **kwargs):
-            def call_it():
-                debounced._result = fn(*args, **kwargs)
-                debounced._called.set()
-
-            if hasattr(debounced, "_timer"):
-                debounced._timer.cancel()
-
-            debounced._timer = Timer(wait, call_it)
-            debounced._timer.start()
-
-            debounced._called = Event()
-            debounced._called.wait()
-
-            return getattr(debounced, "_result", None)
+            return coalesced(*args, **kwargs).result()
 
         return debounced
 
@@ -400,28 +387,152 @@ def percent_around_center_indices(size, percent):
     return bottom_index, top_index
 
 
-def mode(data, component_id, bins=None, range=None):
+# Modes computed by `mode`, by dataset, until one of its components changes
+_mode_cache: "WeakKeyDictionary[Data, OrderedDict]" = WeakKeyDictionary()
+_mode_cache_lock = Lock()
+MODE_CACHE_SIZE = 32
+MODE_CACHE_STATS = {"hits": 0, "misses": 0}
+
+# The hubs whose subset and data changes make `mode` forget subset modes
+_mode_hubs: "WeakSet" = WeakSet()
+_mode_listener = None
+
+
+def _data_version(data) -> tuple:
+    # Component values are read-only in glue, so a change replaces them
+    return tuple(ref(data.get_data(cid)) for cid in data.main_components)
+
+
+def _version_matches(version: tuple, data) -> bool:
+    components = [data.get_data(cid) for cid in data.main_components]
+    return len(version) == len(components) and all(
+        values_ref() is values for values_ref, values in zip(version, components)
+    )
+
+
+def _forget_subset_modes(hub):
+    # A subset state may have changed in place, or depend on data linked
+    # from any dataset of the collection
+    with _mode_cache_lock:
+        for data, cache in list(_mode_cache.items()):
+            if data.hub is hub:
+                for key in [key for key in cache if key[1] is not None]:
+                    del cache[key]
+
+
+def _watch_subsets(hub):
+    global _mode_listener
+
+    from glue.core.hub import HubListener
+    from glue.core.message import NumericalDataChangedMessage, SubsetUpdateMessage
+
+    with _mode_cache_lock:
+        if hub in _mode_hubs:
+            return
+        _mode_hubs.add(hub)
+        if _mode_listener is None:
+            _mode_listener = HubListener()
+
+    hub.subscribe(
+        _mode_listener,
+        SubsetUpdateMessage,
+        handler=lambda message: _forget_subset_modes(hub),
+        filter=lambda message: message.attribute != "style",
+    )
+    hub.subscribe(
+        _mode_listener,
+        NumericalDataChangedMessage,
+        handler=lambda message: _forget_subset_modes(hub),
+    )
+
+
+def mode(data, component_id, bins=None, range=None, subset_state=None):
     """
     Compute the mode of a given dataset, using the component corresponding
     to the given ID. If bins are given, the data values will be binned
-    before finding the modes. Bins should be specified as an integer (# bins)
-    or sequence of scalars.
+    before finding the modes. Bins should be specified as a sequence of
+    scalars, the edges of the (uniform) bins over ``range``. If a
+    ``subset_state`` is given, only the values in that subset are used.
+    Unbinned modes are returned in the order they first appear in the data.
+
+    The counts are computed with numpy (``np.unique`` or a histogram), or
+    in Python for object arrays, and the modes are remembered until the
+    values of a component of the dataset (`~glue.core.Data.get_data`) are
+    replaced, as glue does when they change, e.g. when rows are appended.
+    Modes of a subset are only remembered for datasets in a data collection,
+    and forgotten when any of its subsets or datasets changes. Modes of
+    components linked from other datasets are not remembered, as those can
+    change without this dataset changing.
     """
-
+    if bins is not None:
+        bins = tuple(bins)
+    if range is not None:
+        range = tuple(range)
+    cached = component_id in data.main_components
+    if subset_state is None:
+        key = (component_id, None, bins, range)
+    elif data.hub is not None:
+        _watch_subsets(data.hub)
+        key = (component_id, ref(subset_state), bins, range)
+    else:
+        cached = False
+
+    with _mode_cache_lock:
+        cache = _mode_cache.get(data) if cached else None
+        if cache is not None:
+            entry = cache.get(key)
+            if entry is not None and _version_matches(entry[0], data):
+                cache.move_to_end(key)
+                MODE_CACHE_STATS["hits"] += 1
+                return list(entry[1])
+        MODE_CACHE_STATS["misses"] += 1
+
+    version = _data_version(data)
     if bins is not None:
         hist = data.compute_histogram(
-            [component_id], range=[range], bins=[len(bins) - 1]
+            [component_id],
+            range=[range],
+            bins=[len(bins) - 1],
+            subset_state=subset_state,
         )
         indices = np.flatnonzero(hist == np.amax(hist))
-        return [0.5 * (bins[idx] + bins[idx + 1]) for idx in indices]
+        modes = [0.5 * (bins[idx] + bins[idx + 1]) for idx in indices]
     else:
-        values = data[component_id]
-        counter = Counter(values)
-        max_count = counter.most_common(1)[0][1]
-        return [k for k, v in counter.items() if v == max_count]
+        values = np.asarray(data[component_id])
+        if subset_state is not None:
+            values = values[data.get_mask(subset_state)]
+        if values.dtype.kind in "fc":
+            values = values[~np.isnan(values)]
+        if values.size == 0:
+            modes = []
+        elif values.dtype.kind == "O":
+            # Which may not be comparable with each other, as np.unique needs
+            counter = Counter(values)
+            max_count = counter.most_common(1)[0][1]
+            modes = [k for k, v in counter.items() if v == max_count]
+        else:
+            unique, first, counts = np.unique(
+                values, return_index=True, return_counts=True
+            )
+            indices = np.flatnonzero(counts == counts.max())
+            modes = list(unique[indices[np.argsort(first[indices])]])
+
+    if not cached:
+        return modes
+
+    with _mode_cache_lock:
+        cache = _mode_cache.setdefault(data, OrderedDict())
+        cache[key] = (version, modes)
+        cache.move_to_end(key)
+        while len(cache) > MODE_CACHE_SIZE:
+            cache.popitem(last=False)
+    return list(modes)
 
 
 def component_type_for_field(info: FieldInfo) -> Type[Component]:
+    from glue.core import Component
+    from glue.core.roi import CategoricalComponent
+
     if info.annotation is None:
         return Component  # TODO: What is the right result here?
     numerical = False
@@ -435,6 +546,8 @@ def component_type_for_field(info: FieldInfo) -> Type[Component]:
 
 
 def empty_data_from_model_class(cls: Type[BaseModel], label: str | None=None):
+    from glue.core import Data
+
     data_dict = {}
     for field, info in cls.model_fields.items():
         if info.annotation is None:
@@ -469,10 +582,12 @@ def combine_css(**kwargs):
 
 
 def log_to_console(msg, css="color:white;"):
+    from IPython.display import Javascript, display
+
     display(Javascript(f'console.log("%c{msg}", "{css}");'))
 
 
-class LoggingAdapter(adapters.HTTPAdapter):
+class LoggingAdapter(MetricsAdapter):
     # https://requests.readthedocs.io/en/latest/user/advanced.html?#transport-adapters
     # https://requests.readthedocs.io/en/latest/user/advanced.html?#event-hooks
     def __init__(self, log_prefix=None, *args, **kwargs):
@@ -0,0 +1,173 @@
+import os
+import re
+import threading
+from pathlib import Path
+from typing import Union
+
+from cosmicds.logger import setup_logger
+
+logger = setup_logger("VUE")
+
+
+def component_name(path: Union[str, Path]) -> str:
+    """The kebab-case Vue component name for a file, e.g. ``free-response``."""
+    return re.sub(r"(?<!^)(?=[A-Z])", "-", Path(path).stem).lower()
+
+
+class _Template:
+    __slots__ = ("stamp", "text")
+
+    def __init__(self, stamp: tuple[int, int], text: str):
+        self.stamp = stamp
+        self.text = text
+
+
+class VueTemplateRegistry:
+    """
+    Process-wide cache of the Vue templates read by CosmicDS, so that every
+    file is read once rather than on each page session, and of the
+    component files found under a directory, so that it is not walked again
+    either.
+
+    Files are checked for changes by their modification time and size on
+    every use, which costs a ``stat`` call, so that edits made while
+    developing are still picked up without a restart.
+
+    Registering the components of a directory is done per session, as
+    solara keeps a registry of Vue components per kernel, but components
+    already registered with the same template are skipped.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._templates: dict[str, _Template] = {}
+        # The `.vue` files under a directory, and the directories walked
+        # with their modification times
+        self._listings: dict[str, tuple[list[str], dict[str, int]]] = {}
+        self._stats = {
+            "reads": 0,
+            "cached_reads": 0,
+            "walks": 0,
+            "cached_walks": 0,
+            "registrations": 0,
+            "skipped_registrations": 0,
+        }
+
+    def read(self, path: Union[str, Path]) -> str:
+        """
+        Returns the contents of a template file, reading it again only if
+        it changed since it was last read.
+        """
+        return self._read(path)[0]
+
+    def _read(self, path: Union[str, Path]) -> tuple[str, bool]:
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            template = self._templates.get(path)
+            if template is not None and template.stamp == stamp:
+                self._stats["cached_reads"] += 1
+                return template.text, False
+
+        with open(path) as f:
+            text = f.read()
+        with self._lock:
+            self._templates[path] = _Template(stamp, text)
+            self._stats["reads"] += 1
+        if template is not None:
+            logger.debug("Reloaded changed template `%s`.", path)
+        return text, True
+
+    def component_files(self, directory: Union[str, Path]) -> list[str]:
+        """
+        Returns the ``.vue`` files under ``directory``, walking it again
+        only if one of its directories changed (i.e. a file was added,
+        removed or renamed).
+        """
+        directory = os.path.abspath(directory)
+        with self._lock:
+            listing = self._listings.get(directory)
+        if listing is not None:
+            files, directories = listing
+            try:
+                unchanged = all(
+                    os.stat(path).st_mtime_ns == mtime
+                    for path, mtime in directories.items()
+                )
+            except OSError:
+                unchanged = False
+            if unchanged:
+                with self._lock:
+                    self._stats["cached_walks"] += 1
+                return list(files)
+
+        files, directories = [], {}
+        for root, _, names in os.walk(directory):
+            directories[root] = os.stat(root).st_mtime_ns
+            files.extend(
+                os.path.join(root, name) for name in names if name.endswith(".vue")
+            )
+        files.sort()
+        with self._lock:
+            self._listings[directory] = (files, directories)
+            self._stats["walks"] += 1
+        return list(files)
+
+    def register_components(self, directory: Union[str, Path]) -> dict:
+        """
+        Registers every ``.vue`` file under ``directory`` as a Vue component
+        of the current session, named after the file (see
+        `component_name`). Returns how many components were registered,
+        how many were already registered with the same template, and how
+        many files had to be read from disk.
+        """
+        import ipyvue
+        from ipyvue import VueComponentRegistry
+
+        registered = skipped = files_read = 0
+        for path in self.component_files(directory):
+            name = component_name(path)
+            text, was_read = self._read(path)
+            files_read += was_read
+            # Resolved on each call, as solara makes the registry per kernel
+            existing = VueComponentRegistry.vue_component_registry.get(name)
+            if existing is not None and existing.component == text:
+                skipped += 1
+                continue
+            # Lets ipyvue reload the component when the file changes
+            VueComponentRegistry.vue_component_files[path] = name
+            ipyvue.register_component_from_string(name, text)
+            registered += 1
+
+        with self._lock:
+            self._stats["registrations"] += registered
+            self._stats["skipped_registrations"] += skipped
+        result = {
+            "registered": registered,
+            "skipped": skipped,
+            "files_read": files_read,
+        }
+        logger.debug(
+            "Registered %(registered)d Vue components (%(skipped)d already "
+            "registered, %(files_read)d files read).",
+            result,
+        )
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+            self._listings.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns the number of file reads and directory walks done and
+        saved, and of the component registrations done and skipped, since
+        the process started.
+        """
+        with self._lock:
+            return dict(self._stats, templates=len(self._templates))
+
+
+VUE_TEMPLATES = VueTemplateRegistry()
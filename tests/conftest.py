@@ -7,4 +7,201 @@
     - https://docs.pytest.org/en/stable/writing_plugins.html
 """
 
-# import pytest
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--benchmark",
+        action="store_true",
+        help="Run the benchmarks, which only report their timings.",
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--benchmark"):
+        return
+    skip = pytest.mark.skip(reason="benchmark (run with --benchmark)")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
+class StandInAPIServer(ThreadingHTTPServer):
+    """
+    A local, in-memory stand-in for the CosmicDS API server, implementing
+    the endpoints used by `cosmicds.remote.BaseAPI`. Every request sleeps for
+    ``latency`` seconds before being answered, so that login latency can be
+    benchmarked offline.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0):
+        super().__init__(("127.0.0.1", 0), _StandInHandler)
+        self.latency = latency
+        self.fail_with = None
+        self.accept_patches = True
+        self.lock = threading.Lock()
+        self.requests = []
+        self.bytes_received = 0
+        # The most requests handled at once since the last reset
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.students = {}
+        self.educators = {}
+        self.classes = {}
+        self.story_states = {}
+        self.stage_states = {}
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def add_student(self, hashed_user, student_id, class_id=1, class_size=20):
+        self.students[hashed_user] = {"id": student_id, "username": hashed_user}
+        self.classes[student_id] = {"id": class_id, "size": class_size}
+
+    def reset_requests(self):
+        with self.lock:
+            self.requests.clear()
+            self.bytes_received = 0
+            self.max_in_flight = 0
+
+    def handle_api(self, method, path, body, size=0):
+        with self.lock:
+            self.requests.append((method, path))
+            self.bytes_received += size
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        try:
+            return self._handle_api(method, path, body)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def _handle_api(self, method, path, body):
+        time.sleep(self.latency)
+        if self.fail_with is not None:
+            return self.fail_with, {"detail": "Unavailable"}
+
+        if match := re.fullmatch(r"/student/(\w+)", path):
+            return 200, {"student": self.students.get(match[1])}
+        if match := re.fullmatch(r"/educators/(\w+)", path):
+            return 200, {"educator": self.educators.get(match[1])}
+        if path == "/students/create":
+            student_id = len(self.students) + 1
+            self.add_student(body["username"], student_id)
+            return 201, {"success": True}
+        if match := re.fullmatch(r"/class-for-student-story/(\d+)/([\w-]+)", path):
+            info = self.classes.get(int(match[1]), {"id": 0, "size": 0})
+            return 200, {"class": {"id": info["id"]}, "size": info["size"]}
+        if match := re.fullmatch(r"/classes/size/(\d+)", path):
+            class_id = int(match[1])
+            sizes = [c["size"] for c in self.classes.values() if c["id"] == class_id]
+            return 200, {"size": sizes[0] if sizes else 0}
+        if match := re.fullmatch(r"/story-state/(\d+)/([\w-]+)", path):
+            return self._state(self.story_states, match.groups(), method, body)
+        if match := re.fullmatch(r"/stage-state/(\d+)/([\w-]+)/([\w-]+)", path):
+            return self._state(self.stage_states, match.groups(), method, body)
+
+        return 404, {"detail": "Not found"}
+
+    def _state(self, states, key, method, body):
+        if method == "GET":
+            return 200, {"state": states.get(key)}
+        if method == "PUT":
+            states[key] = body
+            return 200, {"state": body}
+        if method == "PATCH":
+            if not self.accept_patches:
+                return 415, {"detail": "Unsupported media type"}
+            if key not in states:
+                return 404, {"detail": "Not found"}
+            states[key] = _apply_patch(states[key], body)
+            return 200, {"state": states[key]}
+        if method == "DELETE":
+            existed = states.pop(key, None) is not None
+            return (200 if existed else 404), {"success": existed}
+        return 405, {"detail": "Method not allowed"}
+
+
+def _apply_patch(document, patch):
+    document = json.loads(json.dumps(document))
+    for op in patch:
+        *parents, last = [
+            part.replace("~1", "/").replace("~0", "~")
+            for part in op["path"].split("/")[1:]
+        ]
+        target = document
+        for part in parents:
+            target = target[int(part) if isinstance(target, list) else part]
+        if isinstance(target, list):
+            last = int(last)
+        if op["op"] == "remove":
+            del target[last]
+        else:
+            target[last] = op["value"]
+    return document
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _handle(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        status, payload = self.server.handle_api(self.command, self.path, body, length)
+
+        data = json.dumps(payload).encode()
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        if self.command == "GET" and status == 200:
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        if self.command == "GET" and status == 200:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_PUT = do_POST = do_DELETE = do_PATCH = _handle
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def api_server(monkeypatch):
+    """
+    Starts a `StandInAPIServer` and points `cosmicds.remote.BaseAPI` at it.
+    """
+    from cosmicds.remote import BaseAPI
+
+    server = StandInAPIServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    monkeypatch.setattr(BaseAPI, "API_URL", server.url)
+    monkeypatch.setenv("SOLARA_SESSION_SECRET_KEY", "cosmicds-tests")
+    # Which, unlike the API server by default, applies patches
+    monkeypatch.setattr("cosmicds.storage.API_SUPPORTS_PATCH", True)
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
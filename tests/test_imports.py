@@ -0,0 +1,32 @@
+import subprocess
+import sys
+
+# Dependencies that must only be imported once a page uses them
+HEAVY_MODULES = {"glue", "glue_jupyter", "glue_plotly", "plotly", "astropy", "bqplot"}
+
+
+def _import_times(module):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def test_layout_imports_lazily():
+    times = _import_times("cosmicds.layout")
+    assert "cosmicds.layout" in times
+    assert {name.split(".")[0] for name in times} & HEAVY_MODULES == set()
+
+    # The components are only imported when used
+    assert "cosmicds.components.viewer_layout" not in times
+    from cosmicds.components import ViewerLayout  # noqa: F401
@@ -0,0 +1,175 @@
+import os
+
+import solara
+from solara.server import kernel_context
+from solara.toestand import Ref
+
+from cosmicds import layout
+from cosmicds.profiling import OTHER_TRIGGER, render_profiler
+from cosmicds.state import BaseLocalState
+
+PARTS = [
+    "AppBar",
+    "PointsChip",
+    "SpeechMenu",
+    "NavigationDrawer",
+    "StudentInfoPanel",
+    "RouteList",
+    "MainContent",
+    "Footer",
+]
+
+
+class StoryState(BaseLocalState):
+    pass
+
+
+def _render_layout(local_state, on_render=lambda: None):
+    routes = [solara.Route("/", label="Introduction"), solara.Route("stage-1")]
+
+    @solara.component
+    def Layout():
+        on_render()
+        layout.BaseLayout(local_state, children=[solara.Text("Content")])
+
+    @solara.component
+    def App():
+        path, set_path = solara.use_state("")
+        solara.routing._location_context.provide(
+            solara.routing._Location(path, set_path)
+        )
+        solara.routing.router_context.provide(
+            solara.routing.Router(path, routes=routes, set_path=set_path)
+        )
+        Layout()
+
+    _, rc = solara.render(App(), handle_error=False)
+    return rc
+
+
+def test_points_update_only_renders_the_points_chip(monkeypatch):
+    renders = {name: 0 for name in PARTS + ["Layout"]}
+    for name in PARTS:
+        component = getattr(layout, name)
+
+        def counted(*args, _render=component.f, _name=name, **kwargs):
+            renders[_name] += 1
+            return _render(*args, **kwargs)
+
+        monkeypatch.setattr(component, "f", counted)
+
+    local_state = solara.reactive(StoryState(title="Hubble", story_id="hubbles_law"))
+    rc = _render_layout(
+        local_state, lambda: renders.update(Layout=renders["Layout"] + 1)
+    )
+    assert set(renders.values()) == {1}
+
+    Ref(local_state.fields.piggybank_total).set(100)
+    assert renders.pop("PointsChip") == 2
+    assert set(renders.values()) == {1}
+
+    # Unlocking a stage only renders the route list
+    Ref(local_state.fields.max_route_index).set(1)
+    assert renders.pop("RouteList") == 2
+    assert set(renders.values()) == {1}
+    rc.close()
+
+
+def test_render_profiler_records_renders_in_debug_mode():
+    profiler = render_profiler()
+    profiler.reset()
+    local_state = solara.reactive(StoryState(title="Hubble", story_id="hubbles_law"))
+    rc = _render_layout(local_state)
+    assert not profiler.enabled
+    assert profiler.snapshot() == {}
+
+    Ref(local_state.fields.debug_mode).set(True)
+    assert profiler.enabled
+    Ref(local_state.fields.piggybank_total).set(100)
+    Ref(local_state.fields.piggybank_total).set(200)
+    profile = profiler.snapshot()
+    assert profile["PointsChip"]["renders"] == 2
+    assert profile["PointsChip"]["p95_ms"] <= profile["PointsChip"]["total_ms"]
+    # Reads are only tracked once profiling is on
+    triggers = profile["PointsChip"]["triggers"]
+    assert triggers.pop(OTHER_TRIGGER) == 1
+    (trigger, count), = triggers.items()
+    assert trigger.startswith("StoryState") and trigger.endswith(".piggybank_total")
+    assert count == 1
+    # Re-rendered with debug mode on, before the effect enabled profiling
+    assert "BaseLayout" not in profile
+    assert "RouteList" not in profile
+
+    Ref(local_state.fields.debug_mode).set(False)
+    assert not profiler.enabled
+    rc.close()
+    profiler.reset()
+
+
+def test_render_profilers_are_per_session():
+    sessions = [
+        kernel_context.VirtualKernelContext(
+            id=f"kernel-{i}", kernel=None, session_id=f"session-{i}"
+        )
+        for i in range(2)
+    ]
+    with sessions[0]:
+        profiler = render_profiler()
+        assert render_profiler() is profiler
+        profiler.enable()
+        profiler.record("PointsChip", 0.001, [])
+    with sessions[1]:
+        other = render_profiler()
+        assert other is not profiler
+        assert not other.enabled
+        assert other.snapshot() == {}
+
+    # Closing a session drops its profiler
+    for callback in sessions[0]._on_close_callbacks:
+        callback()
+    with sessions[0]:
+        assert render_profiler() is not profiler
+
+
+def test_vue_templates_are_read_and_registered_once(tmp_path):
+    from ipyvue import VueComponentRegistry
+
+    from cosmicds.vue_templates import VueTemplateRegistry
+
+    (tmp_path / "nested").mkdir()
+    first = tmp_path / "CdsTestFirst.vue"
+    first.write_text("<template><div>1</div></template>")
+    (tmp_path / "nested" / "CdsTestSecond.vue").write_text("<template/>")
+    registry = VueTemplateRegistry()
+    components = VueComponentRegistry.vue_component_registry
+
+    try:
+        result = registry.register_components(tmp_path)
+        assert result == {"registered": 2, "skipped": 0, "files_read": 2}
+        assert components["cds-test-first"].component.endswith("1</div></template>")
+
+        # A new session reuses the files read, and the components registered
+        assert registry.register_components(tmp_path) == {
+            "registered": 0,
+            "skipped": 2,
+            "files_read": 0,
+        }
+        assert registry.read(first) == first.read_text()
+        stats = registry.stats()
+        assert (stats["reads"], stats["cached_reads"]) == (2, 3)
+        assert (stats["walks"], stats["cached_walks"]) == (1, 1)
+
+        # Edited and added files are picked up
+        first.write_text("<template><div>2</div></template>")
+        os.utime(first, ns=(0, 10**9))
+        (tmp_path / "CdsTestThird.vue").write_text("<template/>")
+        assert registry.register_components(tmp_path) == {
+            "registered": 2,
+            "skipped": 1,
+            "files_read": 2,
+        }
+        assert components["cds-test-first"].component.endswith("2</div></template>")
+        assert registry.stats()["walks"] == 2
+    finally:
+        for name in ("cds-test-first", "cds-test-second", "cds-test-third"):
+            components.pop(name, None)
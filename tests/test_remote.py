@@ -0,0 +1,1032 @@
+import asyncio
+import gc
+import threading
+import time
+
+import pytest
+import requests
+import solara
+from solara.server import kernel_context
+from solara.toestand import Ref
+from solara_enterprise import auth
+
+from cosmicds.http_cache import ValidatorCache
+from cosmicds.metrics import API_METRICS, template_path
+from cosmicds.resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    ResilientSession,
+    StaleCache,
+    resilient_request,
+)
+from cosmicds.event_loop import run_sync
+from cosmicds.remote import (
+    _MISSING,
+    BaseAPI,
+    IdentityCache,
+    StateCache,
+    StateWriteQueue,
+    get_async_client,
+    make_json_patch,
+)
+from cosmicds.schema import SCHEMA_KEY, STATE_LOAD_STATS, load_state, stamp_schema
+from cosmicds.state import BaseLocalState, BaseState, GlobalState
+from cosmicds.storage import SQLiteStorageBackend, create_backend
+
+STAGES = [f"stage-{i}" for i in range(6)]
+
+
+class StoryState(BaseLocalState):
+    pass
+
+
+class StageState(BaseState):
+    stage_id: str
+    progress: int = 0
+
+
+@pytest.fixture
+def api(api_server):
+    auth.user.set(
+        {"userinfo": {"cds/email": "student@cosmicds", "cds/name": "Student"}}
+    )
+    api = BaseAPI()
+
+    api_server.add_student(api.hashed_user, 7, class_id=3, class_size=25)
+    api_server.story_states[("7", "hubbles_law")] = {
+        "app": {"allow_advancing": False},
+        "story": {"title": "Hubble", "story_id": "hubbles_law", "piggybank_total": 300},
+    }
+    for index, stage_id in enumerate(STAGES):
+        api_server.stage_states[("7", "hubbles_law", stage_id)] = {
+            "stage_id": stage_id,
+            "progress": index,
+        }
+
+    yield api
+
+    auth.user.set(None)
+
+
+def _states():
+    global_state = solara.reactive(GlobalState(update_db=True))
+    local_state = solara.reactive(StoryState(title="Hubble", story_id="hubbles_law"))
+    component_states = [solara.reactive(StageState(stage_id=s)) for s in STAGES]
+    return global_state, local_state, component_states
+
+
+def test_identity_cache():
+    cache = IdentityCache(ttl=60, negative_ttl=0.05, max_users=2)
+    student = {"id": 7}
+
+    # Miss, then hit
+    assert cache.get("alice", "student") is _MISSING
+    cache.set("alice", "student", student)
+    assert cache.get("alice", "student") is student
+    assert cache.stats() == {"hits": 1, "misses": 1, "evictions": 0, "users": 1}
+
+    # Lookups that found nothing expire sooner
+    cache.set("bob", "student", None)
+    assert cache.get("bob", "student") is None
+    time.sleep(0.1)
+    assert cache.get("bob", "student") is _MISSING
+    assert cache.get("alice", "student") is student
+
+    # Least recently used users are evicted
+    cache.set("bob", "student", {"id": 8})
+    cache.get("alice", "student")
+    cache.set("carol", "student", {"id": 9})
+    assert cache.get("bob", "student") is _MISSING
+    assert cache.get("alice", "student") is student
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["users"] == 2
+
+    cache.invalidate("alice")
+    assert cache.get("alice", "student") is _MISSING
+    assert cache.get("carol", "student") == {"id": 9}
+    cache.invalidate()
+    assert cache.stats()["users"] == 0
+
+    # Expiry of found lookups
+    cache = IdentityCache(ttl=0.05)
+    cache.set("alice", "educator", {"id": 1})
+    time.sleep(0.1)
+    assert cache.get("alice", "educator") is _MISSING
+
+
+def test_identity_cache_forgets_unknown_users(api, api_server):
+    api.identity_cache.negative_ttl = 0.05
+    api_server.students.clear()
+    assert not api.user_exists
+
+    # Created through another worker
+    api_server.add_student(api.hashed_user, 7)
+    time.sleep(0.1)
+    assert api.user_exists
+
+
+def test_bootstrap_fills_states(api, api_server):
+    global_state, local_state, component_states = _states()
+
+    assert api.bootstrap("hubbles_law", global_state, local_state, component_states)
+
+    assert global_state.value.student.id == 7
+    assert global_state.value.classroom.class_info == {"id": 3}
+    assert global_state.value.classroom.size == 25
+    assert global_state.value.allow_advancing is False
+    assert local_state.value.piggybank_total == 300
+    assert [s.value.progress for s in component_states] == list(range(len(STAGES)))
+
+
+def test_bootstrap_unknown_user(api, api_server):
+    api_server.students.clear()
+    global_state, local_state, component_states = _states()
+
+    assert not api.bootstrap("hubbles_law", global_state, local_state, component_states)
+    assert global_state.value.student.id is None
+
+
+def test_async_api_methods(api, api_server):
+    async_api = api.async_api
+    global_state, local_state, component_states = _states()
+
+    api_server.reset_requests()
+    assert run_sync(async_api.user_exists())
+    run_sync(async_api.load_user_info("hubbles_law", global_state))
+    assert global_state.value.student.id == 7
+    assert global_state.value.classroom.class_info == {"id": 3}
+    assert global_state.value.classroom.size == 25
+    # The student was looked up once, then taken from the identity cache
+    assert api_server.requests == [
+        ("GET", f"/student/{api.hashed_user}"),
+        ("GET", "/class-for-student-story/7/hubbles_law"),
+    ]
+
+    component_state = component_states[2]
+    stage_state = run_sync(
+        async_api.get_stage_state(global_state, local_state, component_state)
+    )
+    assert stage_state.progress == 2
+    assert component_state.value.progress == 2
+    key = BaseAPI._state_key(global_state, local_state, component_state)
+    assert api.acknowledged_states[key] == {"stage_id": "stage-2", "progress": 2}
+
+    api_server.students.clear()
+    api.identity_cache.invalidate()
+    assert not run_sync(async_api.user_exists())
+
+
+def test_use_api_task(api, api_server):
+    from cosmicds.remote import use_api_task
+
+    async_api = api.async_api
+    tasks = {}
+
+    @solara.component
+    def Page():
+        tasks["exists"] = use_api_task(async_api.user_exists)
+        tasks["lazy"] = use_api_task(async_api.user_exists, lazy=True)
+        solara.Text("")
+
+    _, rc = solara.render(Page(), handle_error=False)
+    for _ in range(100):
+        if tasks["exists"].finished:
+            break
+        time.sleep(0.05)
+    assert tasks["exists"].value is True
+    assert tasks["lazy"].not_called
+    rc.close()
+
+
+def test_bootstrap_requests_concurrently(api, api_server):
+    api_server.latency = 0.05
+
+    global_state, local_state, component_states = _states()
+    api.load_user_info("hubbles_law", global_state)
+    api.get_app_story_states(global_state, local_state)
+    assert api_server.max_in_flight == 1
+
+    api.identity_cache.invalidate()
+    api_server.reset_requests()
+    global_state, local_state, component_states = _states()
+    # A full collection of the heap left by earlier tests (e.g. glue) pauses
+    # every thread for long enough to serialise the requests
+    gc.collect()
+    gc.disable()
+    try:
+        api.bootstrap("hubbles_law", global_state, local_state, component_states)
+    finally:
+        gc.enable()
+
+    # The identity lookups, then everything else, in two concurrent rounds
+    user = api.hashed_user
+    assert sorted(api_server.requests) == sorted(
+        [
+            ("GET", f"/student/{user}"),
+            ("GET", f"/educators/{user}"),
+            ("GET", "/class-for-student-story/7/hubbles_law"),
+            ("GET", "/story-state/7/hubbles_law"),
+        ]
+        + [("GET", f"/stage-state/7/hubbles_law/{stage}") for stage in STAGES]
+    )
+    assert api_server.max_in_flight == 2 + len(STAGES)
+
+
+def test_bootstrap_without_story_state(api, api_server):
+    global_state, _, component_states = _states()
+    data = run_sync(
+        api.async_api.fetch_bootstrap(
+            "hubbles_law", story_id="hubbles_law", stage_ids=STAGES
+        )
+    )
+    assert data.from_database
+
+    # Stage states cannot be keyed without the story, so are not applied
+    assert api._apply_bootstrap(data, global_state, None, component_states)
+    assert global_state.value.student.id == 7
+    assert [s.value.progress for s in component_states] == [0] * len(STAGES)
+
+
+def test_write_queue_coalesces_and_flushes():
+    batches = []
+    queue = StateWriteQueue(
+        lambda batch: batches.append(batch) or {key for key, _ in batch},
+        interval=60,
+    )
+
+    for value in range(100):
+        queue.submit((7, "hubbles_law", "stage-0"), {"progress": value})
+    queue.submit((7, "hubbles_law", None), {"story": {}})
+
+    assert queue.flush(timeout=5)
+    assert batches == [[
+        ((7, "hubbles_law", "stage-0"), {"progress": 99}),
+        ((7, "hubbles_law", None), {"story": {}}),
+    ]]
+    stats = queue.stats()
+    assert stats["coalesced"] == 99
+    assert stats["written"] == 2
+    assert stats["depth"] == 0
+    queue.close(timeout=5)
+
+
+def test_write_queue_retries_failed_writes():
+    attempts = []
+
+    def writer(batch):
+        attempts.append(batch)
+        return set() if len(attempts) < 3 else {key for key, _ in batch}
+
+    queue = StateWriteQueue(writer, interval=60, retry_backoff=0.01)
+    queue.submit((7, "hubbles_law", "stage-0"), {"progress": 1})
+
+    assert queue.flush(timeout=5)
+    assert len(attempts) == 3
+    assert queue.stats()["retried"] == 2
+    queue.close(timeout=5)
+
+
+def test_write_queue_backpressure():
+    release = threading.Event()
+
+    def writer(batch):
+        release.wait(5)
+        return {key for key, _ in batch}
+
+    queue = StateWriteQueue(writer, interval=60, max_pending=2, batch_size=2)
+    queue.submit((1, "story", None), {})
+    queue.submit((2, "story", None), {})
+
+    # The worker takes the full batch, then blocks in the writer
+    assert queue.submit((3, "story", None), {}, timeout=5)
+    queue.submit((4, "story", None), {})
+    assert not queue.submit((5, "story", None), {}, timeout=0.1)
+
+    release.set()
+    assert queue.flush(timeout=5)
+    queue.close(timeout=5)
+
+
+def test_write_queue_does_not_block_while_writes_fail():
+    # As while the API is down: failed writes are requeued and fill the queue
+    queue = StateWriteQueue(
+        lambda batch: set(),
+        interval=0.05,
+        max_pending=2,
+        max_retries=0,
+        submit_timeout=0.1,
+    )
+    queue.submit((1, "story", None), {})
+    queue.submit((2, "story", None), {})
+    for _ in range(100):
+        if queue.stats()["failed"]:
+            break
+        time.sleep(0.01)
+
+    # Snapshots of queued keys replace them, others are dropped
+    assert queue.submit((1, "story", None), {"new": True})
+    assert not queue.submit((3, "story", None), {})
+    assert queue.stats()["dropped"] == 1
+    queue.close(timeout=5)
+
+
+def test_queue_stage_state(api, api_server):
+    global_state, local_state, component_states = _states()
+    api.bootstrap("hubbles_law", global_state, local_state, component_states)
+
+    component_state = component_states[0]
+    for progress in range(10, 20):
+        component_state.set(
+            component_state.value.model_copy(update={"progress": progress})
+        )
+        assert api.queue_stage_state(global_state, local_state, component_state)
+
+    api_server.reset_requests()
+    assert api.flush_states(timeout=5)
+
+    assert api_server.requests == [("PATCH", "/stage-state/7/hubbles_law/stage-0")]
+    assert api_server.stage_states[("7", "hubbles_law", "stage-0")]["progress"] == 19
+    api.write_queue.close(timeout=5)
+
+
+def test_queued_states_are_written_by_overridden_puts(api, api_server):
+    saved = []
+
+    class StoryAPI(BaseAPI):
+        def put_story_state(self, global_state, local_state):
+            session = kernel_context.get_current_context().id
+            saved.append((session, local_state.value.piggybank_total))
+
+    story_api = StoryAPI()
+    global_state, local_state, component_states = _states()
+    context = kernel_context.VirtualKernelContext(
+        id="kernel-0", kernel=None, session_id="session-0"
+    )
+    with context:
+        Ref(global_state.fields.student.id).set(7)
+        Ref(local_state.fields.piggybank_total).set(100)
+        assert story_api.queue_story_state(global_state, local_state)
+        Ref(local_state.fields.piggybank_total).set(200)
+        assert story_api.queue_story_state(global_state, local_state)
+        assert story_api.queue_stage_state(
+            global_state, local_state, component_states[0]
+        )
+
+    api_server.reset_requests()
+    assert story_api.flush_states(timeout=5)
+    # Written once, within the session, with the latest state
+    assert saved == [("kernel-0", 200)]
+    assert api_server.requests == [("PUT", "/stage-state/7/hubbles_law/stage-0")]
+    story_api.write_queue.close(timeout=5)
+
+
+def test_make_json_patch():
+    old = {"a": 1, "b": {"c": [1, 2], "d/e": "x"}, "f": True}
+    new = {"a": 2, "b": {"c": [1, 3], "d/e": "x"}, "g": None}
+
+    assert sorted(make_json_patch(old, new), key=lambda op: op["path"]) == [
+        {"op": "replace", "path": "/a", "value": 2},
+        {"op": "replace", "path": "/b/c/1", "value": 3},
+        {"op": "remove", "path": "/f"},
+        {"op": "add", "path": "/g", "value": None},
+    ]
+    assert make_json_patch(new, new) == []
+
+
+def test_state_uploads_send_deltas(api, api_server):
+    global_state, local_state, component_states = _states()
+    api.bootstrap("hubbles_law", global_state, local_state, component_states)
+    # Stamps the saved states with their schema
+    api.queue_story_state(global_state, local_state)
+    api.queue_stage_state(global_state, local_state, component_states[1])
+    assert api.flush_states(timeout=5)
+
+    Ref(local_state.fields.piggybank_total).set(400)
+    api_server.reset_requests()
+    api.delta_stats.update(bytes_sent=0, bytes_full=0)
+    api.queue_story_state(global_state, local_state)
+    api.queue_stage_state(global_state, local_state, component_states[1])
+    assert api.flush_states(timeout=5)
+
+    # The unchanged stage state is not sent at all
+    assert api_server.requests == [("PATCH", "/story-state/7/hubbles_law")]
+    story = api_server.story_states[("7", "hubbles_law")]
+    assert story["story"]["piggybank_total"] == 400
+    assert story == {
+        "app": stamp_schema(GlobalState, global_state.value.as_dict()),
+        "story": stamp_schema(type(local_state.value), local_state.value.as_dict()),
+    }
+    assert api.delta_stats["bytes_sent"] < api.delta_stats["bytes_full"] / 5
+    api.write_queue.close(timeout=5)
+
+
+def test_patches_are_opt_in_and_counted_when_applied(api, api_server, monkeypatch):
+    assert api.backend.supports_patch
+    monkeypatch.setattr("cosmicds.storage.API_SUPPORTS_PATCH", False)
+    assert not create_backend(api).supports_patch
+
+    global_state, local_state, component_states = _states()
+    api.bootstrap("hubbles_law", global_state, local_state, component_states)
+    Ref(local_state.fields.piggybank_total).set(700)
+    key = (7, "hubbles_law", None)
+    snapshot = {
+        "app": global_state.value.as_dict(),
+        "story": local_state.value.as_dict(),
+    }
+    patches = api.delta_stats["patches"]
+
+    api_server.fail_with = 503
+    api_server.reset_requests()
+    assert run_sync(api.async_api.put_state_snapshots([(key, snapshot)])) == set()
+    assert api_server.requests == [("PATCH", "/story-state/7/hubbles_law")]
+    assert api.delta_stats["patches"] == patches
+    api_server.fail_with = None
+    assert run_sync(api.async_api.put_state_snapshots([(key, snapshot)])) == {key}
+    assert api.delta_stats["patches"] == patches + 1
+
+
+def test_rejected_patch_falls_back_to_full_state(api, api_server):
+    api_server.accept_patches = False
+    global_state, local_state, component_states = _states()
+    api.bootstrap("hubbles_law", global_state, local_state, component_states)
+    Ref(local_state.fields.piggybank_total).set(500)
+
+    api_server.reset_requests()
+    api.queue_story_state(global_state, local_state)
+    assert api.flush_states(timeout=5)
+
+    assert api_server.requests == [
+        ("PATCH", "/story-state/7/hubbles_law"),
+        ("PUT", "/story-state/7/hubbles_law"),
+    ]
+    story = api_server.story_states[("7", "hubbles_law")]["story"]
+    assert story["piggybank_total"] == 500
+    assert api.delta_stats["fallbacks"] == 1
+    # The rejected patch was sent too
+    patch_size = api.delta_stats["bytes_sent"] - api.delta_stats["bytes_full"]
+    assert patch_size > 0
+
+    # Patches are not sent again once the server turned them down
+    assert not api.backend.supports_patch
+    api_server.reset_requests()
+    Ref(local_state.fields.piggybank_total).set(600)
+    api.queue_story_state(global_state, local_state)
+    assert api.flush_states(timeout=5)
+    assert api_server.requests == [("PUT", "/story-state/7/hubbles_law")]
+    assert api.delta_stats["fallbacks"] == 1
+    api.write_queue.close(timeout=5)
+
+
+def test_sqlite_backend(tmp_path, monkeypatch):
+    monkeypatch.setenv("SOLARA_SESSION_SECRET_KEY", "cosmicds-tests")
+    auth.user.set(
+        {"userinfo": {"cds/email": "student@cosmicds", "cds/name": "Student"}}
+    )
+    path = str(tmp_path / "cosmicds.sqlite3")
+    api = BaseAPI()
+    api.backend = SQLiteStorageBackend(path)
+
+    try:
+        assert not api.user_exists
+        global_state, local_state, component_states = _states()
+        api.create_new_user("hubbles_law", "class-code", global_state)
+        assert global_state.value.student.id == 1
+        assert global_state.value.classroom.size == 1
+
+        Ref(local_state.fields.piggybank_total).set(600)
+        component_states[2].set(
+            component_states[2].value.model_copy(update={"progress": 4})
+        )
+        api.queue_story_state(global_state, local_state)
+        api.queue_stage_state(global_state, local_state, component_states[2])
+        assert api.flush_states(timeout=5)
+        api.write_queue.close(timeout=5)
+
+        # A new process reading the same database sees the saved states
+        api = BaseAPI()
+        api.backend = SQLiteStorageBackend(path)
+        global_state, local_state, component_states = _states()
+        assert api.bootstrap("hubbles_law", global_state, local_state, component_states)
+        assert local_state.value.piggybank_total == 600
+        assert component_states[2].value.progress == 4
+        assert api.backend._query_one("PRAGMA journal_mode")[0] == "wal"
+
+        assert api.backend.delete_stage_state(1, "hubbles_law", "stage-2")
+        assert not api.backend.delete_stage_state(1, "hubbles_law", "stage-2")
+
+        assert not api.is_educator
+        assert api.backend.create_educator("teacher")
+        assert not api.backend.create_educator("teacher")
+        assert api.backend.get_educator("teacher") == {"id": 1, "username": "teacher"}
+        assert api.backend.get_educator(api.hashed_user) is None
+
+        # A student whose class is gone
+        with api.backend._connection() as connection:
+            connection.execute("UPDATE students SET class_id = NULL")
+        api.identity_cache.invalidate()
+        global_state, _, _ = _states()
+        api.load_user_info("hubbles_law", global_state)
+        assert global_state.value.classroom.class_info is None
+        api.update_class_size(global_state)
+        run_sync(api.async_api.update_class_size(global_state))
+        assert global_state.value.classroom.size == 0
+
+        api.backend.create_educator(api.hashed_user)
+        api.identity_cache.invalidate()
+        assert api.is_educator
+    finally:
+        auth.user.set(None)
+
+
+def test_create_backend():
+    with pytest.raises(ValueError):
+        create_backend(BaseAPI(), "carrier-pigeon")
+
+
+def test_template_path():
+    assert template_path("https://api/stage-state/7/hubbles_law/stage-0") == (
+        "/stage-state/{student}/{story}/{stage}"
+    )
+    assert template_path("https://api/student/0123abcd") == "/student/{user}"
+    assert template_path("https://api/unknown/42/route") == "/unknown/{id}/route"
+
+
+def test_endpoint_metrics(api, api_server):
+    API_METRICS.reset()
+    global_state, local_state, component_states = _states()
+    api.load_user_info("hubbles_law", global_state)
+    api.bootstrap("hubbles_law", global_state, local_state, component_states)
+
+    snapshot = API_METRICS.snapshot()
+    stages = snapshot["GET /stage-state/{student}/{story}/{stage}"]
+    assert stages["requests"] == len(STAGES)
+    assert stages["statuses"] == {"200": len(STAGES)}
+    assert stages["in_flight"] == 0
+    assert stages["bytes_in"] > 0
+    assert stages["latency"]["p95"] is not None
+    # Both the sync session and the async client are instrumented
+    assert snapshot["GET /class-for-student-story/{student}/{story}"]["requests"] == 2
+
+    text = API_METRICS.to_prometheus()
+    assert (
+        'cosmicds_api_requests_total{method="GET",'
+        'path="/stage-state/{student}/{story}/{stage}",status="200"} 6'
+    ) in text
+    assert "cosmicds_api_request_duration_seconds_bucket" in text
+
+
+def _resilient_session(**kwargs):
+    kwargs.setdefault("breaker", CircuitBreaker(threshold=3, cooldown=60))
+    kwargs.setdefault("hedge_after", 0)
+    return ResilientSession(stale_cache=StaleCache(), **kwargs)
+
+
+def test_session_retries_and_serves_stale_state(api_server, monkeypatch):
+    monkeypatch.setattr("cosmicds.resilience.backoff_delay", lambda attempt: 0)
+    session = _resilient_session(max_retries=2)
+    url = f"{api_server.url}/classes/size/1"
+    api_server.add_student("user", 1, class_id=1, class_size=30)
+    assert session.get(url).json() == {"size": 30}
+
+    api_server.fail_with = 503
+    api_server.reset_requests()
+    response = session.get(url)
+    # Retried until the circuit opened, then served the last good response
+    assert len(api_server.requests) == 3
+    assert response.json() == {"size": 30}
+    assert response.from_stale_cache
+    assert not hasattr(session.stale_cache.get(url), "from_stale_cache")
+    # Not served to clients of another transport
+    assert session.stale_cache.get(url, "httpx") is None
+    assert session.breaker.state == CircuitBreaker.OPEN
+
+    # While open, requests fail fast without reaching the server
+    api_server.reset_requests()
+    assert session.get(url).json() == {"size": 30}
+    with pytest.raises(CircuitOpenError):
+        session.put(f"{api_server.url}/story-state/1/story", json={})
+    assert api_server.requests == []
+    assert session.breaker.stats()["rejected"] == 2
+
+
+def test_circuit_half_opens_after_cooldown(api_server):
+    session = _resilient_session(
+        breaker=CircuitBreaker(threshold=1, cooldown=0.1), max_retries=0
+    )
+    url = f"{api_server.url}/classes/size/1"
+    api_server.fail_with = 500
+    assert session.get(url).status_code == 500
+    assert session.breaker.state == CircuitBreaker.OPEN
+
+    time.sleep(0.15)
+    assert session.breaker.state == CircuitBreaker.HALF_OPEN
+    api_server.fail_with = None
+    assert session.get(url).status_code == 200
+    assert session.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_interrupted_probes_are_released(api_server):
+    breaker = CircuitBreaker(threshold=1, cooldown=0.05)
+    url = f"{api_server.url}/classes/size/1"
+
+    def half_open():
+        breaker.record_failure()
+        time.sleep(0.1)
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+
+    # A probe cancelled along with its task
+    started = asyncio.Event()
+
+    async def hang(headers):
+        started.set()
+        await asyncio.sleep(60)
+
+    async def cancel_probe():
+        task = asyncio.ensure_future(
+            resilient_request(hang, "GET", url, breaker, StaleCache(), hedge_after=0)
+        )
+        await started.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    half_open()
+    asyncio.run(cancel_probe())
+    assert breaker.acquire() == CircuitBreaker.HALF_OPEN
+    breaker.release_probe()
+
+    # A probe failing with an error that is not a request error
+    session = _resilient_session(breaker=breaker, max_retries=0)
+    with pytest.raises(TypeError):
+        session.get(url, unknown_argument=True)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert session.get(url).status_code == 200
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_session_times_out_and_hedges(api_server):
+    session = _resilient_session(timeout=(1, 0.1), max_retries=0)
+    api_server.latency = 0.3
+    with pytest.raises(requests.Timeout):
+        session.get(f"{api_server.url}/classes/size/1")
+
+    # Only the first request is slow, so the hedged one answers first
+    slow = threading.Event()
+    release = threading.Event()
+    handle_api = api_server.handle_api
+
+    def first_slow(*args):
+        if not slow.is_set():
+            slow.set()
+            release.wait(5)
+        return handle_api(*args)
+
+    api_server.latency = 0
+    api_server.handle_api = first_slow
+    session, sent = _recording_session(hedge_after=0.05, timeout=(1, 5))
+    response = session.get(f"{api_server.url}/classes/size/1")
+    assert response.status_code == 200
+    # Answered by the hedge, without waiting for the first attempt
+    (first,), (hedge,) = sent
+    assert first is None and hedge is response
+    # whose response is discarded once it arrives
+    release.set()
+    for _ in range(100):
+        if sent[0][0] is not None:
+            break
+        time.sleep(0.05)
+    assert sent[0][0].raw.closed
+
+    # Fast requests are never hedged
+    sent.clear()
+    slow.clear()
+    api_server.handle_api = handle_api
+    for _ in range(20):
+        session.get(f"{api_server.url}/classes/size/1")
+    assert len(sent) == 20
+
+    # A hedge losing to the first attempt is closed
+    sent.clear()
+
+    def second_slower(*args):
+        if not slow.is_set():
+            slow.set()
+            time.sleep(0.2)
+        else:
+            time.sleep(0.5)
+        return handle_api(*args)
+
+    api_server.handle_api = second_slower
+    response = session.get(f"{api_server.url}/classes/size/1")
+    assert response.json() == {"size": 0}
+    for _ in range(100):
+        if len(sent) == 2 and sent[1][0] is not None:
+            break
+        time.sleep(0.05)
+    (first,), (hedge,) = sent
+    assert first is response and hedge.raw.closed
+
+
+def _recording_session(**kwargs):
+    # Records every request sent, with its response once answered
+    sent = []
+
+    class RecordingAdapter(requests.adapters.HTTPAdapter):
+        def send(self, *args, **kwargs):
+            entry = [None]
+            sent.append(entry)
+            entry[0] = super().send(*args, **kwargs)
+            return entry[0]
+
+    session = _resilient_session(**kwargs)
+    session.mount("http://", RecordingAdapter())
+    return session, sent
+
+
+def test_async_resilient_request():
+    breaker = CircuitBreaker(threshold=2, cooldown=60)
+    attempts = []
+
+    async def send(headers):
+        attempts.append(1)
+        raise OSError("unreachable")
+
+    async def run():
+        return await resilient_request(
+            send, "GET", "url", breaker, StaleCache(), max_retries=5, hedge_after=0
+        )
+
+    with pytest.raises(OSError, match="unreachable"):
+        asyncio.run(run())
+    assert len(attempts) == 2
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(run())
+
+
+def test_conditional_requests_reuse_unchanged_bodies(api, api_server):
+    global_state, local_state, component_states = _states()
+    api.bootstrap("hubbles_law", global_state, local_state, component_states)
+    before = api.http_cache_stats.get("/classes/size/{class}", {"hits": 0})["hits"]
+
+    for _ in range(10):
+        api.update_class_size(global_state)
+    api_server.classes[7]["size"] = 26
+    api.update_class_size(global_state)
+
+    stats = api.http_cache_stats["/classes/size/{class}"]
+    assert stats["hits"] - before == 9
+    assert stats["bytes_saved"] > 0
+    assert global_state.value.classroom.size == 26
+
+    # Story state polling only downloads the state when it changed
+    api_server.story_states[("7", "hubbles_law")]["app"]["student"] = {"id": 7}
+    api_server.reset_requests()
+    for _ in range(3):
+        print("BEFORE", global_state.value.student, id(global_state.value.student))
+        api.get_app_story_states(global_state, local_state)
+    assert api_server.requests == [("GET", "/story-state/7/hubbles_law")] * 3
+    assert api.http_cache_stats["/story-state/{student}/{story}"]["hits"] == 2
+    assert local_state.value.piggybank_total == 300
+
+
+def test_validator_cache_with_async_client(api, api_server):
+    cache = ValidatorCache()
+    url = f"{api_server.url}/classes/size/3"
+
+    async def poll():
+        async def send(headers):
+            return await get_async_client().request("GET", url, headers=headers)
+
+        return [
+            (await resilient_request(send, "GET", url, validators=cache)).json()
+            for _ in range(3)
+        ]
+
+    assert run_sync(poll()) == [{"size": 25}] * 3
+    assert cache.stats()["total"]["hits"] == 2
+
+    # The requests client does not reuse the httpx responses
+    session = _resilient_session(validators=cache)
+    response = session.get(url)
+    assert isinstance(response, requests.Response)
+    assert cache.stats()["total"]["hits"] == 2
+    assert session.get(url) is response
+
+
+def test_prefetch_stage_states(api, api_server):
+    global_state, local_state, component_states = _states()
+    # Only the first stage is loaded at login, the others are prefetched
+    api.bootstrap("hubbles_law", global_state, local_state, component_states[:1])
+
+    # The server holds the requests until they were all received
+    answer = threading.Event()
+    handle_api = api_server._handle_api
+
+    def held(*args):
+        answer.wait(5)
+        return handle_api(*args)
+
+    api_server._handle_api = held
+    api_server.reset_requests()
+    futures = api.prefetch_stage_states("hubbles_law", STAGES)
+    assert set(futures) == set(STAGES)
+    assert futures[STAGES[0]].done()
+    assert not any(futures[stage_id].done() for stage_id in STAGES[1:])
+    # Prefetched concurrently, skipping the stage loaded at login
+    deadline = time.monotonic() + 5
+    while api_server.in_flight < len(STAGES) - 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert api_server.max_in_flight == len(STAGES) - 1
+    answer.set()
+    for future in futures.values():
+        future.result(timeout=5)
+    assert sorted(path for _, path in api_server.requests) == sorted(
+        f"/stage-state/7/hubbles_law/{stage_id}" for stage_id in STAGES[1:]
+    )
+    api_server._handle_api = handle_api
+
+    # Later reads are answered from the prefetched states
+    api_server.reset_requests()
+    for component_state in component_states[1:]:
+        api.get_stage_state(global_state, local_state, component_state)
+    assert api_server.requests == []
+    assert [s.value.progress for s in component_states] == list(range(len(STAGES)))
+
+    # Queued changes are seen by later reads
+    component_state = component_states[3]
+    component_state.set(component_state.value.model_copy(update={"progress": 30}))
+    api.queue_stage_state(global_state, local_state, component_state)
+    component_state.set(component_state.value.model_copy(update={"progress": 0}))
+    api.get_stage_state(global_state, local_state, component_state)
+    assert component_state.value.progress == 30
+    assert api_server.requests == []
+    api.write_queue.close(timeout=5)
+
+
+def test_stage_state_caches_are_bounded_and_forgotten(api, api_server):
+    cache = StateCache(size=3)
+    for stage_id in STAGES:
+        cache[(7, "hubbles_law", stage_id)] = {}
+    assert list(cache) == [(7, "hubbles_law", stage_id) for stage_id in STAGES[-3:]]
+
+    global_state, local_state, component_states = _states()
+    sessions = [
+        kernel_context.VirtualKernelContext(
+            id=f"kernel-{i}", kernel=None, session_id=f"session-{i}"
+        )
+        for i in range(2)
+    ]
+    for context in sessions:
+        with context:
+            api.bootstrap("hubbles_law", global_state, local_state, component_states)
+    assert len(api.stage_state_cache) == len(STAGES)
+    assert len(api.acknowledged_states) == len(STAGES) + 1
+
+    # The states are kept while any of the student's sessions is open
+    for index, context in enumerate(sessions):
+        for callback in context._on_close_callbacks:
+            callback()
+        if index == 0:
+            assert len(api.stage_state_cache) == len(STAGES)
+    assert len(api.stage_state_cache) == 0
+    assert len(api.acknowledged_states) == 0
+
+    # And when the student logs out
+    api.bootstrap("hubbles_law", global_state, local_state, component_states)
+    assert len(api.stage_state_cache) == len(STAGES)
+    api.forget_user(global_state)
+    BaseAPI.clear_user(global_state)
+    assert len(api.stage_state_cache) == 0
+    assert len(api.acknowledged_states) == 0
+    assert global_state.value.student.id == 0
+    api.write_queue.close(timeout=5)
+
+
+def test_login_runs_once_off_the_render_path(api, api_server, monkeypatch):
+    from cosmicds import layout
+    from cosmicds.state import GLOBAL_STATE, LOGIN_STATUS, LoginStatus
+
+    monkeypatch.setattr(layout, "BASE_API", api)
+    monkeypatch.setattr(layout, "get_session_id", lambda: "session")
+    monkeypatch.setattr(layout.settings.main, "base_url", "http://localhost/")
+    api_server.latency = 0.05
+    local_state = solara.reactive(StoryState(title="Hubble", story_id="hubbles_law"))
+    Ref(GLOBAL_STATE.fields.update_db).set(True)
+    renders = solara.reactive(0)
+
+    @solara.component
+    def Page():
+        layout.BaseSetup("hubbles_law", local_state=local_state, stage_ids=STAGES)
+        solara.Text(str(renders.value))
+
+    # Held until the render has returned, which must not wait on it
+    release = threading.Event()
+    bootstrap_threads = []
+    bootstrap = api.bootstrap
+
+    def held_bootstrap(*args, **kwargs):
+        bootstrap_threads.append(threading.current_thread())
+        assert release.wait(5)
+        return bootstrap(*args, **kwargs)
+
+    monkeypatch.setattr(api, "bootstrap", held_bootstrap)
+
+    api_server.reset_requests()
+    _, rc = solara.render(Page(), handle_error=False)
+    # The task may not have started yet, but cannot have finished
+    assert LOGIN_STATUS.value.state in ("idle", "loading")
+    release.set()
+
+    for _ in range(100):
+        if LOGIN_STATUS.value.state not in ("idle", "loading"):
+            break
+        time.sleep(0.05)
+    status = LOGIN_STATUS.value
+    assert status.state == "ready"
+    assert status.user == api.hashed_user
+    assert {"educator", "bootstrap", "prefetch", "total"} <= set(status.timings)
+    assert GLOBAL_STATE.value.student.id == 7
+    assert local_state.value.piggybank_total == 300
+    assert bootstrap_threads and threading.current_thread() not in bootstrap_threads
+
+    # Re-rendering does not log in again
+    for future in list(api.stage_state_cache.values()):
+        future.result(5)
+    requests = len(api_server.requests)
+    for i in range(1, 4):
+        renders.set(i)
+    time.sleep(0.2)
+    assert LOGIN_STATUS.value == status
+    assert len(api_server.requests) == requests
+
+    rc.close()
+    api.write_queue.close(timeout=5)
+    LOGIN_STATUS.set(LoginStatus())
+    GLOBAL_STATE.set(GlobalState())
+
+
+class _Measurement(BaseState):
+    galaxy: str = ""
+    velocity: float | None = None
+    flags: tuple[str, ...] = ()
+
+
+class _MeasurementState(BaseState):
+    stage_id: str = "measurements"
+    measurements: list[_Measurement] = []
+    spectrum: list[float] = []
+    bins: list[list[float]] = []
+    responses: dict[str, dict] = {}
+
+
+def _measurement_state():
+    return _MeasurementState(
+        measurements=[_Measurement(galaxy=f"g{i}", velocity=i) for i in range(50)],
+        spectrum=[float(i) for i in range(20000)],
+        bins=[[0.0, 1.0]] * 2000,
+        responses={str(i): {"choice": i, "tries": [1, 2]} for i in range(300)},
+    )
+
+
+def test_stamped_states_skip_validation():
+    state = _measurement_state()
+    stamped = stamp_schema(_MeasurementState, state.as_dict())
+    plain = {key: value for key, value in stamped.items() if key != SCHEMA_KEY}
+
+    before = dict(STATE_LOAD_STATS)
+    trusted = load_state(_MeasurementState, stamped)
+    assert trusted == state
+    assert isinstance(trusted.measurements[0], _Measurement)
+    assert load_state(_MeasurementState, plain) == state
+    # Stamped by another version of the model
+    assert load_state(_MeasurementState, dict(plain, **{SCHEMA_KEY: "0"})) == state
+    assert STATE_LOAD_STATS["trusted"] - before["trusted"] == 1
+    assert STATE_LOAD_STATS["validated"] - before["validated"] == 2
+
+    # Bad nested values are still caught
+    broken = dict(stamped, measurements=[{"velocity": "fast"}])
+    with pytest.raises(ValueError):
+        load_state(_MeasurementState, broken)
+
+
+@pytest.mark.benchmark
+def test_stamped_state_load_benchmark():
+    stamped = stamp_schema(_MeasurementState, _measurement_state().as_dict())
+    plain = {key: value for key, value in stamped.items() if key != SCHEMA_KEY}
+
+    def best_of(payload):
+        times = []
+        for _ in range(5):
+            start = time.perf_counter()
+            for _ in range(10):
+                load_state(_MeasurementState, payload)
+            times.append(time.perf_counter() - start)
+        return min(times) / 10
+
+    validated = best_of(plain)
+    trusted = best_of(stamped)
+    print(
+        f"validated: {validated * 1000:.3f}ms, "
+        f"stamped (model_construct): {trusted * 1000:.3f}ms per load"
+    )
@@ -0,0 +1,184 @@
+import numpy as np
+from glue.core import Data, DataCollection
+from glue.core.link_helpers import LinkSame
+from glue.core.hub import HubListener
+from glue.core.message import NumericalDataChangedMessage
+
+from cosmicds.glue_app import GLUE_APP_STATS, create_glue_app, warm_up
+from cosmicds.memory import SessionMemoryBudget
+from cosmicds.messages import RowsAppendedMessage
+from cosmicds.rows import append_rows
+from cosmicds.shared_data import SharedDataRegistry
+from cosmicds.state import GlobalState
+
+
+def test_glue_apps_are_not_shared():
+    warm_up()
+    assert GLUE_APP_STATS["plugins_seconds"] is not None
+    created = GLUE_APP_STATS["created"]
+
+    apps = [create_glue_app() for _ in range(2)]
+    assert GLUE_APP_STATS["created"] == created + 2
+    assert apps[0].session is not apps[1].session
+    apps[0].data_collection.append(Data(x=np.arange(10), label="galaxies"))
+    assert len(apps[1].data_collection) == 0
+
+
+def test_shared_datasets_are_not_copied(tmp_path):
+    registry = SharedDataRegistry(directory=str(tmp_path))
+    velocities = np.linspace(0, 1e4, 1000)
+    dataset = registry.register(
+        "galaxies",
+        {"velocity": velocities, "name": [f"g{i}" for i in range(1000)]},
+        memmap=True,
+    )
+    assert registry.register("galaxies", {"velocity": [1.0]}) is dataset
+    assert dataset.memmapped
+
+    collections = [DataCollection(), DataCollection()]
+    views = []
+    for collection in collections:
+        view = registry.view("galaxies")
+        collection.append(view)
+        views.append(view)
+
+    first, second = (view["velocity"] for view in views)
+    assert np.shares_memory(first, second)
+    base = first
+    while not isinstance(base, np.memmap) and isinstance(base.base, np.ndarray):
+        base = base.base
+    assert isinstance(base, np.memmap)
+    assert not first.flags.writeable
+    np.testing.assert_array_equal(first, velocities)
+    assert views[0]["name"][3] == "g3"
+
+    # Subsets stay with the session that made them
+    collections[0].new_subset_group("fast", views[0].id["velocity"] > 5e3)
+    assert len(views[0].subsets) == 1
+    assert len(views[1].subsets) == 0
+    assert views[0].subsets[0].to_mask().sum() == 500
+
+    # As do links
+    other = Data(v=np.arange(1000.0), label="other")
+    collections[1].append(other)
+    collections[1].add_link(LinkSame(views[1].id["velocity"], other.id["v"]))
+    assert len(collections[1].external_links) == 1
+    assert len(collections[0].external_links) == 0
+    np.testing.assert_array_equal(other[views[1].id["velocity"]], np.arange(1000.0))
+
+    assert registry.stats() == {
+        "datasets": 1,
+        "nbytes": dataset.nbytes,
+        "memmapped": 1,
+        "views": 2,
+    }
+
+    # Updated or appended values stay with the session that changed them
+    assert all(registry.is_shared(view.get_component("velocity")) for view in views)
+    views[0].update_components({views[0].id["velocity"]: -velocities})
+    append_rows(views[1], {"velocity": [2e4], "name": ["new"]})
+    np.testing.assert_array_equal(views[0]["velocity"], -velocities)
+    assert views[1].shape == (1001,)
+    assert registry.view("galaxies").shape == (1000,)
+    np.testing.assert_array_equal(registry.view("galaxies")["velocity"], velocities)
+    assert not any(
+        registry.is_shared(view.get_component("velocity")) for view in views
+    )
+    assert registry.is_shared(registry.view("galaxies").get_component("name"))
+
+
+def test_append_rows_upserts_and_sends_only_new_rows():
+    collection = DataCollection()
+    data = Data(
+        student=np.array([1, 2]), velocity=np.array([10.0, 20.0]), label="measurements"
+    )
+    collection.append(data)
+    collection.new_subset_group("fast", data.id["velocity"] > 15)
+
+    messages = []
+    changes = []
+    listener = HubListener()
+    collection.hub.subscribe(listener, RowsAppendedMessage, messages.append)
+    # Existing subscribers still see a change
+    viewer = HubListener()
+    collection.hub.subscribe(viewer, NumericalDataChangedMessage, changes.append)
+
+    velocities = data["velocity"]
+    message = append_rows(
+        data, {"student": [2, 3, 4], "velocity": [25.0, 30.0, 5.0]}, key="student"
+    )
+    # Values read before are left as they were
+    np.testing.assert_array_equal(velocities, [10.0, 20.0])
+    assert messages == [message]
+    assert changes == [message]
+    assert data.shape == (4,)
+    assert (message.start, message.count) == (2, 2)
+    np.testing.assert_array_equal(message.updated, [1])
+    np.testing.assert_array_equal(data["student"], [1, 2, 3, 4])
+    np.testing.assert_array_equal(data["velocity"], [10.0, 25.0, 30.0, 5.0])
+    np.testing.assert_array_equal(data["velocity"][message.new_rows], [30.0, 5.0])
+    assert data.subsets[0].to_mask().tolist() == [False, True, True, False]
+
+    # Capacity doubles, so most appends do not reallocate
+    buffers = set()
+    for student in range(5, 1005):
+        append_rows(data, {"student": [student], "velocity": [1.0]}, key="student")
+        buffers.add(data["velocity"].base.ctypes.data)
+    assert data.shape == (1004,)
+    assert len(buffers) <= 10
+
+    # Categorical components grow too
+    names = Data(name=["a", "b"], size=[1, 2], label="names")
+    append_rows(names, {"name": ["c"], "size": [3]})
+    assert names["name"].tolist() == ["a", "b", "c"]
+    assert list(names.get_component("name").categories) == ["a", "b", "c"]
+
+    # Rows with the same key are merged in the batch creating a dataset too
+    state = GlobalState()
+    rows = {"student": [1, 2, 1], "velocity": [10.0, 20.0, 15.0]}
+    measurements = state.append_rows("measurements", rows, "student")
+    assert measurements in state.glue_data_collection
+    np.testing.assert_array_equal(measurements["student"], [1, 2])
+    np.testing.assert_array_equal(measurements["velocity"], [15.0, 20.0])
+    state.append_rows("measurements", {"student": [2], "velocity": [5.0]}, "student")
+    np.testing.assert_array_equal(measurements["velocity"], [15.0, 5.0])
+
+
+def test_memory_budget_spills_least_recently_used_data(tmp_path):
+    app = create_glue_app()
+    budget = SessionMemoryBudget(app, budget=20_000, directory=str(tmp_path))
+    collection = app.data_collection
+    # 8000 bytes each
+    datasets = [Data(x=np.arange(1000.0) + i, label=f"d{i}") for i in range(3)]
+    for data in datasets:
+        collection.append(data)
+    assert budget.stats()["evictions"] == 1
+    assert budget.stats()["resident_bytes"] == 16_000
+
+    # The oldest dataset is mapped from disk, with the same values
+    first = datasets[0]
+    values = first.get_component("x")._data
+    assert isinstance(values, np.memmap)
+    np.testing.assert_array_equal(first["x"], np.arange(1000.0))
+    assert len(list(tmp_path.glob("session-*/*.npy"))) == 1
+
+    # Using it reloads it, and evicts the next least recently used one
+    budget.access(first)
+    stats = budget.stats()
+    assert (stats["reloads"], stats["evictions"]) == (1, 2)
+    assert isinstance(datasets[1].get_component("x")._data, np.memmap)
+    collection.new_subset_group("small", first.id["x"] < 10)
+    assert first.subsets[0].to_mask().sum() == 10
+
+    # Displayed datasets are never evicted
+    budget._displayed = lambda: datasets
+    collection.append(Data(y=np.zeros(1000), label="d3"))
+    assert not isinstance(datasets[2].get_component("x")._data, np.memmap)
+
+    # Replaced values count again, and their spilled file is removed
+    datasets[1].update_components({datasets[1].id["x"]: np.ones(1000)})
+    assert not isinstance(datasets[1].get_component("x")._data, np.memmap)
+
+    collection.remove(datasets[1])
+    budget.close()
+    assert list(tmp_path.iterdir()) == []
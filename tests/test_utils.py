@@ -0,0 +1,379 @@
+import asyncio
+import gc
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from glue.core import Data, DataCollection
+from glue.core.message import SubsetUpdateMessage
+from glue.core.subset import RangeSubsetState
+
+from solara.server import kernel_context
+
+from cosmicds.debounce import Debouncer
+from cosmicds.line_fit import LineFitEngine, fit_lines
+from cosmicds.scheduler import SCHEDULER, Scheduler
+from cosmicds.rows import append_rows
+from cosmicds.utils import (
+    MODE_CACHE_STATS,
+    RepeatedTimer,
+    _debounce,
+    coalesce,
+    debounce,
+    fit_line,
+    mode,
+)
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_scheduler_runs_jobs_on_shared_threads():
+    scheduler = Scheduler(workers=2)
+    ticks = {"fast": 0, "slow": 0}
+    threads = set()
+
+    def tick(name):
+        ticks[name] += 1
+        threads.add(threading.current_thread().name)
+
+    before = threading.active_count()
+    jobs = [
+        scheduler.schedule(0.01, tick, "fast", owner="kernel-1", jitter=0.005),
+        scheduler.schedule(0.05, tick, "slow", owner="kernel-1"),
+    ]
+    _wait_for(lambda: ticks["slow"] >= 3)
+    assert ticks["fast"] > ticks["slow"]
+    # One scheduler thread and the workers, however many runs
+    assert threading.active_count() <= before + 3
+    assert len(threads) <= 2
+
+    # Closing the kernel cancels its jobs
+    assert set(scheduler.jobs(owner="kernel-1")) == set(jobs)
+    assert scheduler.cancel_owner("kernel-1") == 2
+    time.sleep(0.05)
+    counts = dict(ticks)
+    time.sleep(0.1)
+    assert ticks == counts
+
+    stats = scheduler.stats()
+    assert stats["jobs"] == 0 and stats["cancelled"] == 2
+    assert stats["runs"] == sum(ticks.values())
+    assert 0 <= stats["lag_p50"] <= stats["lag_p95"] <= stats["lag_max"]
+    scheduler.close()
+
+
+def test_slow_jobs_skip_runs_instead_of_piling_up():
+    scheduler = Scheduler(workers=4)
+    running = []
+    overlaps = []
+
+    def slow():
+        overlaps.append(len(running))
+        running.append(1)
+        time.sleep(0.05)
+        running.pop()
+
+    job = scheduler.schedule(0.01, slow, delay=0, owner=None)
+    _wait_for(lambda: job.runs >= 3)
+    job.cancel()
+    assert job.skipped > 0
+    assert max(overlaps) == 0
+    scheduler.close()
+
+
+def test_repeated_timer_uses_the_shared_scheduler():
+    calls = []
+    timer = RepeatedTimer(0.01, calls.append, "tick")
+    assert timer.is_running
+    assert timer._job in SCHEDULER.jobs()
+    _wait_for(lambda: len(calls) >= 3)
+    timer.stop()
+    assert not timer.is_running
+    assert timer._job not in SCHEDULER.jobs()
+    assert set(calls) == {"tick"}
+
+    # Restarting schedules it again
+    timer.start()
+    assert timer.is_running
+    timer.stop()
+
+
+def test_debounce_is_per_session_under_load():
+    sessions = [
+        kernel_context.VirtualKernelContext(
+            id=f"kernel-{i}", kernel=None, session_id=f"session-{i}"
+        )
+        for i in range(300)
+    ]
+    saved = {}
+    lock = threading.Lock()
+
+    @debounce(0.05)
+    def save(value):
+        with lock:
+            session = kernel_context.get_current_context().id
+            saved.setdefault(session, []).append(value)
+
+    def type_answer(context):
+        with context:
+            for value in range(20):
+                save(value)
+                time.sleep(0.001)
+
+    before = threading.active_count()
+    with ThreadPoolExecutor(32) as pool:
+        list(pool.map(type_answer, sessions))
+    # No thread per call (at most the pool, event loop and its executor)
+    assert threading.active_count() < before + 32 + 40
+
+    _wait_for(lambda: len(saved) == len(sessions) and save.pending == 0)
+    time.sleep(0.1)
+    # Every session gets exactly its own last call
+    assert saved == {context.id: [19] for context in sessions}
+    assert save.stats()["runs"] == len(sessions)
+
+
+def test_debounce_edges_and_instances():
+    calls = []
+
+    class Editor:
+        def __init__(self, name):
+            self.name = name
+
+        @debounce(0.05, leading=True)
+        def edit(self, value):
+            calls.append((self.name, value))
+
+    first, second = Editor("first"), Editor("second")
+    for value in range(3):
+        first.edit(value)
+        second.edit(value)
+    # Leading calls are made at once, separately for each instance
+    assert calls == [("first", 0), ("second", 0)]
+    _wait_for(lambda: len(calls) == 4)
+    time.sleep(0.1)
+    assert sorted(calls[2:]) == [("first", 2), ("second", 2)]
+
+    # Without a second call, there is no trailing call
+    calls.clear()
+    first.edit(5)
+    time.sleep(0.15)
+    assert calls == [("first", 5)]
+
+    # Bound and unbound calls return nothing, and pending calls do not keep
+    # their instance alive
+    calls.clear()
+    assert first.edit(6) is None
+    assert first.edit(7) is None
+    assert Debouncer(calls.append, 0.05)(8) is None
+    del first
+    gc.collect()
+    _wait_for(lambda: Editor.edit.pending == 0)
+    time.sleep(0.1)
+    assert calls == [("first", 6), 8]
+    assert len(Editor.edit._instance_keys) == 1
+
+    # Calls that keep coming are made at least every `max_wait`
+    values = []
+    throttled = Debouncer(values.append, 0.05, max_wait=0.1)
+    for value in range(30):
+        throttled(value)
+        time.sleep(0.01)
+    _wait_for(lambda: values and values[-1] == 29)
+    assert 2 <= len(values) <= 5
+
+
+def test_coalesced_calls_share_one_execution():
+    runs = []
+
+    @coalesce(0.05)
+    def total(values):
+        runs.append(values)
+        return sum(values)
+
+    start = time.monotonic()
+    futures = [total([i, i]) for i in range(200)]
+    # Nothing waits for the call to be made
+    assert time.monotonic() - start < 0.05
+    assert len(set(futures)) == 1
+    assert futures[0].result(5) == 398
+    assert runs == [[199, 199]]
+
+    # Exceptions reach every caller
+    failing = coalesce(0.01)(lambda: 1 / 0)
+    future = failing()
+    assert failing() is future
+    with pytest.raises(ZeroDivisionError):
+        future.result(5)
+
+    # Blocking callers of `_debounce` get the result of the one call too
+    blocking = _debounce(0.05)(total)
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda i: blocking([i]), range(8)))
+    assert len(set(results)) == 1
+    assert len(runs) == 2
+
+
+def test_coalesced_calls_can_be_awaited():
+    class Counter:
+        def __init__(self):
+            self.runs = 0
+
+        @coalesce(0.02)
+        def refresh(self, value):
+            self.runs += 1
+            return value * 2
+
+    counters = [Counter(), Counter()]
+
+    async def main():
+        return await asyncio.gather(
+            *(counter.refresh.aio(i) for i in range(5) for counter in counters)
+        )
+
+    results = asyncio.run(main())
+    assert results == [8] * 10
+    assert [counter.runs for counter in counters] == [1, 1]
+
+
+def _counter_mode(data, component_id):
+    # The previous, pure Python implementation
+    counter = Counter(data[component_id])
+    max_count = counter.most_common(1)[0][1]
+    return [k for k, v in counter.items() if v == max_count]
+
+
+def test_mode_is_vectorised_and_remembered():
+    rng = np.random.default_rng(42)
+    velocities = np.round(rng.normal(5000, 1500, 300_000), -1)
+    data = Data(velocity=velocities, student=np.arange(300_000) % 30, label="all")
+    velocity = data.id["velocity"]
+
+    before = dict(MODE_CACHE_STATS)
+    modes = mode(data, velocity)
+    # The same values, in the same order, as counting them in Python
+    assert modes == _counter_mode(data, velocity)
+    assert all(type(value) is np.float64 for value in modes)
+    assert mode(data, velocity) == modes
+    assert MODE_CACHE_STATS["misses"] - before["misses"] == 1
+    assert MODE_CACHE_STATS["hits"] - before["hits"] == 1
+
+    # Subsets
+    state = data.id["student"] == 3
+    subset_values = velocities[np.arange(300_000) % 30 == 3]
+    unique, counts = np.unique(subset_values, return_counts=True)
+    assert mode(data, velocity, subset_state=state) == list(
+        unique[counts == counts.max()]
+    )
+
+    # Binned
+    bins = np.linspace(0, 10_000, 11)
+    hist, _ = np.histogram(velocities, bins=bins)
+    assert mode(data, velocity, bins=bins, range=[0, 10_000]) == [
+        bins[hist.argmax()] + 500
+    ]
+    assert mode(
+        data, velocity, bins=bins, range=[0, 10_000], subset_state=velocity > 7000
+    ) == [7500.0]
+
+    # New values are taken into account
+    append_rows(data, {"velocity": np.full(1000, 123.0), "student": np.zeros(1000)})
+    assert mode(data, velocity) == [123.0]
+
+    # As are subset states changed in place, once their subset is updated
+    collection = DataCollection([data])
+    group = collection.new_subset_group("fast", RangeSubsetState(7000, 8000, velocity))
+    state = group.subset_state
+    values = data["velocity"]
+    expected = _counter_mode(Data(v=values[(values > 7000) & (values < 8000)]), "v")
+    assert mode(data, velocity, subset_state=state) == expected
+    before = dict(MODE_CACHE_STATS)
+    assert mode(data, velocity, subset_state=state) == expected
+    assert MODE_CACHE_STATS["hits"] - before["hits"] == 1
+    state.lo, state.hi = 100, 200
+    data.subsets[0].broadcast("subset_state")
+    assert mode(data, velocity, subset_state=state) == [123.0]
+
+    # Values that numpy cannot sort are counted in Python
+    mixed = Data(answer=np.array([1, "a", None, "a"], dtype=object), label="mixed")
+    assert mode(mixed, mixed.id["answer"]) == _counter_mode(mixed, "answer") == ["a"]
+
+
+def test_line_fits_match_astropy_and_update_incrementally():
+    from astropy.modeling import fitting, models
+
+    rng = np.random.default_rng(7)
+    distances = rng.uniform(10, 500, 3000)
+    velocities = 70 * distances + rng.normal(0, 2000, 3000)
+    velocities[::100] = np.nan
+    students = np.arange(3000) % 30
+    finite = np.isfinite(velocities)
+
+    line_init = models.Linear1D(intercept=0, fixed={"intercept": True})
+    expected = fitting.LinearLSQFitter()(
+        line_init, distances[finite], velocities[finite]
+    )
+    fit = fit_line(distances, velocities)
+    assert fit.slope.value == pytest.approx(expected.slope.value)
+    assert fit.intercept.value == 0
+    np.testing.assert_allclose(fit([0, 100]), expected([0, 100]))
+    assert np.isnan(fit_line([], []).slope.value)
+
+    # Every student at once, with a free intercept too
+    fits = fit_lines(distances, velocities, students)
+    free = fit_lines(distances, velocities, students, through_origin=False)
+    for student in (0, 17):
+        mask = finite & (students == student)
+        x, y = distances[mask], velocities[mask]
+        assert fits[student].slope.value == pytest.approx(x @ y / (x @ x))
+        slope, intercept = np.polyfit(x, y, 1)
+        assert free[student].slope.value == pytest.approx(slope)
+        assert free[student].intercept.value == pytest.approx(intercept)
+
+    # Layers of a dataset, kept up to date as rows are appended
+    data = Data(distance=distances, velocity=velocities, student=students)
+    subset = data.new_subset(data.id["student"] == 3)
+    engine = LineFitEngine()
+    layers = [data, subset]
+    before = engine.fit_many(layers, data.id["distance"], data.id["velocity"])
+    assert before[0].slope.value == pytest.approx(expected.slope.value)
+    assert engine.stats() == {"fits": 2, "cached": 0, "incremental": 0}
+
+    new = {
+        "distance": np.full(100, 50.0),
+        "velocity": np.full(100, 9000.0),
+        "student": np.full(100, 3),
+    }
+    engine.rows_appended(append_rows(data, new))
+    after = engine.fit_many(layers, data.id["distance"], data.id["velocity"])
+    assert engine.stats() == {"fits": 2, "cached": 2, "incremental": 2}
+    for layer, fit in zip(layers, after):
+        mask = np.isfinite(layer["velocity"])
+        x, y = layer["distance"][mask], layer["velocity"][mask]
+        assert fit.slope.value == pytest.approx(x @ y / (x @ x))
+        assert fit.count == mask.sum()
+
+    # A new subset definition is fitted again
+    subset.subset_state = data.id["student"] == 4
+    engine.fit(subset, data.id["distance"], data.id["velocity"])
+    assert engine.stats()["fits"] == 3
+
+    # As is one changed in place, once the subset is reported as updated
+    state = subset.subset_state = RangeSubsetState(0, 5, data.id["student"])
+    engine.fit(subset, data.id["distance"], data.id["velocity"])
+    state.hi = 20
+    engine.subset_updated(SubsetUpdateMessage(subset, attribute="subset_state"))
+    fit = engine.fit(subset, data.id["distance"], data.id["velocity"])
+    assert engine.stats()["fits"] == 5
+    mask = np.isfinite(subset["velocity"])
+    x, y = subset["distance"][mask], subset["velocity"][mask]
+    assert fit.slope.value == pytest.approx(x @ y / (x @ x))
+    assert fit.count == mask.sum()